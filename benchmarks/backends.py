@@ -0,0 +1,145 @@
+"""Compare waitress throughput for different ``io_backend`` settings.
+
+Usage::
+
+    python benchmarks/backends.py [--backends=wasyncore,asyncio,uvloop]
+                                  [--clients=8] [--seconds=5]
+
+``uvloop`` means ``io_backend='asyncio'`` with uvloop's event loop policy
+installed; it is skipped when uvloop is not importable.  For every backend
+a server is started in a child process and driven by
+``--clients`` client processes, each issuing keep-alive ``GET`` requests for
+``--seconds`` seconds.  The aggregate number of requests per second is
+printed for each configuration.
+
+Apart from the optional uvloop only the standard library is required.
+The application and the task threads are the same for every backend, so
+the differences are those of the event loops alone.
+"""
+import getopt
+import logging
+import multiprocessing
+import socket
+import sys
+import time
+
+BODY = b'Hello world!\n'
+
+REQUEST = (
+    b'GET / HTTP/1.1\r\n'
+    b'Host: localhost\r\n'
+    b'\r\n'
+)
+
+def app(environ, start_response):
+    start_response('200 OK', [
+        ('Content-Type', 'text/plain'),
+        ('Content-Length', str(len(BODY))),
+    ])
+    return [BODY]
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def serve(port, backend):
+    from waitress.server import create_server
+    if backend == 'uvloop':
+        import asyncio
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        backend = 'asyncio'
+    # queue depth warnings are expected here and only add noise
+    logging.getLogger('waitress').setLevel(logging.ERROR)
+    server = create_server(
+        app,
+        host='127.0.0.1',
+        port=port,
+        io_backend=backend,
+        asyncore_use_selectors=True,
+        connection_limit=1000,
+    )
+    server.run()
+
+def wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start on port %d' % port)
+
+def client(port, seconds, results):
+    sock = socket.create_connection(('127.0.0.1', port))
+    fp = sock.makefile('rb')
+    count = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        sock.sendall(REQUEST)
+        length = 0
+        while True:
+            line = fp.readline()
+            if line in (b'\r\n', b''):
+                break
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':', 1)[1])
+        fp.read(length)
+        count += 1
+    sock.close()
+    results.put(count)
+
+def run(backend, clients, seconds):
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(port, backend))
+    server.daemon = True
+    server.start()
+    try:
+        wait_for(port)
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(
+                target=client, args=(port, seconds, results))
+            for i in range(clients)
+        ]
+        for worker in workers:
+            worker.start()
+        total = sum(results.get() for worker in workers)
+        for worker in workers:
+            worker.join()
+    finally:
+        server.terminate()
+        server.join()
+    return total / float(seconds)
+
+def main(argv=sys.argv):
+    opts, args = getopt.getopt(
+        argv[1:], '', ['backends=', 'clients=', 'seconds='])
+    backends = ['wasyncore', 'asyncio', 'uvloop']
+    clients = 8
+    seconds = 5
+    for opt, value in opts:
+        if opt == '--backends':
+            backends = value.split(',')
+        elif opt == '--clients':
+            clients = int(value)
+        elif opt == '--seconds':
+            seconds = float(value)
+    print('cpus=%d clients=%d seconds=%s' % (
+        multiprocessing.cpu_count(), clients, seconds))
+    for backend in backends:
+        if backend == 'uvloop':
+            try:
+                import uvloop # noqa
+            except ImportError:
+                print('uvloop: not installed')
+                continue
+        rate = run(backend, clients, seconds)
+        print('%s: %.0f requests/sec' % (backend, rate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""Time the parsing of request headers and the building of response headers.
+
+Usage::
+
+    python benchmarks/headers.py [--number=200000]
+
+Parses the headers of a few typical requests into a WSGI environ with
+``HTTPRequestParser`` and ``WSGITask.get_environment``, and builds the status
+line and headers of a few typical responses with
+``Task.build_response_header``.  Each is timed twice: with the tables of
+header names, header lines and status lines the server learns as it goes
+(``waitress.parser.header_keys`` and ``environ_keys``, and
+``waitress.task.header_names``, ``header_lines`` and ``status_lines``), and
+with those tables emptied and kept from learning anything, as a baseline.
+The ``Date`` header is timed alone, formatted for every response
+(``build_http_date``) and once a second (``cached_http_date``).  Nothing is
+sent over the network.
+"""
+import getopt
+import sys
+import time
+import timeit
+
+from waitress import parser
+from waitress import task
+from waitress.adjustments import Adjustments
+from waitress.parser import HTTPRequestParser
+from waitress.task import WSGITask
+from waitress.utilities import build_http_date
+
+try:
+    from waitress.utilities import cached_http_date
+except ImportError: # older waitress
+    cached_http_date = None
+
+try:
+    from waitress.task import environ_template
+except ImportError: # older waitress
+    environ_template = None
+
+REQUESTS = [
+    ('GET, browser', (
+        b'GET /index.html?q=1 HTTP/1.1\r\n'
+        b'Host: www.example.com\r\n'
+        b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:60.0) '
+        b'Gecko/20100101 Firefox/60.0\r\n'
+        b'Accept: text/html,application/xhtml+xml,application/xml;'
+        b'q=0.9,*/*;q=0.8\r\n'
+        b'Accept-Language: en-US,en;q=0.5\r\n'
+        b'Accept-Encoding: gzip, deflate, br\r\n'
+        b'Cookie: session=6d1e3b0c; theme=dark\r\n'
+        b'Connection: keep-alive\r\n'
+        b'Upgrade-Insecure-Requests: 1\r\n'
+        b'\r\n')),
+    ('POST, API client', (
+        b'POST /api/v1/items HTTP/1.1\r\n'
+        b'Host: api.example.com\r\n'
+        b'User-Agent: python-requests/2.19.1\r\n'
+        b'Accept: */*\r\n'
+        b'Content-Type: application/json\r\n'
+        b'Content-Length: 2\r\n'
+        b'Authorization: Bearer 6d1e3b0c\r\n'
+        b'X-Request-Id: 6d1e3b0c\r\n'
+        b'\r\n{}')),
+]
+
+RESPONSES = [
+    ('keep-alive, Content-Length', '1.1', '', '200 OK', [
+        ('Content-Type', 'text/html; charset=UTF-8'),
+        ('Content-Length', '1234'),
+    ]),
+    ('chunked, lower case names', '1.1', '', '200 OK', [
+        ('content-type', 'application/json'),
+        ('cache-control', 'no-cache'),
+        ('x-request-id', '6d1e3b0c'),
+    ]),
+    ('HTTP/1.0 close, redirect', '1.0', '', '302 Found', [
+        ('Location', 'http://example.com/'),
+        ('Content-Type', 'text/plain'),
+        ('Set-Cookie', 'a=b; Path=/'),
+        ('Content-Length', '0'),
+    ]),
+]
+
+# (module, table name) of the tables emptied for the uncached runs, and
+# (module, name) of the limits on their size set to 0
+TABLES = [
+    (parser, 'header_keys'),
+    (parser, 'environ_keys'),
+    (task, 'header_names'),
+    (task, 'header_lines'),
+    (task, 'status_lines'),
+]
+LIMITS = [
+    (parser, 'header_cache_size'),
+    (task, 'response_cache_size'),
+]
+
+class Server(object):
+    adj = Adjustments()
+    effective_port = 8080
+    server_name = 'localhost'
+
+if environ_template is not None:
+    Server.environ_template = environ_template(Server)
+
+class Channel(object):
+    server = Server()
+    adj = server.adj
+    addr = ('127.0.0.1', 43210)
+
+class Request(object):
+
+    def __init__(self, version, connection):
+        self.version = version
+        self.headers = {'CONNECTION': connection}
+
+def parse(data):
+    request = HTTPRequestParser(Channel.adj)
+    request.received(data)
+    return WSGITask(Channel(), request).get_environment()
+
+def build(version, connection, status, headers):
+    task = WSGITask(Channel(), Request(version, connection))
+    task.status = status
+    task.response_headers = list(headers)
+    task.start_time = time.time()
+    return task.build_response_header()
+
+class uncached(object):
+    """Empties the tables and keeps them from learning while in use."""
+
+    def __enter__(self):
+        self.saved = []
+        for module, name in TABLES:
+            table = getattr(module, name, None)
+            if table is not None:
+                self.saved.append((table, dict(table)))
+                keep = {}
+                if name == 'environ_keys':
+                    # not a cache: CONTENT_LENGTH and CONTENT_TYPE
+                    keep = dict((key, value) for key, value in table.items()
+                                if not value.startswith('HTTP_'))
+                table.clear()
+                table.update(keep)
+        self.limits = []
+        for module, name in LIMITS:
+            if hasattr(module, name):
+                self.limits.append((module, name, getattr(module, name)))
+                setattr(module, name, 0)
+        return self
+
+    def __exit__(self, *exc_info):
+        for table, contents in self.saved:
+            table.clear()
+            table.update(contents)
+        for module, name, value in self.limits:
+            setattr(module, name, value)
+
+def main(argv=sys.argv):
+    opts, args = getopt.getopt(argv[1:], '', ['number='])
+    number = 200000
+    for opt, value in opts:
+        if opt == '--number':
+            number = int(value)
+
+    def time_per_call(func):
+        best = min(timeit.repeat(func, number=number, repeat=3))
+        return best / number * 1e6
+
+    def report(label, func, uncached_func=None):
+        cached_time = time_per_call(func)
+        if uncached_func is None:
+            with uncached():
+                uncached_time = time_per_call(func)
+        else:
+            uncached_time = time_per_call(uncached_func)
+        print('%-40s %9.2f %9.2f usec' % (label, uncached_time, cached_time))
+
+    print('%-40s %9s %9s' % ('', 'uncached', 'cached'))
+    now = time.time()
+    if cached_http_date is not None:
+        report('Date header', lambda: cached_http_date(now),
+               lambda: build_http_date(now))
+    else:
+        report('Date header', lambda: build_http_date(now))
+    for label, data in REQUESTS:
+        report('request: ' + label, lambda: parse(data))
+    for label, version, connection, status, headers in RESPONSES:
+        report('response: ' + label,
+               lambda: build(version, connection, status, headers))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Compare waitress throughput for different ``io_loops`` settings.
+
+Usage::
+
+    python benchmarks/loops.py [--loops=1,2,4] [--clients=8] [--seconds=5]
+
+For every loop count a server is started in a child process and driven by
+``--clients`` client processes, each issuing keep-alive ``GET`` requests for
+``--seconds`` seconds.  The aggregate number of requests per second is
+printed for each configuration.
+
+Only the standard library is required.  Results depend heavily on the
+number of available cores; all loops share one GIL, so the gain comes from
+overlapping socket system calls rather than from parallel Python code.
+"""
+import getopt
+import logging
+import multiprocessing
+import socket
+import sys
+import time
+
+BODY = b'Hello world!\n'
+
+REQUEST = (
+    b'GET / HTTP/1.1\r\n'
+    b'Host: localhost\r\n'
+    b'\r\n'
+)
+
+def app(environ, start_response):
+    start_response('200 OK', [
+        ('Content-Type', 'text/plain'),
+        ('Content-Length', str(len(BODY))),
+    ])
+    return [BODY]
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def serve(port, io_loops):
+    from waitress.server import create_server
+    # queue depth warnings are expected here and only add noise
+    logging.getLogger('waitress').setLevel(logging.ERROR)
+    server = create_server(
+        app,
+        host='127.0.0.1',
+        port=port,
+        io_loops=io_loops,
+        asyncore_use_selectors=True,
+        connection_limit=1000,
+    )
+    server.run()
+
+def wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start on port %d' % port)
+
+def client(port, seconds, results):
+    sock = socket.create_connection(('127.0.0.1', port))
+    fp = sock.makefile('rb')
+    count = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        sock.sendall(REQUEST)
+        length = 0
+        while True:
+            line = fp.readline()
+            if line in (b'\r\n', b''):
+                break
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':', 1)[1])
+        fp.read(length)
+        count += 1
+    sock.close()
+    results.put(count)
+
+def run(io_loops, clients, seconds):
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(port, io_loops))
+    server.daemon = True
+    server.start()
+    try:
+        wait_for(port)
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(
+                target=client, args=(port, seconds, results))
+            for i in range(clients)
+        ]
+        for worker in workers:
+            worker.start()
+        total = sum(results.get() for worker in workers)
+        for worker in workers:
+            worker.join()
+    finally:
+        server.terminate()
+        server.join()
+    return total / float(seconds)
+
+def main(argv=sys.argv):
+    opts, args = getopt.getopt(argv[1:], '', ['loops=', 'clients=', 'seconds='])
+    loops = [1, 2, 4]
+    clients = 8
+    seconds = 5
+    for opt, value in opts:
+        if opt == '--loops':
+            loops = [int(x) for x in value.split(',')]
+        elif opt == '--clients':
+            clients = int(value)
+        elif opt == '--seconds':
+            seconds = float(value)
+    print('cpus=%d clients=%d seconds=%s' % (
+        multiprocessing.cpu_count(), clients, seconds))
+    for io_loops in loops:
+        rate = run(io_loops, clients, seconds)
+        print('io_loops=%d: %.0f requests/sec' % (io_loops, rate))
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,7 @@
 """
 import getopt
 import socket
+import warnings
 
 from waitress.compat import (
     PY2,
@@ -69,6 +70,16 @@ def slash_fixed_str(s):
 def str_iftruthy(s):
     return str(s) if s else None
 
+def as_socket_list(sockets):
+    """Checks if the elements in the list are of type socket and
+    removes them if not."""
+    return [sock for sock in sockets if isinstance(sock, socket.socket)]
+
+def as_object(obj):
+    """Used for adjustments that take Python objects, which can't be given
+    on the command line."""
+    return obj
+
 class _str_marker(str):
     pass
 
@@ -86,14 +97,32 @@ class Adjustments(object):
         ('ipv6', asbool),
         ('listen', aslist),
         ('threads', int),
+        ('min_threads', int),
+        ('max_threads', int),
+        ('thread_idle_timeout', int),
+        ('max_queue_depth', int),
+        ('max_queue_wait', float),
+        ('overload_retry_after', int),
+        ('io_loops', int),
+        ('io_backend', str),
+        ('asgi', asbool),
+        ('pipeline_depth', int),
+        ('metrics_listen', str_iftruthy),
         ('trusted_proxy', str),
         ('url_scheme', str),
         ('url_prefix', slash_fixed_str),
         ('backlog', int),
+        ('accept_batch', int),
+        ('tcp_defer_accept', int),
+        ('tcp_fastopen', int),
         ('recv_bytes', int),
         ('send_bytes', int),
         ('outbuf_overflow', int),
+        ('outbuf_high_watermark', int),
+        ('outbuf_low_watermark', int),
         ('inbuf_overflow', int),
+        ('inbuf_use_memfd', asbool),
+        ('stream_request_body', asbool),
         ('connection_limit', int),
         ('cleanup_interval', int),
         ('channel_timeout', int),
@@ -104,8 +133,11 @@ class Adjustments(object):
         ('ident', str_iftruthy),
         ('asyncore_loop_timeout', int),
         ('asyncore_use_poll', asbool),
+        ('asyncore_use_selectors', asbool),
         ('unix_socket', str),
         ('unix_socket_perms', asoctal),
+        ('sockets', as_socket_list),
+        ('observer', as_object),
     )
 
     _param_map = dict(_params)
@@ -121,6 +153,40 @@ class Adjustments(object):
     # mumber of threads available for tasks
     threads = 4
 
+    # When max_threads is set, the number of task threads is adjusted to the
+    # load between min_threads (threads if unset) and max_threads: a thread
+    # is added while tasks wait in the queue, and one is removed each time a
+    # thread stays idle for thread_idle_timeout seconds.
+    min_threads = None
+    max_threads = None
+    thread_idle_timeout = 60
+
+    # Requests arriving while max_queue_depth tasks are already queued, or
+    # while the oldest queued task has waited more than max_queue_wait
+    # seconds, are answered with a 503 Service Unavailable by the I/O thread
+    # instead of being queued.  The response asks the client to retry after
+    # overload_retry_after seconds.
+    max_queue_depth = None
+    max_queue_wait = None
+    overload_retry_after = 1
+
+    # number of wasyncore I/O loops (each in its own thread) accepting and
+    # serving connections; more than one requires SO_REUSEPORT
+    io_loops = 1
+
+    # the event loop the connections are served from: 'wasyncore', or
+    # 'asyncio' (Python 3 only; see waitress.aio)
+    io_backend = 'wasyncore'
+
+    # the application is an ASGI application, whose coroutines are run on
+    # the event loop of the asyncio backend rather than in task threads
+    asgi = False
+
+    # When greater than one, the pipelined requests of a connection are
+    # serviced by several task threads at once, and up to this many of them
+    # are read ahead; the responses are still sent in order.
+    pipeline_depth = 1
+
     # Host allowed to overrid ``wsgi.url_scheme`` via header
     trusted_proxy = None
 
@@ -143,7 +209,22 @@ class Adjustments(object):
     # reattempt at connection succeeds."
     backlog = 1024
 
-    # recv_bytes is the argument to pass to socket.recv().
+    # the number of connections waiting in the backlog accepted at most each
+    # time the listening socket is found readable (fewer once
+    # connection_limit is reached)
+    accept_batch = 16
+
+    # Set on listening TCP sockets (see waitress.server.LISTEN_OPTIONS):
+    # tcp_defer_accept is the number of seconds during which the kernel
+    # holds on to a new connection until its client sends data, rather than
+    # reporting it to accept() right away (TCP_DEFER_ACCEPT, Linux only);
+    # tcp_fastopen is the length of the queue of TCP Fast Open connections
+    # that may send their request with the SYN (TCP_FASTOPEN).  0 leaves
+    # either unset.
+    tcp_defer_accept = 0
+    tcp_fastopen = 0
+
+    # recv_bytes is the size of the buffer passed to socket.recv_into().
     recv_bytes = 8192
 
     # send_bytes is the number of bytes to send to socket.send().  Multiples
@@ -157,11 +238,31 @@ class Adjustments(object):
     # is conservative.
     outbuf_overflow = 1048576
 
+    # A task writing a response blocks while more than outbuf_high_watermark
+    # bytes of output are waiting to be sent on its connection, until they
+    # drop to outbuf_low_watermark; this bounds the memory and disk used
+    # when an application writes faster than the client reads.  Files sent
+    # with wsgi.file_wrapper are not counted.  The defaults are 16MB and 8MB.
+    outbuf_high_watermark = 16777216
+    outbuf_low_watermark = 8388608
+
     # A tempfile should be created if the pending input is larger than
     # inbuf_overflow, which is measured in bytes. The default is 512K.  This
     # is conservative.
     inbuf_overflow = 524288
 
+    # Boolean: keep the request bodies larger than inbuf_overflow in a file
+    # created with os.memfd_create, which is never written to disk (unless
+    # swapped out), rather than in a temporary file.  Ignored where
+    # os.memfd_create is not available.
+    inbuf_use_memfd = False
+
+    # Start the task of a request with a body as soon as its headers have
+    # been received, and hand the body to wsgi.input as it arrives.  At most
+    # about inbuf_overflow bytes of it are held in memory: the socket is not
+    # read from while the application has not read them.
+    stream_request_body = False
+
     # Stop creating new channels if too many are already active (integer).
     # Each channel consumes at least one file descriptor, and, depending on
     # the input and output body sizes, potentially up to three.  The default
@@ -173,7 +274,8 @@ class Adjustments(object):
     # that.
     connection_limit = 100
 
-    # Minimum seconds between cleaning up inactive channels.
+    # Minimum seconds between cleaning up inactive channels.  Unused:
+    # channel timeouts are tracked per channel (see server.maintenance).
     cleanup_interval = 30
 
     # Maximum seconds to leave an inactive connection open.
@@ -197,6 +299,19 @@ class Adjustments(object):
     # Path to a Unix domain socket to use.
     unix_socket_perms = 0o600
 
+    # Already bound and listening sockets to serve on instead of binding
+    # the ones described by listen or unix_socket (e.g. sockets inherited
+    # from a pre-fork master process).
+    sockets = []
+
+    # host:port on which to serve Prometheus metrics (see waitress.metrics),
+    # resolved like the elements of listen; not served while None.
+    metrics_listen = None
+
+    # A waitress.observer.RequestObserver told about the stages each request
+    # goes through, with their timestamps.
+    observer = None
+
     # The socket options to set on receiving a connection.  It is a list of
     # (level, optname, value) tuples.  TCP_NODELAY disables the Nagle
     # algorithm for writes (Waitress already buffers its writes).
@@ -210,6 +325,12 @@ class Adjustments(object):
     # The asyncore.loop flag to use poll() instead of the default select().
     asyncore_use_poll = False
 
+    # Keep sockets registered with a ``selectors`` selector (epoll on Linux,
+    # kqueue on BSDs) across asyncore.loop iterations instead of rebuilding
+    # the select()/poll() sets every time.  Takes precedence over
+    # asyncore_use_poll; ignored where the selectors module is unavailable.
+    asyncore_use_selectors = False
+
     # Enable IPv4 by default
     ipv4 = True
 
@@ -221,6 +342,20 @@ class Adjustments(object):
         if 'listen' in kw and ('host' in kw or 'port' in kw):
             raise ValueError('host and or port may not be set if listen is set.')
 
+        if 'sockets' in kw and (
+                'host' in kw or 'port' in kw or 'listen' in kw or
+                'unix_socket' in kw):
+            raise ValueError(
+                'host, port, listen and unix_socket may not be set if '
+                'sockets is set.')
+
+        if 'cleanup_interval' in kw:
+            warnings.warn(
+                'cleanup_interval is deprecated and has no effect: inactive '
+                'channels are closed as soon as channel_timeout elapses.',
+                DeprecationWarning
+            )
+
         for k, v in kw.items():
             if k not in self._param_map:
                 raise ValueError('Unknown adjustment %r' % k)
@@ -230,6 +365,67 @@ class Adjustments(object):
            not isinstance(self.port, _int_marker)):
             self.listen = ['{}:{}'.format(self.host, self.port)]
 
+        if self.max_threads is not None:
+            if self.min_threads is None:
+                self.min_threads = self.threads
+            if not 1 <= self.min_threads <= self.max_threads:
+                raise ValueError(
+                    'min_threads (or threads) must be at least 1 and no '
+                    'greater than max_threads.')
+            if self.thread_idle_timeout < 1:
+                raise ValueError('thread_idle_timeout must be at least 1.')
+        elif self.min_threads is not None:
+            raise ValueError('min_threads may only be set with max_threads.')
+
+        if self.io_loops > 1:
+            if self.unix_socket:
+                raise ValueError(
+                    'io_loops may not be greater than 1 if unix_socket is set.')
+            if self.sockets:
+                raise ValueError(
+                    'io_loops may not be greater than 1 if sockets is set.')
+            if not hasattr(socket, 'SO_REUSEPORT'): # pragma: no cover
+                raise ValueError(
+                    'io_loops greater than 1 requires SO_REUSEPORT, which is '
+                    'not supported on this platform.')
+
+        if self.metrics_listen and self.sockets:
+            raise ValueError(
+                'metrics_listen may not be set if sockets is set.')
+
+        if self.accept_batch < 1:
+            raise ValueError('accept_batch must be at least 1.')
+        if self.max_queue_depth is not None and self.max_queue_depth < 1:
+            raise ValueError('max_queue_depth must be at least 1.')
+        if self.tcp_defer_accept < 0 or self.tcp_fastopen < 0:
+            raise ValueError(
+                'tcp_defer_accept and tcp_fastopen may not be negative.')
+
+        if self.io_backend not in ('wasyncore', 'asyncio'):
+            raise ValueError(
+                'io_backend must be wasyncore or asyncio, not %r.' %
+                self.io_backend)
+        if self.io_backend == 'asyncio':
+            if PY2:
+                raise ValueError('io_backend asyncio requires Python 3.')
+            if self.io_loops > 1:
+                raise ValueError(
+                    'io_loops may not be greater than 1 if io_backend is '
+                    'asyncio.')
+            if self.metrics_listen:
+                raise ValueError(
+                    'metrics_listen may not be set if io_backend is asyncio.')
+        if self.asgi:
+            if self.io_backend != 'asyncio':
+                raise ValueError('asgi requires io_backend asyncio.')
+            if self.pipeline_depth > 1:
+                raise ValueError(
+                    'pipeline_depth may not be greater than 1 if asgi is '
+                    'set.')
+            if self.stream_request_body:
+                raise ValueError(
+                    'stream_request_body may not be set if asgi is set.')
+
         enabled_families = socket.AF_UNSPEC
 
         if not self.ipv4 and not HAS_IPV6: # pragma: no cover
@@ -243,9 +439,17 @@ class Adjustments(object):
         if not self.ipv4 and self.ipv6 and HAS_IPV6:
             enabled_families = socket.AF_INET6
 
+        self.listen = self._resolve(self.listen, enabled_families)
+        if self.metrics_listen:
+            self.metrics_listen = self._resolve(
+                [self.metrics_listen], enabled_families)
+
+    def _resolve(self, listen, enabled_families):
+        """Turns host:port strings into the (family, socktype, proto,
+        sockaddr) tuples of the sockets to bind."""
         wanted_sockets = []
         hp_pairs = []
-        for i in self.listen:
+        for i in listen:
             if ':' in i:
                 (host, port) = i.rsplit(":", 1)
 
@@ -299,7 +503,7 @@ class Adjustments(object):
             except:
                 raise ValueError('Invalid host/port specified.')
 
-        self.listen = wanted_sockets
+        return wanted_sockets
 
     @classmethod
     def parse_args(cls, argv):
@@ -308,8 +512,11 @@ class Adjustments(object):
         dictionary suitable for passing into __init__, where __init__ does the
         casting.
         """
-        long_opts = ['help', 'call']
+        long_opts = ['help', 'call', 'workers=']
         for opt, cast in cls._params:
+            if cast in (as_socket_list, as_object):
+                # objects can't be given on the command line
+                continue
             opt = opt.replace('_', '-')
             if cast is asbool:
                 long_opts.append(opt)
@@ -335,6 +542,8 @@ class Adjustments(object):
                 kw[param] = 'false'
             elif param in ('help', 'call'):
                 kw[param] = True
+            elif param == 'workers':
+                kw[param] = value
             elif cls._param_map[param] is asbool:
                 kw[param] = 'true'
             else:
@@ -0,0 +1,745 @@
+##############################################################################
+#
+# Copyright (c) 2001, 2002 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Serving on an asyncio event loop instead of the wasyncore loop.
+
+Selected with the ``io_backend='asyncio'`` adjustment (Python 3 only).  The
+channels parse requests and queue responses exactly like those of the
+wasyncore servers, and the tasks still run in the ThreadedTaskDispatcher;
+only the socket I/O and the wakeups (``loop.call_soon_threadsafe`` in place
+of the trigger) go through the event loop, which may be shared with other
+asyncio code, or be uvloop's if its event loop policy is installed.
+
+With the ``asgi`` adjustment, the application is an ASGI application instead;
+each request is served by a coroutine on the event loop (see ASGITask), so
+requests waiting on something else hold no thread.
+"""
+
+import asyncio
+import errno
+import os
+import os.path
+import socket
+
+from http import HTTPStatus
+
+from waitress.channel import (
+    ClientDisconnected,
+    HTTPChannel,
+)
+from waitress.compat import (
+    monotonic,
+    tobytes,
+)
+from waitress.server import (
+    BaseWSGIServer,
+    MultiSocketServer,
+    create_dispatcher,
+    print_listen_options,
+    set_listen_socket_options,
+)
+from waitress.task import (
+    Task,
+    environ_template,
+    hop_by_hop,
+)
+from waitress.utilities import (
+    cleanup_unix_socket,
+    logger,
+)
+
+# accept() errors after which the listening socket is simply polled again
+ACCEPT_RETRY = frozenset((errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR,
+                          errno.ECONNABORTED))
+
+
+class AsyncioChannel(HTTPChannel):
+    """
+    An HTTPChannel whose input and output go through an asyncio transport.
+    ChannelProtocol hands it the input as it arrives, and ``poll`` does for
+    it what an iteration of the wasyncore loop does for a channel that is
+    readable or writable.
+    """
+
+    read_paused = False   # pause_reading() was called on the transport
+    write_paused = False  # the transport's write buffer is full
+
+    def __init__(self, server, transport, addr, adj, map):
+        HTTPChannel.__init__(self, server, None, addr, adj, map=map)
+        self.transport = transport
+        self.loop = server.loop
+        # closed by wasyncore.dispatcher.close, see handle_close
+        self.socket = transport
+        self.connected = True
+        self._fileno = transport.get_extra_info('socket').fileno()
+        self.add_channel(map)
+
+    def data_received(self, data):
+        self.last_activity = monotonic()
+        if self.server.metrics is not None: # pragma: no cover
+            self.server.metrics.bytes_received.inc(len(data))
+        # Before any task may be started, so that its output cannot be
+        # missed; see AsyncioWSGIServer.pull_trigger.
+        self.server.busy_channels.add(self)
+        request = self.request
+        if self.readable() or (request is not None and request.streaming):
+            self.received(data)
+        else:
+            # arrived before pause_reading(); parsed by handle_write once
+            # the running task is done, like input following a streamed
+            # request
+            self.pending += data
+        self.poll()
+
+    def poll(self):
+        """
+        Flushes output, or closes the channel, as ``writable()`` asks, and
+        pauses or resumes reading from the transport as ``readable()`` does.
+        """
+        if self.connected and self.writable():
+            self.handle_write()
+        if self.connected:
+            readable = self.reading()
+            if readable == self.read_paused:
+                self.read_paused = not readable
+                if readable:
+                    self.transport.resume_reading()
+                else:
+                    self.transport.pause_reading()
+
+    def reading(self):
+        """ Whether to read from the transport, see poll """
+        return self.readable()
+
+    def send(self, data):
+        # The transport takes it all, sending what it can at once and
+        # buffering the rest, until it asks us to pause.
+        if self.write_paused:
+            return 0
+        self.transport.write(data)
+        return len(data)
+
+    def sendmsg(self, segments):
+        if self.write_paused:
+            return 0
+        self.transport.writelines(segments)
+        return sum([len(segment) for segment in segments])
+
+    def _sendfile_some(self, outbuf, count):
+        # the transport writes everything itself; read the file instead
+        outbuf.sendfile_fd = None
+        return None
+
+    def _flush_some_if_lockable(self):
+        if self.outbuf_lock.acquire(False):
+            try:
+                self._flush_some()
+            finally:
+                self.outbuf_lock.release()
+        else:
+            # A task is appending to the outbuf; try again on the next
+            # iteration, as the wasyncore loop would.
+            self.loop.call_soon(self.poll)
+
+    def pull_trigger(self):
+        # from a task thread: have the loop poll this channel, even if
+        # triggered() let go of it meanwhile
+        self.server.busy_channels.add(self)
+        HTTPChannel.pull_trigger(self)
+
+    def del_channel(self, map=None):
+        HTTPChannel.del_channel(self, map)
+        self.server.busy_channels.discard(self)
+        for server in self.server.servers:
+            server.update_accepting()
+
+
+class ChannelProtocol(asyncio.Protocol):
+    """ Connects the transport of an accepted connection to its channel """
+
+    channel = None
+
+    def __init__(self, server, addr):
+        self.server = server
+        self.addr = addr
+
+    def connection_made(self, transport):
+        server = self.server
+        server.starting -= 1
+        self.channel = server.channel_class(
+            server, transport, self.addr, server.adj, server.map)
+
+    def data_received(self, data):
+        self.channel.data_received(data)
+
+    def pause_writing(self):
+        self.channel.write_paused = True
+
+    def resume_writing(self):
+        channel = self.channel
+        channel.write_paused = False
+        channel.poll()
+
+    def connection_lost(self, exc):
+        channel = self.channel
+        if channel is not None and channel.connected:
+            channel.handle_close()
+
+
+class ASGITask(Task):
+    """An ASGI task produces a response from an ASGI application, running
+    its coroutine on the event loop of the channel.
+    """
+    scope = None
+    body_view = None          # the part of the body not yet received
+    request_complete = False  # the whole body has been received
+    response_complete = False # the last http.response.body has been sent
+
+    async def serve(self):
+        self.start()
+        await self.channel.server.application(
+            self.get_scope(), self.receive, self.send)
+        if not self.complete:
+            if not self.channel.connected:
+                # gave up on the request once told of the disconnect
+                raise ClientDisconnected()
+            raise RuntimeError('http.response.start was not sent')
+        cl = self.content_length
+        if cl is not None and self.content_bytes_written != cl:
+            # as in WSGITask.execute
+            self.close_on_finish = True
+            if self.request.command != 'HEAD':
+                self.logger.warning(
+                    'application sent too few bytes (%s) for specified '
+                    'Content-Length (%s)' % (self.content_bytes_written, cl))
+        self.finish()
+
+    async def receive(self):
+        if self.response_complete or self.request_complete:
+            # nothing is left but the client going away
+            if not self.response_complete:
+                await self.channel.wait_closed()
+            return {'type': 'http.disconnect'}
+        view = self.body_view
+        if view is None:
+            view = self.request.get_body_view()
+        # in chunks no larger than the part of a body kept in memory
+        size = self.channel.adj.inbuf_overflow
+        body = bytes(view[:size])
+        view = view[size:]
+        if view:
+            self.body_view = view
+        else:
+            self.body_view = None
+            self.request_complete = True
+        return {
+            'type': 'http.request',
+            'body': body,
+            'more_body': not self.request_complete,
+        }
+
+    async def send(self, message):
+        channel = self.channel
+        if not channel.connected:
+            raise ClientDisconnected()
+        kind = message['type']
+        if kind == 'http.response.start':
+            if self.complete:
+                raise AssertionError('http.response.start sent twice')
+            self.start_response(
+                message['status'], message.get('headers', ()))
+        elif kind == 'http.response.body':
+            if not self.complete:
+                raise AssertionError(
+                    'http.response.body sent before http.response.start')
+            if self.response_complete:
+                raise AssertionError(
+                    'http.response.body sent after the last one')
+            body = message.get('body', b'')
+            if body:
+                self.write(body)
+            if not message.get('more_body', False):
+                self.response_complete = True
+            if (channel.bytes_written - channel.bytes_sent >
+                    channel.adj.outbuf_high_watermark):
+                await channel.drain()
+        else:
+            raise ValueError('unsupported ASGI message type %r' % kind)
+
+    def start_response(self, status, headers):
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ''
+        self.status = ('%d %s' % (status, reason)).rstrip()
+        self.complete = True
+        response_headers = self.response_headers
+        for k, v in headers:
+            k = k.decode('latin-1')
+            v = v.decode('latin-1')
+            if '\n' in v or '\r' in v:
+                raise ValueError("carriage return/line "
+                                 "feed character present in header value")
+            if '\n' in k or '\r' in k:
+                raise ValueError("carriage return/line "
+                                 "feed character present in header name")
+            kl = k.lower()
+            if kl == 'content-length':
+                self.content_length = int(v)
+            elif kl in hop_by_hop:
+                raise AssertionError(
+                    '%s is a "hop-by-hop" header; it cannot be used by '
+                    'an ASGI application' % k)
+            response_headers.append((k, v))
+
+    def get_scope(self):
+        """Returns the ASGI connection scope of the request."""
+        scope = self.scope
+        if scope is not None:
+            return scope
+
+        request = self.request
+        channel = self.channel
+        server = channel.server
+
+        path = request.path
+        if path.startswith('/'):
+            path = '/' + path.lstrip('/')
+
+        headers = request.headers
+        scheme = request.url_scheme
+        host, port = channel.addr[:2]
+        if host == server.adj.trusted_proxy:
+            headers = dict(headers)
+            scheme = headers.pop('X_FORWARDED_PROTO', scheme)
+        if scheme not in ('http', 'https'):
+            raise ValueError('Invalid X_FORWARDED_PROTO value')
+
+        if port is None:
+            # a unix socket
+            client = None
+            server_addr = (server.effective_port, None)
+        else:
+            client = (host, port)
+            server_addr = (server.effective_host, int(server.effective_port))
+
+        scope = self.scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0', 'spec_version': '2.3'},
+            'http_version': self.version,
+            'method': request.command.upper(),
+            'scheme': scheme,
+            # PEP 3333 strings hold the bytes of the path as latin-1
+            'path': path.encode('latin-1').decode('utf-8', 'replace'),
+            'query_string': tobytes(request.query),
+            'root_path': server.adj.url_prefix,
+            # the parser keeps header names upper-cased, with dashes turned
+            # into underscores (and drops those with underscores of their
+            # own)
+            'headers': [
+                (tobytes(key.lower().replace('_', '-')), tobytes(value))
+                for key, value in headers.items()
+            ],
+            'client': client,
+            'server': server_addr,
+        }
+        return scope
+
+
+class ASGIChannel(AsyncioChannel):
+    """
+    An AsyncioChannel whose requests are served by ASGITasks: ``serve`` is
+    started on the event loop where the other channels hand their requests
+    to the task dispatcher.
+    """
+
+    task_class = ASGITask
+
+    drain_waiter = None   # future of the task waiting in drain()
+    closed_waiter = None  # future of the task waiting in wait_closed()
+
+    async def serve(self):
+        """ Serves all pending requests, like ``service`` """
+        while self.requests:
+            request = self.requests[0]
+            task = await self.serve_request(request)
+            if task.close_on_finish:
+                self.close_when_flushed = True
+                for request in self.requests:
+                    request.close()
+                self.requests = []
+            else:
+                self.requests.pop(0)
+                request.close()
+        self.force_flush = True
+        self.last_activity = monotonic()
+        self.poll()
+
+    async def serve_request(self, request):
+        """
+        Runs the task of ``request``, like ``service_request``, and returns
+        it.
+        """
+        if request.error:
+            task = self.error_task_class(self, request)
+            task.service()
+            return task
+        task = self.task_class(self, request)
+        try:
+            await task.serve()
+        except ClientDisconnected:
+            self.logger.info('Client disconnected while serving %s' %
+                             task.request.path)
+            task.close_on_finish = True
+        except Exception:
+            task = self.service_error(request, task, self)
+        return task
+
+    def reading(self):
+        # While a request is served, keep reading (up to recv_bytes of the
+        # requests pipelined after it, kept in pending), so that the task
+        # learns from receive() when the client goes away.
+        if self.readable():
+            return True
+        return not (self.will_close or self.close_when_flushed or
+                    len(self.pending) >= self.adj.recv_bytes)
+
+    def wake_for_output(self):
+        # called on the loop, by the task that wrote
+        if self.bytes_written != self.bytes_sent:
+            self.force_flush = True
+            self.loop.call_soon(self.poll)
+
+    def _wait_for_drain(self, owner):
+        # The loop must not block; ASGITask.send waits in drain() instead,
+        # once it has written.
+        if not self.connected:
+            raise ClientDisconnected()
+
+    async def drain(self):
+        """
+        Waits until no more than outbuf_low_watermark bytes of output are
+        buffered, as write_soon does in a task thread.
+        """
+        low = min(self.adj.outbuf_low_watermark,
+                  self.adj.outbuf_high_watermark)
+        while self.connected and self.buffered() > low:
+            self.drain_waiter = self.loop.create_future()
+            self.force_flush = True
+            self.loop.call_soon(self.poll)
+            await self.drain_waiter
+        if not self.connected:
+            raise ClientDisconnected()
+
+    async def wait_closed(self):
+        if self.connected:
+            if self.closed_waiter is None:
+                self.closed_waiter = self.loop.create_future()
+            await self.closed_waiter
+
+    def poll(self):
+        AsyncioChannel.poll(self)
+        self.wake(self.drain_waiter)
+        self.drain_waiter = None
+
+    def handle_close(self):
+        AsyncioChannel.handle_close(self)
+        self.wake(self.drain_waiter)
+        self.drain_waiter = None
+        self.wake(self.closed_waiter)
+
+    def wake(self, waiter):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+
+class AsyncioWSGIServer(object):
+    """
+    Serves ``application`` on one listening socket, from the asyncio event
+    loop given to ``attach``, or from one of its own created by ``run``.
+    The servers created for several listening sockets share ``map`` (their
+    channels, which ``connection_limit`` applies to) and ``servers``.
+    """
+
+    channel_class = AsyncioChannel
+    asyncio = asyncio # test shim
+    socketmod = socket # test shim
+    logger = logger
+    metrics = None
+
+    # The idle channels are expired through the same timer wheel as those
+    # of the wasyncore servers; see BaseWSGIServer.maintenance.
+    schedule_expiry = BaseWSGIServer.schedule_expiry
+    cancel_expiry = BaseWSGIServer.cancel_expiry
+    maintenance = BaseWSGIServer.maintenance
+    get_server_name = BaseWSGIServer.get_server_name
+
+    loop = None
+    accepting = False    # the listening socket is registered with the loop
+    pulled = False       # see pull_trigger
+    tick_handle = None   # the maintenance timer
+
+    def __init__(self,
+                 application,
+                 sock,
+                 adj,
+                 dispatcher=None,
+                 map=None,
+                 servers=None,
+                 ):
+        self.application = application
+        self.socket = sock
+        self.adj = adj
+        if dispatcher is None:
+            dispatcher = create_dispatcher(adj)
+        self.task_dispatcher = dispatcher
+        if map is None:
+            map = {}
+        self.map = map
+        if servers is None:
+            servers = []
+        servers.append(self)
+        self.servers = servers
+        if sock.family == getattr(socket, 'AF_UNIX', None):
+            self.effective_host = 'unix'
+            self.effective_port = sock.getsockname()
+            self.server_name = 'localhost'
+        else:
+            self.effective_host, self.effective_port = (
+                self.socketmod.getnameinfo(
+                    sock.getsockname(),
+                    self.socketmod.NI_NUMERICHOST |
+                    self.socketmod.NI_NUMERICSERV))
+            self.server_name = self.get_server_name(self.effective_host)
+        self.environ_template = environ_template(self)
+        self.active_channels = {}
+        # channels with tasks queued or running, polled by pull_trigger
+        self.busy_channels = set()
+        self.starting = 0 # accepted connections without a channel yet
+        self.expiry_slots = {}
+        self.expiry_cursor = int(monotonic())
+
+    def attach(self, loop):
+        """ Starts serving from ``loop``, which must support add_reader """
+        self.loop = loop
+        self.socket.setblocking(False)
+        self.update_accepting()
+        self.tick_handle = loop.call_later(1, self.tick)
+
+    def update_accepting(self):
+        if self.loop is None or self.socket is None:
+            return
+        accepting = (
+            len(self.map) + self.starting < self.adj.connection_limit)
+        if accepting != self.accepting:
+            self.accepting = accepting
+            if accepting:
+                self.loop.add_reader(self.socket, self.handle_accept)
+            else:
+                self.loop.remove_reader(self.socket)
+
+    def handle_accept(self):
+        # Drains up to accept_batch connections, like
+        # BaseWSGIServer.handle_accept; update_accepting stops it at
+        # connection_limit.
+        for i in range(self.adj.accept_batch):
+            if not self.accepting:
+                return
+            try:
+                conn, addr = self.socket.accept()
+            except socket.error as why:
+                if (why.args[0] not in ACCEPT_RETRY and
+                        self.adj.log_socket_errors):
+                    self.logger.warning('server accept() threw an exception',
+                                        exc_info=True)
+                return
+            conn.setblocking(False)
+            self.set_socket_options(conn)
+            self.connect(conn, self.fix_addr(addr))
+
+    def connect(self, conn, addr):
+        self.starting += 1
+        self.update_accepting()
+        loop = self.loop
+        future = loop.create_task(loop.connect_accepted_socket(
+            lambda: ChannelProtocol(self, addr), conn))
+        future.add_done_callback(lambda future: self.accepted(future, conn))
+
+    def accepted(self, future, conn):
+        if future.cancelled() or future.exception() is not None:
+            conn.close()
+            self.starting -= 1
+            self.update_accepting()
+
+    def set_socket_options(self, conn):
+        if conn.family != getattr(socket, 'AF_UNIX', None):
+            for (level, optname, value) in self.adj.socket_options:
+                conn.setsockopt(level, optname, value)
+
+    def fix_addr(self, addr):
+        if self.socket.family == getattr(socket, 'AF_UNIX', None):
+            return ('localhost', None)
+        return addr
+
+    def add_task(self, task):
+        self.task_dispatcher.add_task(task)
+
+    def pull_trigger(self):
+        # Called by task threads, many times a request; the loop is woken
+        # once until it has run triggered().
+        if not self.pulled:
+            self.pulled = True
+            self.loop.call_soon_threadsafe(self.triggered)
+
+    def triggered(self):
+        # Polls the channels that received input since they were last found
+        # without tasks; only they have tasks that may have pulled.
+        self.pulled = False
+        busy = self.busy_channels
+        for channel in list(busy):
+            channel.poll()
+            # A task may have finished since poll() looked, leaving output
+            # or pending input for the next poll.
+            if not (channel.requests or channel.writable()):
+                busy.discard(channel)
+
+    def tick(self):
+        now = monotonic()
+        if now >= self.expiry_cursor or now < self.expiry_cursor - 1:
+            self.maintenance(now)
+        self.tick_handle = self.loop.call_later(1, self.tick)
+
+    def expire(self, channel):
+        channel.will_close = True
+        channel.poll()
+
+    def print_listen(self, format_str): # pragma: nocover
+        print(format_str.format(self.effective_host, self.effective_port))
+        print_listen_options([self.socket])
+
+    def run(self):
+        loop = self.asyncio.new_event_loop()
+        for server in self.servers:
+            server.attach(loop)
+        try:
+            loop.run_forever()
+        except (SystemExit, KeyboardInterrupt):
+            for server in self.servers:
+                server.close()
+        finally:
+            loop.close()
+
+    def close(self):
+        self.task_dispatcher.shutdown()
+        if self.tick_handle is not None:
+            self.tick_handle.cancel()
+            self.tick_handle = None
+        if self.accepting:
+            self.accepting = False
+            self.loop.remove_reader(self.socket)
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        for channel in list(self.active_channels.values()):
+            channel.handle_close()
+
+
+class ASGIServer(AsyncioWSGIServer):
+    """
+    Serves an ASGI ``application`` like AsyncioWSGIServer serves a WSGI one.
+    """
+
+    channel_class = ASGIChannel
+
+    def add_task(self, channel):
+        self.loop.create_task(channel.serve())
+
+
+class AsyncioMultiSocketServer(MultiSocketServer):
+    """ Runs the AsyncioWSGIServers of several listening sockets """
+
+    def __init__(self, servers, adj, effective_listen, dispatcher):
+        MultiSocketServer.__init__(
+            self, servers[0].map, adj, effective_listen, dispatcher)
+        self.servers = servers
+
+    def listen_sockets(self):
+        return [server.socket for server in self.servers]
+
+    def run(self):
+        self.servers[0].run()
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+
+
+def bind_socket(sockinfo, adj):
+    family, socktype, proto, sockaddr = sockinfo
+    sock = socket.socket(family, socktype)
+    try:
+        if family == getattr(socket, 'AF_UNIX', None):
+            cleanup_unix_socket(sockaddr)
+            sock.bind(sockaddr)
+            if os.path.exists(sockaddr):
+                os.chmod(sockaddr, adj.unix_socket_perms)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if family == socket.AF_INET6: # pragma: nocover
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.bind(sockaddr)
+            set_listen_socket_options(sock, adj)
+        sock.listen(adj.backlog)
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+def create_asyncio_server(application, adj, dispatcher=None):
+    """
+    Called by ``create_server`` for ``io_backend='asyncio'``: returns an
+    AsyncioWSGIServer (an ASGIServer if ``adj.asgi`` is set), or an
+    AsyncioMultiSocketServer when there are several sockets to listen on.
+    """
+    if adj.sockets:
+        # already listening, e.g. in a waitress.prefork worker
+        socks = list(adj.sockets)
+    elif adj.unix_socket and hasattr(socket, 'AF_UNIX'):
+        socks = [bind_socket(
+            (socket.AF_UNIX, socket.SOCK_STREAM, None, adj.unix_socket), adj)]
+    else:
+        socks = []
+        try:
+            for sockinfo in adj.listen:
+                socks.append(bind_socket(sockinfo, adj))
+        except:
+            # those already bound would be left listening
+            for sock in socks:
+                sock.close()
+            raise
+    if dispatcher is None:
+        dispatcher = create_dispatcher(adj)
+    if adj.asgi:
+        server_class = ASGIServer
+    else:
+        server_class = AsyncioWSGIServer
+    map = {}
+    servers = []
+    for sock in socks:
+        server_class(application, sock, adj, dispatcher, map, servers)
+    if len(servers) == 1:
+        return servers[0]
+    effective_listen = [
+        (server.effective_host, server.effective_port) for server in servers]
+    return AsyncioMultiSocketServer(servers, adj, effective_listen, dispatcher)
@@ -13,7 +13,20 @@
 ##############################################################################
 """Buffers
 """
+import mmap
+import os
+import stat
+import threading
+
+from collections import deque
 from io import BytesIO
+from tempfile import TemporaryFile
+
+from waitress.compat import (
+    PY3,
+    monotonic,
+    )
+from waitress.metrics import overflowed_buffers
 
 # copy_bytes controls the size of temp. strings for shuffling data around.
 COPY_BYTES = 1 << 18 # 256K
@@ -21,6 +34,18 @@ COPY_BYTES = 1 << 18 # 256K
 # The maximum number of bytes to buffer in a simple string.
 STRBUF_LIMIT = 8192
 
+# Appends to a SegmentBuffer smaller than this are merged with a small last
+# segment rather than queued on their own, to bound the number of segments.
+COALESCE_BYTES = 1024
+
+if PY3: # pragma: no cover
+    segment_view = memoryview
+else:
+    # b''.join() doesn't take a memoryview on Python 2; slice (copy) the
+    # segments themselves
+    def segment_view(segment):
+        return segment
+
 class FileBasedBuffer(object):
 
     remain = 0
@@ -30,12 +55,16 @@ class FileBasedBuffer(object):
         if from_buffer is not None:
             from_file = from_buffer.getfile()
             read_pos = from_file.tell()
-            from_file.seek(0)
-            while True:
-                data = from_file.read(COPY_BYTES)
-                if not data:
-                    break
-                file.write(data)
+            if hasattr(from_file, 'getvalue'):
+                # a BytesIO; write its contents in one go
+                file.write(from_file.getvalue())
+            else:
+                from_file.seek(0)
+                while True:
+                    data = from_file.read(COPY_BYTES)
+                    if not data:
+                        break
+                    file.write(data)
             self.remain = int(file.tell() - read_pos)
             from_file.seek(read_pos)
             file.seek(read_pos)
@@ -71,6 +100,11 @@ class FileBasedBuffer(object):
             file.seek(read_pos)
         return res
 
+    def get_segments(self, numbytes):
+        """Return a list of bytes-like objects holding up to ``numbytes`` of
+        the data at the front of the buffer, without consuming it."""
+        return [self.get(numbytes)]
+
     def skip(self, numbytes, allow_prune=0):
         if self.remain < numbytes:
             raise ValueError("Can't skip %d bytes in buffer of %d bytes" % (
@@ -103,6 +137,30 @@ class FileBasedBuffer(object):
     def getfile(self):
         return self.file
 
+    def getview(self):
+        """Returns a memoryview of the file from its current position to its
+        end, mapping the file into memory rather than reading it where
+        possible."""
+        file = self.file
+        read_pos = file.tell()
+        if hasattr(file, 'getvalue'):
+            # a BytesIO, which shares its contents with getvalue()
+            return memoryview(file.getvalue())[read_pos:]
+        file.flush()
+        file.seek(0, 2)
+        size = file.tell()
+        file.seek(read_pos)
+        if size <= read_pos:
+            return memoryview(b'')
+        if not PY3: # pragma: no cover
+            # memoryview can't wrap an mmap on Python 2; the view must not
+            # consume what it shows, as the mapping doesn't
+            view = memoryview(file.read())
+            file.seek(read_pos)
+            return view
+        m = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+        return memoryview(m)[read_pos:]
+
     def close(self):
         if hasattr(self.file, 'close'):
             self.file.close()
@@ -114,9 +172,21 @@ class TempfileBasedBuffer(FileBasedBuffer):
         FileBasedBuffer.__init__(self, self.newfile(), from_buffer)
 
     def newfile(self):
-        from tempfile import TemporaryFile
         return TemporaryFile('w+b')
 
+class MemfdBasedBuffer(TempfileBasedBuffer):
+    """
+    A TempfileBasedBuffer whose file lives in memory rather than on disk,
+    where os.memfd_create is available (Linux, Python 3.8 and later).  Like
+    any other file, its pages can be swapped out under memory pressure.
+    """
+
+    def newfile(self):
+        memfd_create = getattr(os, 'memfd_create', None)
+        if memfd_create is None: # pragma: no cover
+            return TemporaryFile('w+b')
+        return os.fdopen(memfd_create('waitress-buffer'), 'w+b')
+
 class BytesIOBasedBuffer(FileBasedBuffer):
 
     def __init__(self, from_buffer=None):
@@ -132,6 +202,10 @@ class BytesIOBasedBuffer(FileBasedBuffer):
 class ReadOnlyFileBasedBuffer(FileBasedBuffer):
     # used as wsgi.file_wrapper
 
+    # file descriptor the channel may hand to os.sendfile, starting at
+    # file.tell(); None if the file isn't a regular file with a fileno
+    sendfile_fd = None
+
     def __init__(self, file, block_size=32768):
         self.file = file
         self.block_size = block_size # for __iter__
@@ -147,8 +221,22 @@ class ReadOnlyFileBasedBuffer(FileBasedBuffer):
                 self.remain = fsize
             else:
                 self.remain = min(fsize, size)
+            self.sendfile_fd = self._get_sendfile_fd()
         return self.remain
 
+    def _get_sendfile_fd(self):
+        if not hasattr(os, 'sendfile'): # pragma: no cover
+            return None
+        try:
+            fd = self.file.fileno()
+            if not stat.S_ISREG(os.fstat(fd).st_mode):
+                return None
+        except Exception:
+            # no fileno (e.g. BytesIO raises UnsupportedOperation) or a
+            # bogus one
+            return None
+        return fd
+
     def get(self, numbytes=-1, skip=False):
         # never read more than self.remain (it can be user-specified)
         if numbytes == -1 or numbytes > self.remain:
@@ -256,6 +344,13 @@ class OverflowableBuffer(object):
             buf = self._create_buffer()
         return buf.get(numbytes, skip)
 
+    def get_segments(self, numbytes):
+        buf = self.buf
+        if buf is None:
+            # like get(), hand out the whole strbuf (it is small)
+            return [self.strbuf]
+        return buf.get_segments(numbytes)
+
     def skip(self, numbytes, allow_prune=False):
         buf = self.buf
         if buf is None:
@@ -296,3 +391,359 @@ class OverflowableBuffer(object):
         buf = self.buf
         if buf is not None:
             buf.close()
+
+class SegmentBuffer(object):
+    """
+    A drop-in replacement for OverflowableBuffer with three stages:
+    - A deque of bytes segments
+    - BytesIO-based buffer (only once getfile() has been asked for)
+    - Temporary file storage (a ``spool``, TempfileBasedBuffer by default)
+    In the first stage appending never copies the data already held,
+    consuming data drops whole segments or moves an offset into the first
+    one, and get_segments() hands out memoryview slices of the segments
+    (copies on Python 2).
+    """
+
+    overflowed = False
+    buf = None   # file-based buffer for the later stages
+    offset = 0   # number of bytes of segments[0] already consumed
+    size = 0     # number of unread bytes in segments
+
+    def __init__(self, overflow, spool=TempfileBasedBuffer):
+        # overflow is the maximum number of bytes kept in memory.
+        self.overflow = overflow
+        self.spool = spool
+        self.segments = deque()
+
+    def __len__(self):
+        buf = self.buf
+        if buf is not None:
+            # use buf.__len__ rather than len(buf) FBO of not getting
+            # OverflowError on Python 2
+            return buf.__len__()
+        return self.size
+
+    def __nonzero__(self):
+        # use self.__len__ rather than len(self) FBO of not getting
+        # OverflowError on Python 2
+        return self.__len__() > 0
+
+    __bool__ = __nonzero__ # py3
+
+    def _set_file_buffer(self, buf):
+        # move the unread segments into the file-based buffer buf
+        file = buf.file
+        for segment in self._iter_segments():
+            file.write(segment)
+        file.seek(0)
+        buf.remain = self.size
+        self.segments.clear()
+        self.offset = self.size = 0
+        self.buf = buf
+
+    def _set_large_buffer(self):
+        buf = self.buf
+        if buf is None:
+            self._set_file_buffer(self.spool())
+        else:
+            self.buf = self.spool(buf)
+            buf.close()
+        self.overflowed = True
+        overflowed_buffers.inc()
+
+    def _iter_segments(self):
+        offset = self.offset
+        for segment in self.segments:
+            if offset:
+                segment = segment_view(segment)[offset:]
+                offset = 0
+            yield segment
+
+    def append(self, s):
+        buf = self.buf
+        if buf is None:
+            if not s:
+                return
+            if s.__class__ is not bytes:
+                # the caller may reuse a bytearray or the memory under a
+                # memoryview; we have to own what we keep
+                if isinstance(s, memoryview):
+                    # bytes() of a memoryview is its repr on Python 2
+                    s = s.tobytes()
+                else:
+                    s = bytes(s)
+            segments = self.segments
+            size = len(s)
+            if (size < COALESCE_BYTES and segments and
+                    len(segments[-1]) + size <= COALESCE_BYTES):
+                segments[-1] = segments[-1] + s
+            else:
+                segments.append(s)
+            self.size += size
+            if self.size >= self.overflow:
+                self._set_large_buffer()
+            return
+        buf.append(s)
+        # use buf.__len__ rather than len(buf) FBO of not getting
+        # OverflowError on Python 2
+        if not self.overflowed and buf.__len__() >= self.overflow:
+            self._set_large_buffer()
+
+    def get(self, numbytes=-1, skip=False):
+        buf = self.buf
+        if buf is not None:
+            return buf.get(numbytes, skip)
+        if numbytes < 0 or numbytes > self.size:
+            numbytes = self.size
+        segments = self.segments
+        if (segments and self.offset == 0 and
+                len(segments[0]) == numbytes):
+            res = segments[0]
+        else:
+            res = b''.join(self.get_segments(numbytes))
+        if skip:
+            self.skip(numbytes)
+        return res
+
+    def get_segments(self, numbytes):
+        buf = self.buf
+        if buf is not None:
+            return buf.get_segments(numbytes)
+        res = []
+        for segment in self._iter_segments():
+            if numbytes <= 0:
+                break
+            if len(segment) > numbytes:
+                segment = segment_view(segment)[:numbytes]
+            res.append(segment)
+            numbytes -= len(segment)
+        return res
+
+    def skip(self, numbytes, allow_prune=False):
+        buf = self.buf
+        if buf is not None:
+            return buf.skip(numbytes, allow_prune)
+        if self.size < numbytes:
+            raise ValueError("Can't skip %d bytes in buffer of %d bytes" % (
+                numbytes, self.size)
+            )
+        self.size -= numbytes
+        segments = self.segments
+        numbytes += self.offset
+        while numbytes and numbytes >= len(segments[0]):
+            numbytes -= len(segments.popleft())
+        self.offset = numbytes
+
+    def prune(self):
+        """
+        Drops the data already retrieved from the buffer.  Consumed segments
+        are dropped as they are skipped, so this only has work to do in the
+        file-based stages.
+        """
+        buf = self.buf
+        if buf is None:
+            return
+        # use buf.__len__ rather than len(buf) FBO of not getting
+        # OverflowError on Python 2
+        if self.overflowed and buf.__len__() < self.overflow:
+            # Revert to the segment list.
+            data = buf.get()
+            buf.close()
+            self.buf = None
+            self.overflowed = False
+            overflowed_buffers.dec()
+            self.append(data)
+            return
+        buf.prune()
+
+    def getfile(self):
+        if self.buf is None:
+            self._set_file_buffer(BytesIOBasedBuffer())
+        return self.buf.getfile()
+
+    def getview(self):
+        """Returns a memoryview of the unread data.  Several segments are
+        joined into one first; the later stages are mapped into memory (see
+        FileBasedBuffer.getview)."""
+        buf = self.buf
+        if buf is not None:
+            return buf.getview()
+        segments = self.segments
+        if not segments:
+            return memoryview(b'')
+        if len(segments) > 1:
+            data = b''.join(self._iter_segments())
+            segments.clear()
+            segments.append(data)
+            self.offset = 0
+        return memoryview(segments[0])[self.offset:]
+
+    def close(self):
+        buf = self.buf
+        if buf is not None:
+            buf.close()
+        if self.overflowed:
+            self.overflowed = False
+            overflowed_buffers.dec()
+        self.segments.clear()
+        self.offset = self.size = 0
+
+class StreamBuffer(object):
+    """
+    The body of a request whose task is started before the body has been
+    received (see the ``stream_request_body`` adjustment).  The I/O thread
+    appends the body as it arrives, and the task reads it through
+    getfile(), blocking until enough of it is there.
+
+    About ``limit`` bytes are held at most: the channel stops reading from
+    the socket while full() is true, and ``wake`` is called once a read
+    makes room again, to have the I/O loop look at the channel again.
+
+    A read that has waited ``timeout`` seconds without any of the body
+    arriving aborts the body, in case the channel has gone without doing so.
+    """
+
+    finished = False # True once the whole body has been appended
+    aborted = False  # True if the body will never be received in full
+    wake = None
+
+    def __init__(self, limit, timeout=None):
+        self.limit = limit
+        self.timeout = timeout
+        self.data = bytearray()
+        self.received = 0
+        self.lock = threading.Condition(threading.Lock())
+
+    def __len__(self):
+        return self.received
+
+    def __nonzero__(self):
+        return True
+
+    __bool__ = __nonzero__ # py3
+
+    def full(self):
+        return len(self.data) >= self.limit
+
+    def append(self, s):
+        with self.lock:
+            if self.aborted:
+                return
+            self.data += s
+            self.received += len(s)
+            self.lock.notify()
+
+    def finish(self):
+        with self.lock:
+            self.finished = True
+            self.lock.notify()
+
+    def abort(self):
+        with self.lock:
+            self.aborted = True
+            del self.data[:]
+            self.lock.notify()
+
+    def _read(self, size, end=None):
+        # Returns up to size bytes (all there are if size < 0), or up to and
+        # including the first occurrence of end, once they have arrived, or
+        # the body has ended, or the buffer is full.
+        timeout = self.timeout
+        deadline = None
+        with self.lock:
+            data = self.data
+            start = 0
+            received = self.received
+            while True:
+                if end is not None:
+                    index = data.find(end, start)
+                    if index >= 0:
+                        index += len(end)
+                        if size < 0 or index < size:
+                            size = index
+                        break
+                    start = max(len(data) - len(end) + 1, 0)
+                if 0 <= size <= len(data):
+                    break
+                if self.aborted:
+                    raise IOError('the request body was not received in full')
+                if self.finished or self.full():
+                    # the channel reads no more until some is taken
+                    break
+                if timeout is None:
+                    self.lock.wait()
+                    continue
+                now = monotonic()
+                if deadline is None or self.received != received:
+                    received = self.received
+                    deadline = now + timeout
+                elif now >= deadline:
+                    self.aborted = True
+                    del data[:]
+                    raise IOError('timed out waiting for the request body')
+                self.lock.wait(deadline - now)
+            was_full = self.full()
+            if size < 0:
+                size = len(data)
+            res = bytes(data[:size])
+            del data[:size]
+            wake = was_full and not self.full()
+        if wake and self.wake is not None:
+            self.wake()
+        return res
+
+    def _read_all(self, size, end=None):
+        # _read until size bytes, the end of the body or end have been read
+        chunks = []
+        while size != 0:
+            chunk = self._read(size, end)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+            if end is not None and chunk.endswith(end):
+                break
+        return b''.join(chunks)
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        return self._read_all(size)
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        return self._read_all(size, b'\n')
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        while hint is None or hint < 0 or total < hint:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    __next__ = next # py3
+
+    def getfile(self):
+        return self
+
+    def getview(self):
+        # only once the rest of the body has been received
+        return memoryview(self.read())
+
+    def close(self):
+        self.abort()
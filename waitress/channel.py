@@ -11,27 +11,88 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+from collections import deque
+import errno
 import socket
 import threading
 import time
 import traceback
 
 from waitress.buffers import (
-    OverflowableBuffer,
     ReadOnlyFileBasedBuffer,
+    SegmentBuffer,
+)
+
+from waitress.compat import (
+    monotonic,
+    PY3,
+    tobytes,
 )
 
 from waitress.parser import HTTPRequestParser
 
 from waitress.task import (
+    build_overloaded_response,
     ErrorTask,
     WSGITask,
 )
 
-from waitress.utilities import InternalServerError
+from waitress.utilities import (
+    cached_http_date,
+    InternalServerError,
+)
 
 from . import wasyncore
 
+# socket.sendmsg is missing on Windows and Python 2
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# most segments passed to a single sendmsg call (POSIX guarantees an IOV_MAX
+# of at least 16; Linux and the BSDs allow 1024)
+SENDMSG_MAX_SEGMENTS = 64
+
+# largest count passed to a single os.sendfile call
+SENDFILE_MAX = 0x7ffff000
+
+# os.sendfile errors meaning "use read() and send() for this file instead"
+SENDFILE_UNSUPPORTED = frozenset(
+    getattr(errno, name) for name in ('EINVAL', 'ENOSYS', 'EOPNOTSUPP',
+                                      'ENOTSUP', 'EOVERFLOW')
+    if hasattr(errno, name))
+
+# methods of the pipelined requests that may be serviced alongside others
+# (see PipelineSlot); those of other methods are serviced one at a time
+PARALLEL_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'TRACE'))
+
+# The channels of one I/O loop all read into the same buffer, one at a time;
+# received() copies whatever it keeps before the next read reuses it.
+recv_buffers = threading.local()
+
+def get_recv_buffer(size):
+    buf = getattr(recv_buffers, 'buf', None)
+    if buf is None or len(buf) != size:
+        buf = recv_buffers.buf = bytearray(size)
+    return buf
+
+def buffered_len(outbufs):
+    # The number of bytes held in outbufs, not counting the files queued by
+    # wsgi.file_wrapper, which are read as they are sent.
+    return sum([b.__len__() for b in outbufs
+                if b.__class__ is not ReadOnlyFileBasedBuffer])
+
+class ClientDisconnected(Exception):
+    """ Raised when a task writes to a channel whose client has gone away
+    while it waited for its output to be sent."""
+
+def queue_output(outbufs, data, overflow):
+    # Appends data to the last of a list of outbufs; a wsgi.file_wrapper
+    # buffer is queued as an outbuf of its own, followed by a new one.
+    if data.__class__ is ReadOnlyFileBasedBuffer:
+        outbufs.append(data)
+        outbufs.append(SegmentBuffer(overflow))
+    else:
+        outbufs[-1].append(data)
+
 class HTTPChannel(wasyncore.dispatcher, object):
     """
     Setting self.requests = [somerequest] prevents more requests from being
@@ -51,6 +112,13 @@ class HTTPChannel(wasyncore.dispatcher, object):
     requests = ()                # currently pending requests
     sent_continue = False        # used as a latch after sending 100 continue
     force_flush = False          # indicates a need to flush the outbuf
+    expiry_slot = None           # server timer wheel slot (see maintenance)
+    bytes_written = 0            # bytes ever appended to the outbufs
+    bytes_sent = 0               # bytes ever sent from the outbufs
+    pending = b''                # input received but not parsed yet
+    closing = False              # a request closing the connection was read
+    slots = ()                   # PipelineSlots of requests being serviced
+    writers_waiting = 0          # task threads blocked in write_soon
 
     #
     # ASYNCHRONOUS METHODS (including __init__)
@@ -66,17 +134,26 @@ class HTTPChannel(wasyncore.dispatcher, object):
             ):
         self.server = server
         self.adj = adj
-        self.outbufs = [OverflowableBuffer(adj.outbuf_overflow)]
-        self.creation_time = self.last_activity = time.time()
+        self.outbufs = [SegmentBuffer(adj.outbuf_overflow)]
+        self.creation_time = time.time()
+        self.last_activity = monotonic()
+        # (bytes_written at the end of a response, its task), see
+        # track_flush
+        self.flush_marks = deque()
 
         # task_lock used to push/pop requests
         self.task_lock = threading.Lock()
-        # outbuf_lock used to access any outbuf
-        self.outbuf_lock = threading.Lock()
-
-        wasyncore.dispatcher.__init__(self, sock, map=map)
-
-        # Don't let wasyncore.dispatcher throttle self.addr on us.
+        # outbuf_lock used to access any outbuf; write_soon waits on it for
+        # the output to drain below outbuf_low_watermark
+        self.outbuf_lock = threading.Condition()
+
+        # The server has made sock non-blocking already and knows its peer,
+        # which wasyncore.dispatcher.__init__ would find out again, each
+        # with a system call of its own.
+        wasyncore.dispatcher.__init__(self, None, map=map)
+        if sock is not None:
+            self.set_socket(sock, map)
+            self.connected = True
         self.addr = addr
 
     def any_outbuf_has_data(self):
@@ -93,9 +170,19 @@ class HTTPChannel(wasyncore.dispatcher, object):
 
     def writable(self):
         # if there's data in the out buffer or we've been instructed to close
-        # the channel (possibly by our server maintenance logic), run
-        # handle_write
-        return self.any_outbuf_has_data() or self.will_close
+        # the channel (possibly by our server maintenance logic, or once
+        # output that may all have been sent already is flushed), run
+        # handle_write; it also parses input left over from a streamed
+        # request, or read ahead of pipeline_depth, once it may be serviced
+        return (self.any_outbuf_has_data() or self.will_close or
+                self.close_when_flushed or
+                bool(self.pending and self.accepts_requests()))
+
+    def accepts_requests(self):
+        # whether another request may be handed to a task
+        if self.adj.pipeline_depth > 1:
+            return len(self.requests) < self.adj.pipeline_depth
+        return not self.requests
 
     def handle_write(self):
         # Precondition: there's data in the out buffer to be sent, or
@@ -104,6 +191,12 @@ class HTTPChannel(wasyncore.dispatcher, object):
             # we dont want to close the channel twice
             return
 
+        if self.pending and self.accepts_requests():
+            data = self.pending
+            self.pending = b''
+            if not (self.will_close or self.close_when_flushed):
+                self.received(data)
+
         # try to flush any pending output
         if not self.requests:
             # 1. There are no running tasks, so we don't need to try to lock
@@ -136,6 +229,8 @@ class HTTPChannel(wasyncore.dispatcher, object):
             try:
                 flush()
             except socket.error:
+                if self.server.metrics is not None:
+                    self.server.metrics.socket_errors.inc()
                 if self.adj.log_socket_errors:
                     self.logger.exception('Socket error')
                 self.will_close = True
@@ -156,62 +251,138 @@ class HTTPChannel(wasyncore.dispatcher, object):
         # 2. There's no already currently running task(s).
         # 3. There's no data in the output buffer that needs to be sent
         #    before we potentially create a new task.
-        return not (self.will_close or self.requests or
+        # While a task reads the body of its request as it arrives (see
+        # stream_request_body), keep reading the body unless the task has
+        # yet to take what was already received.
+        # Nothing after a request that closes the connection is read.
+        request = self.request
+        if request is not None and request.streaming:
+            return not (self.will_close or self.close_when_flushed or
+                        request.body_stream.full())
+        if self.adj.pipeline_depth > 1:
+            # Pipelined requests are serviced in parallel (see
+            # PipelineSlot); read ahead until pipeline_depth of them are.
+            return not (self.will_close or self.close_when_flushed or
+                        self.closing or self.pending or
+                        len(self.requests) >= self.adj.pipeline_depth)
+        return not (self.will_close or self.close_when_flushed or
+                    self.closing or self.requests or
                     self.any_outbuf_has_data())
 
     def handle_read(self):
+        buf = get_recv_buffer(self.adj.recv_bytes)
         try:
-            data = self.recv(self.adj.recv_bytes)
+            num_received = self.recv_into(buf)
         except socket.error:
+            if self.server.metrics is not None:
+                self.server.metrics.socket_errors.inc()
             if self.adj.log_socket_errors:
                 self.logger.exception('Socket error')
             self.handle_close()
             return
-        if data:
-            self.last_activity = time.time()
+        if num_received:
+            self.last_activity = monotonic()
+            if self.server.metrics is not None:
+                self.server.metrics.bytes_received.inc(num_received)
+            if PY3:
+                data = memoryview(buf)[:num_received]
+            else: # pragma: no cover
+                # re can't search a memoryview on Python 2
+                data = bytes(buf[:num_received])
             self.received(data)
 
     def received(self, data):
         """
         Receives input asynchronously and assigns one or more requests to the
-        channel.
+        channel.  ``data`` may be a memoryview; pipelined requests are handed
+        to the parser as slices of it, without copying.
         """
-        # Preconditions: there's no task(s) already running
+        # Preconditions: there's no task(s) already running, unless it is
+        # the task of a request whose body it reads as it arrives, or
+        # pipeline_depth allows for more
         request = self.request
         requests = []
+        streaming = request is not None and request.streaming
+        depth = self.adj.pipeline_depth
 
-        if not data:
+        if not data or self.closing:
             return False
 
         while data:
             if request is None:
+                if depth > 1 and len(self.requests) + len(requests) >= depth:
+                    # parsed once one of them is done, see handle_write
+                    self.pending = bytes(data)
+                    break
                 request = self.parser_class(self.adj)
             n = request.received(data)
-            if request.expect_continue and request.headers_finished:
+            if (request.expect_continue and request.headers_finished and
+                    (requests or self.requests)):
+                # the responses to requests pipelined before this one are
+                # still to be sent (with pipeline_depth, some may be on
+                # their way) and must come first; the 100 Continue waits
+                # for a later read, unless the body has arrived by then
+                if request.completed:
+                    request.expect_continue = False
+            elif request.expect_continue and request.headers_finished:
                 # guaranteed by parser to be a 1.1 request
                 request.expect_continue = False
                 if not self.sent_continue:
                     # there's no current task, so we don't need to try to
                     # lock the outbuf to append to it.
                     self.outbufs[-1].append(b'HTTP/1.1 100 Continue\r\n\r\n')
+                    self.bytes_written += 25
                     self.sent_continue = True
                     self._flush_some()
                     request.completed = False
             if request.completed:
                 # The request (with the body) is ready to use.
                 self.request = None
-                if not request.empty:
+                if request.connection_close or request.error:
+                    # its response closes the connection; whatever was
+                    # pipelined after it is never answered
+                    self.closing = True
+                if streaming:
+                    # its task is (or was) running already; what follows
+                    # is parsed once the task is done, see handle_write
+                    if n < len(data) and not self.closing:
+                        self.pending = bytes(data[n:])
+                    break
+                if not request.empty and not request.streaming:
                     requests.append(request)
+                if self.closing:
+                    break
                 request = None
             else:
                 self.request = request
+                if (request.headers_finished and
+                        request.body_stream is not None and
+                        not request.streaming):
+                    # start the task now; the rest of the body is handed
+                    # to it as it arrives
+                    request.streaming = True
+                    request.body_stream.wake = self.pull_trigger
+                    requests.append(request)
             if n >= len(data):
                 break
             data = data[n:]
 
         if requests:
-            self.requests = requests
-            self.server.add_task(self)
+            observer = self.adj.observer
+            if observer is not None:
+                now = monotonic()
+                for request in requests:
+                    request.received_at = now
+                    observer.received(request)
+                now = monotonic()
+                for request in requests:
+                    request.queued_at = now
+                    observer.queued(request)
+            if self.adj.pipeline_depth > 1:
+                self.add_slots(requests)
+            else:
+                self.requests = requests
+                self.server.add_task(self)
 
         return True
 
@@ -252,11 +423,16 @@ class HTTPChannel(wasyncore.dispatcher, object):
                     dobreak = True
 
             while outbuflen > 0:
-                chunk = outbuf.get(self.adj.send_bytes)
-                num_sent = self.send(chunk)
+                num_sent = None
+                if getattr(outbuf, 'sendfile_fd', None) is not None:
+                    num_sent = self._sendfile_some(outbuf, outbuflen)
+                    if num_sent:
+                        outbuf.skip(num_sent, True)
+                if num_sent is None:
+                    num_sent = self._send_some()
                 if num_sent:
-                    outbuf.skip(num_sent, True)
-                    outbuflen -= num_sent
+                    # the data sent may have spanned several outbufs
+                    outbuflen = outbuf.__len__()
                     sent += num_sent
                 else:
                     dobreak = True
@@ -266,12 +442,86 @@ class HTTPChannel(wasyncore.dispatcher, object):
                 break
 
         if sent:
-            self.last_activity = time.time()
+            self.last_activity = monotonic()
+            self.bytes_sent += sent
+            if self.server.metrics is not None:
+                self.server.metrics.bytes_sent.inc(sent)
+            if self.flush_marks:
+                self._check_flushed()
+            if self.writers_waiting:
+                # a task is running, so we hold the outbuf_lock
+                self.outbuf_lock.notify_all()
             return True
 
         return False
 
+    def _send_some(self):
+        # Gather up to send_bytes from the front of the outbufs (the headers,
+        # chunk framing and body pieces of one or more responses), send them
+        # with a single sendmsg() where possible, and consume what was sent.
+        limit = self.adj.send_bytes
+        segments = []
+        gathered = [] # (outbuf, number of bytes gathered from it)
+        size = 0
+        for outbuf in self.outbufs:
+            if segments and getattr(outbuf, 'sendfile_fd', None) is not None:
+                # leave it for _sendfile_some once it reaches the front
+                break
+            outbuf_size = 0
+            for segment in outbuf.get_segments(limit - size):
+                if segment:
+                    segments.append(segment)
+                    outbuf_size += len(segment)
+            if outbuf_size:
+                gathered.append((outbuf, outbuf_size))
+                size += outbuf_size
+            if size >= limit or len(segments) >= SENDMSG_MAX_SEGMENTS:
+                break
+
+        if not segments:
+            return 0
+        if len(segments) > 1 and HAS_SENDMSG:
+            num_sent = self.sendmsg(segments[:SENDMSG_MAX_SEGMENTS])
+        else:
+            num_sent = self.send(segments[0])
+
+        remaining = num_sent
+        for outbuf, outbuf_size in gathered:
+            if not remaining:
+                break
+            num = min(remaining, outbuf_size)
+            outbuf.skip(num, True)
+            remaining -= num
+        return num_sent
+
+    def _check_flushed(self):
+        # Tell the observer about the responses whose last byte is now sent.
+        marks = self.flush_marks
+        while marks and marks[0][0] <= self.bytes_sent:
+            end, task = marks.popleft()
+            task.request.flushed_at = monotonic()
+            self.adj.observer.flushed(task)
+
+    def _sendfile_some(self, outbuf, count):
+        # Let the kernel copy file-backed output (wsgi.file_wrapper) straight
+        # to the socket.  Returns None if the file turns out not to support
+        # sendfile after all, in which case the buffer is read the usual way.
+        try:
+            return self.sendfile(outbuf.sendfile_fd, outbuf.file.tell(),
+                                 min(count, SENDFILE_MAX))
+        except OSError as why:
+            if why.args[0] not in SENDFILE_UNSUPPORTED:
+                raise
+            outbuf.sendfile_fd = None
+            return None
+
     def handle_close(self):
+        request = self.request
+        if request is not None and request.streaming:
+            # the task reading the body would otherwise wait forever
+            request.body_stream.abort()
+        # the responses still in the outbufs will never be flushed
+        self.flush_marks.clear()
         for outbuf in self.outbufs:
             try:
                 outbuf.close()
@@ -279,6 +529,10 @@ class HTTPChannel(wasyncore.dispatcher, object):
                 self.logger.exception(
                     'Unknown exception while trying to close outbuf')
         self.connected = False
+        if self.writers_waiting:
+            # the tasks blocked in write_soon would otherwise wait forever
+            with self.outbuf_lock:
+                self.outbuf_lock.notify_all()
         wasyncore.dispatcher.close(self)
 
     def add_channel(self, map=None):
@@ -288,6 +542,10 @@ class HTTPChannel(wasyncore.dispatcher, object):
         """
         wasyncore.dispatcher.add_channel(self, map)
         self.server.active_channels[self._fileno] = self
+        if self.server.metrics is not None:
+            self.server.metrics.active_channels.inc()
+        self.server.schedule_expiry(
+            self, self.last_activity + self.adj.channel_timeout)
 
     def del_channel(self, map=None):
         """See wasyncore.dispatcher
@@ -299,6 +557,9 @@ class HTTPChannel(wasyncore.dispatcher, object):
         ac = self.server.active_channels
         if fd in ac:
             del ac[fd]
+            if self.server.metrics is not None:
+                self.server.metrics.active_channels.dec()
+        self.server.cancel_expiry(self)
 
     #
     # SYNCHRONOUS METHODS
@@ -309,56 +570,80 @@ class HTTPChannel(wasyncore.dispatcher, object):
             # the async mainloop might be popping data off outbuf; we can
             # block here waiting for it because we're in a task thread
             with self.outbuf_lock:
-                if data.__class__ is ReadOnlyFileBasedBuffer:
-                    # they used wsgi.file_wrapper
-                    self.outbufs.append(data)
-                    nextbuf = OverflowableBuffer(self.adj.outbuf_overflow)
-                    self.outbufs.append(nextbuf)
-                else:
-                    self.outbufs[-1].append(data)
-            # XXX We might eventually need to pull the trigger here (to
-            # instruct select to stop blocking), but it slows things down so
-            # much that I'll hold off for now; "server push" on otherwise
-            # unbusy systems may suffer.
+                if (self.bytes_written - self.bytes_sent >
+                        self.adj.outbuf_high_watermark):
+                    self._wait_for_drain(self)
+                queue_output(self.outbufs, data, self.adj.outbuf_overflow)
+                self.bytes_written += len(data)
             return len(data)
         return 0
 
+    def wake_for_output(self):
+        """
+        Called by a task thread that has written output and goes back to the
+        application for more.  The I/O thread may be asleep in select()
+        without waiting for the socket to become writable, which would hold
+        up "server push" responses until the next timeout; the trigger wakes
+        it to send what was written.  Writes made before it gets to it are
+        sent along, and pulls of a trigger not yet drained cost nothing (see
+        trigger.pulled), so a burst of writes costs a single wakeup.
+        """
+        if self.bytes_written != self.bytes_sent:
+            self.force_flush = True
+            self.pull_trigger()
+
+    def pull_trigger(self):
+        # From a task thread, having changed what readable() or writable()
+        # answer: wake the I/O thread, which asks them again (a
+        # wasyncore.selector_map only asks the channels it is told about).
+        self.interest_changed()
+        self.server.pull_trigger()
+
+    def buffered(self):
+        """ The number of bytes in the outbufs, see buffered_len """
+        return buffered_len(self.outbufs)
+
+    def _wait_for_drain(self, owner):
+        # With the outbuf_lock held, in a task thread: block until no more
+        # than outbuf_low_watermark bytes written by owner (this channel, or
+        # the PipelineSlot writing) are buffered, so that an application
+        # writing faster than its client reads holds at most about
+        # outbuf_high_watermark bytes of output in memory or on disk.
+        low = min(self.adj.outbuf_low_watermark,
+                  self.adj.outbuf_high_watermark)
+        self.writers_waiting += 1
+        try:
+            while self.connected and owner.buffered() > low:
+                # the I/O thread may be asleep in select() without waiting
+                # for the socket to become writable
+                self.force_flush = True
+                self.pull_trigger()
+                self.outbuf_lock.wait()
+        finally:
+            self.writers_waiting -= 1
+        if not self.connected:
+            raise ClientDisconnected()
+
+    def track_flush(self, task):
+        """
+        Arranges for the observer to be told when everything written so far,
+        which ends the response of ``task``, has been sent.
+        """
+        with self.outbuf_lock:
+            self._add_flush_mark(task)
+
+    def _add_flush_mark(self, task):
+        # with the outbuf_lock held
+        self.flush_marks.append((self.bytes_written, task))
+        if self.bytes_sent >= self.bytes_written:
+            # already sent (or nothing was written at all)
+            self._check_flushed()
+
     def service(self):
         """Execute all pending requests """
         with self.task_lock:
             while self.requests:
-                request = self.requests[0]
-                if request.error:
-                    task = self.error_task_class(self, request)
-                else:
-                    task = self.task_class(self, request)
-                try:
-                    task.service()
-                except:
-                    self.logger.exception('Exception when serving %s' %
-                                          task.request.path)
-                    if not task.wrote_header:
-                        if self.adj.expose_tracebacks:
-                            body = traceback.format_exc()
-                        else:
-                            body = ('The server encountered an unexpected '
-                                    'internal server error')
-                        req_version = request.version
-                        req_headers = request.headers
-                        request = self.parser_class(self.adj)
-                        request.error = InternalServerError(body)
-                        # copy some original request attributes to fulfill
-                        # HTTP 1.1 requirements
-                        request.version = req_version
-                        try:
-                            request.headers['CONNECTION'] = req_headers[
-                                'CONNECTION']
-                        except KeyError:
-                            pass
-                        task = self.error_task_class(self, request)
-                        task.service() # must not fail
-                    else:
-                        task.close_on_finish = True
+                task = self.service_request(self.requests[0], self)
                 # we cannot allow self.requests to drop to empty til
                 # here; otherwise the mainloop gets confused
                 if task.close_on_finish:
@@ -371,14 +656,261 @@ class HTTPChannel(wasyncore.dispatcher, object):
                     request.close()
 
         self.force_flush = True
-        self.server.pull_trigger()
-        self.last_activity = time.time()
+        self.pull_trigger()
+        self.last_activity = monotonic()
+
+    def service_request(self, request, channel):
+        """
+        Runs the task of ``request``, writing its response to ``channel``
+        (this channel, or the PipelineSlot of the request), and returns it.
+        """
+        if request.error:
+            task = self.error_task_class(channel, request)
+        else:
+            task = self.task_class(channel, request)
+        try:
+            task.service()
+        except ClientDisconnected:
+            self.logger.info('Client disconnected while serving %s' %
+                             task.request.path)
+            task.close_on_finish = True
+        except:
+            task = self.service_error(request, task, channel)
+        if request.streaming and not request.body_stream.finished:
+            # the rest of its body would be taken for the next request
+            task.close_on_finish = True
+        return task
+
+    def service_error(self, request, task, channel):
+        """
+        Called while handling the exception raised by ``task``, the task of
+        ``request``: answers with a 500 Internal Server Error unless the task
+        has begun its response already, in which case the connection is
+        closed after it, and returns the task the response came from.
+        """
+        self.logger.exception('Exception when serving %s' %
+                              task.request.path)
+        if task.wrote_header:
+            task.close_on_finish = True
+            return task
+        if self.adj.expose_tracebacks:
+            body = traceback.format_exc()
+        else:
+            body = ('The server encountered an unexpected '
+                    'internal server error')
+        req = request
+        request = self.parser_class(self.adj)
+        request.error = InternalServerError(body)
+        # copy some original request attributes to fulfill
+        # HTTP 1.1 requirements
+        request.version = req.version
+        request.received_at = req.received_at
+        request.queued_at = req.queued_at
+        try:
+            request.headers['CONNECTION'] = req.headers['CONNECTION']
+        except KeyError:
+            pass
+        task = self.error_task_class(channel, request)
+        task.service() # must not fail
+        return task
+
+    def add_slots(self, requests):
+        """
+        Queues a task for each of ``requests``, to be serviced in parallel
+        with those already being serviced; see PipelineSlot.
+        """
+        with self.outbuf_lock:
+            if not self.slots:
+                self.slots = deque()
+            if not self.requests:
+                self.requests = []
+            for request in requests:
+                slot = PipelineSlot(self, request)
+                if not self.slots:
+                    # the first in line writes to the outbufs directly
+                    slot.outbufs = None
+                self.slots.append(slot)
+                self.requests.append(request)
+            slots = self._start_slots()
+        for slot in slots:
+            self.server.add_task(slot)
+
+    def _start_slots(self):
+        # with the outbuf_lock held; marks the slots that may be serviced
+        # now as started and returns them.  A request whose method isn't in
+        # PARALLEL_METHODS waits for those before it to be done, and those
+        # after it wait for it.
+        started = []
+        for index, slot in enumerate(self.slots):
+            if not slot.started:
+                if not slot.parallel and index:
+                    break
+                slot.started = True
+                started.append(slot)
+            if not (slot.parallel or slot.done):
+                break
+        return started
+
+    def finish_slot(self, slot, close):
+        """
+        Called by ``slot`` once its response has been written.  The output of
+        the slots after it is queued in order as each reaches the front; if
+        ``close`` is true, the connection is closed after this response and
+        the responses to later requests are dropped.
+        """
+        with self.outbuf_lock:
+            slot.done = True
+            slot.close_on_finish = close
+            slots = self.slots
+            while slots and slots[0].done:
+                slot = slots.popleft()
+                slot.request.close()
+                self.requests.remove(slot.request)
+                if slot.close_on_finish:
+                    # the slots still running buffer output of their own,
+                    # which is dropped
+                    self.close_when_flushed = True
+                    slots.clear()
+                    self.requests = []
+                    break
+                if slots:
+                    self._adopt_slot(slots[0])
+            started = self._start_slots()
+            if self.writers_waiting:
+                # the next slot may be waiting for its turn, see
+                # PipelineSlot.write_soon
+                self.outbuf_lock.notify_all()
+        for slot in started:
+            self.server.add_task(slot)
+        self.force_flush = True
+        self.pull_trigger()
+        self.last_activity = monotonic()
+
+    def _adopt_slot(self, slot):
+        # with the outbuf_lock held; queue the output slot has buffered so
+        # far, after which it writes to the outbufs directly
+        outbufs = slot.outbufs
+        slot.outbufs = None
+        self.outbufs.extend(outbufs)
+        self.bytes_written += slot.bytes_written
+        if slot.flush_task is not None:
+            self._add_flush_mark(slot.flush_task)
+
+    def reject(self):
+        """
+        Answers the pending requests with a 503 Service Unavailable, on the
+        I/O thread, because the task dispatcher is overloaded.  The
+        connection is closed once the response has been sent.
+        """
+        # there's no running task, so we don't need to lock the outbuf
+        head, tail = build_overloaded_response(
+            self.requests[0].version, self.adj.ident,
+            self.adj.overload_retry_after)
+        now = time.time()
+        response = head + tobytes(cached_http_date(now)) + tail
+        self.outbufs[-1].append(response)
+        self.bytes_written += len(response)
+        if self.server.metrics is not None:
+            self.server.metrics.responses['5'].inc()
+        for request in self.requests:
+            request.close()
+        self.requests = []
+        self.close_when_flushed = True
+        self.last_activity = monotonic()
 
     def cancel(self):
         """ Cancels all pending requests """
         self.force_flush = True
-        self.last_activity = time.time()
+        self.last_activity = monotonic()
         self.requests = []
 
     def defer(self):
         pass
+
+
+class PipelineSlot(object):
+    """
+    The task of one of the pipelined requests of a channel, which are
+    serviced in parallel when the ``pipeline_depth`` adjustment is greater
+    than one.  Its Task writes to the slot as if it were the channel: the
+    first slot in line writes to the channel's outbufs, and the others
+    buffer their output in outbufs of their own until HTTPChannel.
+    finish_slot moves it to the channel's once they reach the front.
+    """
+
+    done = False
+    started = False    # handed to the task dispatcher
+    close_on_finish = False
+    flush_task = None  # the task to track_flush once the output is queued
+    bytes_written = 0  # bytes buffered in outbufs
+
+    def __init__(self, channel, request):
+        self.channel = channel
+        self.request = request
+        self.server = channel.server
+        self.adj = channel.adj
+        self.addr = channel.addr
+        # serviced alongside the slots around it, see HTTPChannel.add_slots
+        self.parallel = (not request.error and
+                         request.command.upper() in PARALLEL_METHODS)
+        # None once the output goes to the channel's outbufs
+        self.outbufs = [SegmentBuffer(channel.adj.outbuf_overflow)]
+
+    def buffered(self):
+        if self.outbufs is None:
+            return self.channel.buffered()
+        return buffered_len(self.outbufs)
+
+    def write_soon(self, data):
+        if data:
+            channel = self.channel
+            with channel.outbuf_lock:
+                if self.outbufs is None:
+                    unsent = channel.bytes_written - channel.bytes_sent
+                else:
+                    # not our turn yet; block while our own output is large
+                    unsent = self.bytes_written
+                if unsent > self.adj.outbuf_high_watermark:
+                    channel._wait_for_drain(self)
+                if self.outbufs is None:
+                    queue_output(channel.outbufs, data,
+                                 self.adj.outbuf_overflow)
+                    channel.bytes_written += len(data)
+                else:
+                    queue_output(self.outbufs, data, self.adj.outbuf_overflow)
+                    self.bytes_written += len(data)
+            return len(data)
+        return 0
+
+    def wake_for_output(self):
+        if self.outbufs is None:
+            self.channel.wake_for_output()
+
+    def track_flush(self, task):
+        with self.channel.outbuf_lock:
+            if self.outbufs is None:
+                self.channel._add_flush_mark(task)
+            else:
+                self.flush_task = task
+
+    def service(self):
+        channel = self.channel
+        task = channel.service_request(self.request, self)
+        channel.finish_slot(self, task.close_on_finish)
+
+    def reject(self):
+        # like HTTPChannel.reject, for this request only
+        channel = self.channel
+        head, tail = build_overloaded_response(
+            self.request.version, self.adj.ident,
+            self.adj.overload_retry_after)
+        self.write_soon(head + tobytes(cached_http_date(time.time())) + tail)
+        if self.server.metrics is not None:
+            self.server.metrics.responses['5'].inc()
+        channel.finish_slot(self, True)
+
+    def cancel(self):
+        self.channel.finish_slot(self, True)
+
+    def defer(self):
+        pass
@@ -21,6 +21,12 @@ PY3 = sys.version_info[0] == 3
 # True if we are running on Windows
 WIN = platform.system() == 'Windows'
 
+try:
+    from time import monotonic
+except ImportError: # pragma: no cover
+    # Python 2
+    from time import time as monotonic
+
 if PY3: # pragma: no cover
     string_types = str,
     integer_types = int,
@@ -0,0 +1,379 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Server metrics in the Prometheus text exposition format.
+
+When the ``metrics_listen`` adjustment is set, ``create_server`` makes a
+``Metrics`` registry, which the server, its channels, tasks and task
+dispatcher update as they go, and serves it at ``/metrics`` on that address
+from the I/O thread (so a scrape never waits for a task thread).
+
+Each counter keeps one cell per thread that updates it, so updating never
+takes a lock; the cells are only added up when the metrics are rendered.
+"""
+from bisect import bisect_left
+import socket
+
+from waitress.compat import (
+    monotonic,
+    thread,
+    tobytes,
+)
+from waitress.observer import RequestObserver
+from waitress.utilities import find_double_newline
+
+from . import wasyncore
+
+# Upper bounds, in seconds, of the histogram buckets (those of the official
+# Prometheus clients).
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75,
+                   1.0, 2.5, 5.0, 7.5, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, value) for name, value in sorted(labels.items()))
+
+class Counter(object):
+    """A number that only goes up."""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.cells = {} # { thread ident -> [value] }
+
+    def inc(self, amount=1):
+        # Only the thread a cell belongs to updates it.  A new thread may
+        # get the ident of a dead one, and with it the dead one's cell.
+        ident = thread.get_ident()
+        try:
+            self.cells[ident][0] += amount
+        except KeyError:
+            self.cells.setdefault(ident, [0])[0] += amount
+
+    def get(self):
+        return sum([cell[0] for cell in list(self.cells.values())])
+
+    def samples(self):
+        yield self.name, self.labels, self.get()
+
+class Gauge(Counter):
+    """A number that goes up and down.  ``function``, if given, is called
+    for the value instead."""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=None, function=None):
+        Counter.__init__(self, name, help, labels)
+        self.function = function
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return Counter.get(self)
+
+class Histogram(object):
+    """Counts observed values in buckets by upper bound."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.cells = {} # { thread ident -> [count per bucket..., sum] }
+
+    def observe(self, value):
+        ident = thread.get_ident()
+        try:
+            cell = self.cells[ident]
+        except KeyError:
+            cell = self.cells.setdefault(
+                ident, [0] * (len(self.buckets) + 1) + [0.0])
+        # the last bucket, before the sum, is for values above them all
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def samples(self):
+        totals = [0] * (len(self.buckets) + 1) + [0.0]
+        for cell in list(self.cells.values()):
+            for i, value in enumerate(cell):
+                totals[i] += value
+        count = 0
+        for bound, value in zip(self.buckets + (float('inf'),), totals):
+            count += value
+            yield self.name + '_bucket', {'le': format_value(bound)}, count
+        yield self.name + '_sum', None, totals[-1]
+        yield self.name + '_count', None, count
+
+# SegmentBuffers don't know which server they belong to, so this one is
+# shared by every server in the process.
+overflowed_buffers = Gauge(
+    'waitress_overflowed_buffers',
+    'Buffers currently spilled to temporary files.')
+
+class Metrics(RequestObserver):
+    """
+    The metrics of one server.  They are also its request observer, which
+    passes the events on to ``observer`` when given.
+    """
+
+    def __init__(self, observer=None):
+        self.observer = observer
+        self.connections_accepted = Counter(
+            'waitress_connections_accepted_total',
+            'Connections accepted.')
+        self.requests = Counter(
+            'waitress_requests_total',
+            'Requests received.')
+        self.responses = dict(
+            (c, Counter('waitress_responses_total',
+                        'Responses produced, by status class.',
+                        {'status': c + 'xx'}))
+            for c in '12345')
+        self.bytes_received = Counter(
+            'waitress_received_bytes_total',
+            'Bytes read from clients.')
+        self.bytes_sent = Counter(
+            'waitress_sent_bytes_total',
+            'Bytes sent to clients.')
+        self.socket_errors = Counter(
+            'waitress_socket_errors_total',
+            'Socket errors while accepting, reading or sending.')
+        self.active_channels = Gauge(
+            'waitress_active_channels',
+            'Open client connections.')
+        self.queue_depth = Gauge(
+            'waitress_queue_depth',
+            'Tasks waiting for a task thread.',
+            function=lambda: 0)
+        self.busy_threads = Gauge(
+            'waitress_busy_threads',
+            'Task threads servicing a request.')
+        self.queue_wait = Histogram(
+            'waitress_queue_wait_seconds',
+            'Time requests waited for a task thread.')
+        self.app_time = Histogram(
+            'waitress_app_seconds',
+            'Time spent producing responses in task threads.')
+        self.latency = Histogram(
+            'waitress_request_duration_seconds',
+            'Time from receiving a request to sending the last byte of its '
+            'response.')
+
+    def collect(self):
+        """Returns the metrics, those of one name next to each other."""
+        return ([self.connections_accepted, self.requests] +
+                [self.responses[c] for c in sorted(self.responses)] +
+                [self.bytes_received, self.bytes_sent, self.socket_errors,
+                 self.active_channels, self.queue_depth, self.busy_threads,
+                 overflowed_buffers, self.queue_wait, self.app_time,
+                 self.latency])
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format, as bytes."""
+        lines = []
+        name = None
+        for metric in self.collect():
+            if metric.name != name:
+                name = metric.name
+                lines.append('# HELP %s %s' % (name, metric.help))
+                lines.append('# TYPE %s %s' % (name, metric.type))
+            for sample_name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (
+                    sample_name, format_labels(labels), format_value(value)))
+        lines.append('')
+        return tobytes('\n'.join(lines))
+
+    # RequestObserver
+
+    def received(self, request):
+        self.requests.inc()
+        if self.observer is not None:
+            self.observer.received(request)
+
+    def queued(self, request):
+        if self.observer is not None:
+            self.observer.queued(request)
+
+    def started(self, task):
+        request = task.request
+        if request.queued_at is not None:
+            self.queue_wait.observe(request.started_at - request.queued_at)
+        if self.observer is not None:
+            self.observer.started(task)
+
+    def finished(self, task):
+        request = task.request
+        self.app_time.observe(request.finished_at - request.started_at)
+        counter = self.responses.get(task.status[:1])
+        if counter is not None:
+            counter.inc()
+        if self.observer is not None:
+            self.observer.finished(task)
+
+    def flushed(self, task):
+        request = task.request
+        if request.received_at is not None:
+            self.latency.observe(request.flushed_at - request.received_at)
+        if self.observer is not None:
+            self.observer.flushed(task)
+
+class MetricsChannel(wasyncore.dispatcher, object):
+    """Answers a single request for the metrics, then closes.
+
+    Closed by its MetricsServer once ``timeout`` seconds have passed
+    without the request having been received in full, or without any of
+    the response being sent.  While open, it is a member of ``channels``.
+    """
+
+    max_request_size = 8192
+    will_close = False
+
+    def __init__(self, metrics, sock, map, timeout=120, channels=None):
+        wasyncore.dispatcher.__init__(self, sock, map=map)
+        self.metrics = metrics
+        self.inbuf = b''
+        self.outbuf = b''
+        self.timeout = timeout
+        self.deadline = monotonic() + timeout
+        self.channels = channels
+        if channels is not None:
+            channels.add(self)
+
+    def readable(self):
+        return not (self.outbuf or self.will_close)
+
+    def writable(self):
+        return bool(self.outbuf) or self.will_close
+
+    def handle_read(self):
+        try:
+            data = self.recv(self.max_request_size)
+        except socket.error:
+            self.close()
+            return
+        self.inbuf += data
+        if find_double_newline(self.inbuf) >= 0:
+            self.outbuf = self.respond(self.inbuf)
+            self.deadline = monotonic() + self.timeout
+        elif len(self.inbuf) >= self.max_request_size:
+            self.close()
+
+    def respond(self, request):
+        first_line = request.lstrip().split(b'\n', 1)[0].split()
+        if len(first_line) < 2:
+            status, body = '400 Bad Request', b''
+        elif first_line[0] not in (b'GET', b'HEAD'):
+            status, body = '405 Method Not Allowed', b''
+        elif first_line[1].split(b'?', 1)[0] != b'/metrics':
+            status, body = '404 Not Found', b''
+        else:
+            status, body = '200 OK', self.metrics.render()
+        head = ('HTTP/1.0 %s\r\n'
+                'Content-Type: %s\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: close\r\n\r\n' % (status, CONTENT_TYPE, len(body)))
+        if first_line and first_line[0] == b'HEAD':
+            body = b''
+        return tobytes(head) + body
+
+    def handle_write(self):
+        if self.will_close:
+            self.close()
+            return
+        try:
+            num_sent = self.send(self.outbuf)
+        except socket.error:
+            self.close()
+            return
+        self.outbuf = self.outbuf[num_sent:]
+        if not self.outbuf:
+            self.close()
+        elif num_sent:
+            self.deadline = monotonic() + self.timeout
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        if self.channels is not None:
+            self.channels.discard(self)
+        wasyncore.dispatcher.close(self)
+
+class MetricsServer(wasyncore.dispatcher, object):
+    """Serves ``metrics`` on the address described by ``sockinfo``.
+
+    At most ``max_channels`` connections are served at once, each closed
+    after ``timeout`` seconds of inactivity (see MetricsChannel), so that
+    scrapes can hold no more than that many sockets of ``map``.
+    """
+
+    backlog = 16
+    max_channels = 8
+    next_check = 0 # when readable() next looks for idle channels
+
+    def __init__(self, metrics, sockinfo, map, timeout=120):
+        wasyncore.dispatcher.__init__(self, map=map)
+        self.metrics = metrics
+        self.timeout = timeout
+        self.channels = set()
+        family, socktype, proto, sockaddr = sockinfo
+        self.create_socket(family, socktype)
+        self.set_reuse_addr()
+        self.bind(sockaddr)
+        self.listen(self.backlog)
+        self.effective_host, self.effective_port = (
+            self.socket.getsockname()[:2])
+
+    def readable(self):
+        now = monotonic()
+        if now >= self.next_check:
+            self.next_check = now + 1
+            for channel in self.channels:
+                if channel.deadline <= now:
+                    # closed once the loop finds it writable; the loop
+                    # may be about to poll its socket
+                    channel.will_close = True
+                    channel.interest_changed()
+        return len(self.channels) < self.max_channels
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        try:
+            v = self.accept()
+            if v is None:
+                return
+            conn, addr = v
+        except socket.error:
+            return
+        MetricsChannel(self.metrics, conn, self._map, self.timeout,
+                       self.channels)
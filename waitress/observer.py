@@ -0,0 +1,65 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Request lifecycle observers.
+
+An observer passed as the ``observer`` adjustment is told about each request
+as it goes through the server.  Before each call the matching timestamp,
+taken from ``waitress.compat.monotonic``, is set on the request
+(a ``waitress.parser.HTTPRequestParser``):
+
+``received(request)``
+  ``request.received_at``: the request (with its body) has been read and
+  parsed by the channel.
+
+``queued(request)``
+  ``request.queued_at``: the request has been handed to the task dispatcher,
+  together with any other requests pipelined with it.
+
+``started(task)``
+  ``task.request.started_at``: a task thread starts servicing the request.
+
+``finished(task)``
+  ``task.request.finished_at``: the application has returned and the whole
+  response has been written to the channel's output buffers.
+
+``flushed(task)``
+  ``task.request.flushed_at``: the last byte of the response has been sent.
+
+So ``started_at - queued_at`` is the time spent waiting for a thread,
+``finished_at - started_at`` the time spent in the application and
+``flushed_at - finished_at`` the time spent sending what was left of the
+response.  ``finished`` and ``flushed`` are only reported for responses that
+were produced completely, and ``flushed`` not if the client goes away first.
+
+The methods are called from the I/O and task threads as the request moves
+between them, so they must be quick, thread safe and must not raise.
+"""
+
+class RequestObserver(object):
+    """An observer that ignores everything, to be subclassed."""
+
+    def received(self, request):
+        pass
+
+    def queued(self, request):
+        pass
+
+    def started(self, task):
+        pass
+
+    def finished(self, task):
+        pass
+
+    def flushed(self, task):
+        pass
@@ -25,7 +25,12 @@ from waitress.compat import (
     unquote_bytes_to_wsgi,
 )
 
-from waitress.buffers import OverflowableBuffer
+from waitress.buffers import (
+    MemfdBasedBuffer,
+    SegmentBuffer,
+    StreamBuffer,
+    TempfileBasedBuffer,
+)
 
 from waitress.receiver import (
     FixedStreamReceiver,
@@ -39,6 +44,21 @@ from waitress.utilities import (
     BadRequest,
 )
 
+# How many header names the tables below may learn.
+header_cache_size = 1000
+
+# Header names as received to their keys in HTTPRequestParser.headers, e.g.
+# b'Content-Type' to 'CONTENT_TYPE'.  Added as they are seen; names
+# containing underscores are never added.
+header_keys = {}
+
+# Keys of HTTPRequestParser.headers to their WSGI environ keys, e.g. 'HOST'
+# to 'HTTP_HOST'.  Added by the parser as they are seen.
+environ_keys = {
+    'CONTENT_LENGTH': 'CONTENT_LENGTH',
+    'CONTENT_TYPE': 'CONTENT_TYPE',
+}
+
 class ParsingError(Exception):
     pass
 
@@ -58,10 +78,20 @@ class HTTPRequestParser(object):
     header_bytes_received = 0
     body_bytes_received = 0
     body_rcv = None
+    body_stream = None       # StreamBuffer of a body read by a running task
+    streaming = False        # set by the channel once its task is started
     version = '1.0'
     error = None
     connection_close = False
 
+    # monotonic() timestamps of the request's stages, only set when there is
+    # an observer (see waitress.observer)
+    received_at = None
+    queued_at = None
+    started_at = None
+    finished_at = None
+    flushed_at = None
+
     # Other attributes: first_line, header, headers, command, uri, version,
     # path, query, fragment
 
@@ -79,6 +109,9 @@ class HTTPRequestParser(object):
         Receives the HTTP stream for one request.  Returns the number of
         bytes consumed.  Sets the completed flag once both the header and the
         body have been received.
+
+        ``data`` may be a memoryview of the channel's receive buffer, which
+        is reused once this returns; anything kept must be copied.
         """
         if self.completed:
             return 0 # Can't consume any more.
@@ -86,12 +119,22 @@ class HTTPRequestParser(object):
         br = self.body_rcv
         if br is None:
             # In header.
-            s = self.header_plus + data
-            index = find_double_newline(s)
+            s = self.header_plus
+            if s:
+                # The header began in an earlier read, whose data has
+                # already been searched, except for the last two bytes,
+                # which may start a terminator that ends in data.
+                start = len(s) - 2
+                s += data
+            else:
+                start = 0
+                s = data
+            index = find_double_newline(s, start)
             if index >= 0:
                 # Header finished.
-                header_plus = s[:index]
+                header_plus = bytes(s[:index])
                 consumed = len(data) - (len(s) - index)
+                self.header_plus = b''
                 # Remove preceeding blank lines.
                 header_plus = header_plus.lstrip()
                 if not header_plus:
@@ -131,6 +174,9 @@ class HTTPRequestParser(object):
                     self.error = RequestHeaderFieldsTooLarge(
                         'exceeds max_header of %s' % max_header)
                     self.completed = True
+                if s is data:
+                    # a bytearray, grown in place as the header trickles in
+                    s = bytearray(data)
                 self.header_plus = s
                 return datalen
         else:
@@ -150,7 +196,7 @@ class HTTPRequestParser(object):
             elif br.completed:
                 # The request (with the body) is ready to use.
                 self.completed = True
-                if self.chunked:
+                if self.chunked and not self.streaming:
                     # We've converted the chunked transfer encoding request
                     # body into a normal request body, so we know its content
                     # length; set the header here.  We already popped the
@@ -158,6 +204,13 @@ class HTTPRequestParser(object):
                     # appear to the client to be an entirely non-chunked HTTP
                     # request with a valid content-length.
                     self.headers['CONTENT_LENGTH'] = str(br.__len__())
+            stream = self.body_stream
+            if stream is not None and self.completed:
+                # wake up the task reading it
+                if self.error is None:
+                    stream.finish()
+                else:
+                    stream.abort()
             return consumed
 
     def parse_header(self, header_plus):
@@ -182,10 +235,16 @@ class HTTPRequestParser(object):
             index = line.find(b':')
             if index > 0:
                 key = line[:index]
-                if b'_' in key:
-                    continue
+                key1 = header_keys.get(key)
+                if key1 is None:
+                    if b'_' in key:
+                        continue
+                    key1 = tostr(key.upper().replace(b'-', b'_'))
+                    if len(header_keys) < header_cache_size:
+                        header_keys[key] = key1
+                        if key1 not in environ_keys:
+                            environ_keys[key1] = 'HTTP_' + key1
                 value = line[index + 1:].strip()
-                key1 = tostr(key.upper().replace(b'-', b'_'))
                 # If a header already exists, we append subsequent values
                 # seperated by a comma. Applications already need to handle
                 # the comma seperated values, as HTTP front ends might do
@@ -221,7 +280,7 @@ class HTTPRequestParser(object):
             te = headers.pop('TRANSFER_ENCODING', '')
             if te.lower() == 'chunked':
                 self.chunked = True
-                buf = OverflowableBuffer(self.adj.inbuf_overflow)
+                buf = self.create_body_buffer()
                 self.body_rcv = ChunkedReceiver(buf)
             expect = headers.get('EXPECT', '').lower()
             self.expect_continue = expect == '100-continue'
@@ -235,9 +294,21 @@ class HTTPRequestParser(object):
                 cl = 0
             self.content_length = cl
             if cl > 0:
-                buf = OverflowableBuffer(self.adj.inbuf_overflow)
+                buf = self.create_body_buffer()
                 self.body_rcv = FixedStreamReceiver(cl, buf)
 
+    def create_body_buffer(self):
+        if self.adj.stream_request_body:
+            # the task may be started before the body has been received
+            buf = self.body_stream = StreamBuffer(self.adj.inbuf_overflow,
+                                                  self.adj.channel_timeout)
+            return buf
+        if self.adj.inbuf_use_memfd:
+            spool = MemfdBasedBuffer
+        else:
+            spool = TempfileBasedBuffer
+        return SegmentBuffer(self.adj.inbuf_overflow, spool)
+
     def get_body_stream(self):
         body_rcv = self.body_rcv
         if body_rcv is not None:
@@ -245,6 +316,14 @@ class HTTPRequestParser(object):
         else:
             return BytesIO()
 
+    def get_body_view(self):
+        """Returns a memoryview of the part of the body not yet read through
+        get_body_stream(), without copying it where possible."""
+        body_rcv = self.body_rcv
+        if body_rcv is not None:
+            return body_rcv.getbuf().getview()
+        return memoryview(b'')
+
     def close(self):
         body_rcv = self.body_rcv
         if body_rcv is not None:
@@ -0,0 +1,286 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Pre-fork multi-process mode.
+
+A master process binds the listening sockets once and forks worker
+processes, each of which serves the inherited sockets with its own
+``create_server``.  The master restarts workers that die, and on SIGHUP
+replaces them one by one.  SIGTERM and SIGINT shut everything down
+gracefully.
+"""
+
+import errno
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from waitress.adjustments import Adjustments
+from waitress.server import (
+    create_server,
+    print_listen_options,
+    set_listen_socket_options,
+)
+from waitress.utilities import cleanup_unix_socket
+
+from waitress.compat import (
+    IPPROTO_IPV6,
+    IPV6_V6ONLY,
+    integer_types,
+    )
+
+def exit_status(code):
+    """The status the interpreter exits with for ``SystemExit(code)``,
+    printing ``code`` like it does unless it is an integer or None."""
+    if code is None:
+        return 0
+    if isinstance(code, integer_types):
+        return code
+    try:
+        sys.stderr.write('%s\n' % (code,))
+    except Exception:
+        pass
+    return 1
+
+def bind_sockets(adj):
+    """Create, bind and listen on the sockets described by ``adj``."""
+    sockets = []
+    if adj.unix_socket and hasattr(socket, 'AF_UNIX'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        cleanup_unix_socket(adj.unix_socket)
+        sock.bind(adj.unix_socket)
+        os.chmod(adj.unix_socket, adj.unix_socket_perms)
+        sock.listen(adj.backlog)
+        return [sock]
+    try:
+        for (family, socktype, proto, sockaddr) in adj.listen:
+            sock = socket.socket(family, socktype, proto)
+            sockets.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if family == socket.AF_INET6: # pragma: nocover
+                sock.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 1)
+            sock.bind(sockaddr)
+            set_listen_socket_options(sock, adj)
+            sock.listen(adj.backlog)
+    except:
+        for sock in sockets:
+            sock.close()
+        raise
+    return sockets
+
+class Master(object):
+    """
+    Supervises ``workers`` child processes serving the application returned
+    by ``loader`` on the sockets bound by the master.
+
+    ``loader`` is called in every child after it has been forked, so an
+    application factory given to ``waitress-serve --call`` runs once per
+    worker and again for the replacement workers started on SIGHUP.
+    Changes to the application's code still need a full restart.
+    """
+
+    os = os # test shim
+    signal = signal # test shim
+    time = time # test shim
+    create_server = staticmethod(create_server) # test shim
+
+    logger = logging.getLogger('waitress')
+
+    # seconds between checks for dead children while idle
+    poll_interval = 0.5
+
+    # minimum seconds between two restarts of crashed workers, so that a
+    # worker that fails on startup doesn't turn into a fork loop
+    restart_delay = 1
+
+    # seconds to wait for workers to finish after SIGTERM before killing them
+    graceful_timeout = 30
+
+    def __init__(self, loader, workers, sockets=None, **kw):
+        self.loader = loader
+        self.workers = workers
+        self.adj = Adjustments(**kw)
+        if sockets is None:
+            sockets = bind_sockets(self.adj)
+        self.sockets = sockets
+        # the children get the master's sockets instead of addresses
+        for name in ('host', 'port', 'listen', 'unix_socket'):
+            kw.pop(name, None)
+        self.worker_kw = kw
+        self.children = {} # pid -> start time
+        self.retiring = {} # pid -> start time, for workers being replaced
+        self.pending_signals = []
+        self.last_restart = 0
+        self.alive = True
+
+    def print_listen(self, format_str): # pragma: nocover
+        for sock in self.sockets:
+            if sock.family == getattr(socket, 'AF_UNIX', None):
+                print(format_str.format('unix', sock.getsockname()))
+                continue
+            l = list(sock.getsockname()[:2])
+            if ':' in l[0]:
+                l[0] = '[{}]'.format(l[0])
+            print(format_str.format(*l))
+        print_listen_options(self.sockets)
+
+    def handle_signal(self, signum, frame):
+        self.pending_signals.append(signum)
+
+    def install_signals(self):
+        for signum in (self.signal.SIGTERM, self.signal.SIGINT,
+                       self.signal.SIGHUP):
+            self.signal.signal(signum, self.handle_signal)
+
+    def run(self):
+        self.install_signals()
+        try:
+            for i in range(self.workers):
+                self.spawn()
+            while self.alive:
+                self.reap()
+                self.process_signals()
+                if not self.alive:
+                    break
+                self.restart_missing()
+                self.time.sleep(self.poll_interval)
+        finally:
+            self.stop()
+            self.close()
+
+    def process_signals(self):
+        while self.pending_signals:
+            signum = self.pending_signals.pop(0)
+            if signum == self.signal.SIGHUP:
+                self.logger.info('Reloading workers')
+                self.reload()
+            else:
+                self.logger.info('Shutting down')
+                self.alive = False
+                return
+
+    def spawn(self):
+        pid = self.os.fork()
+        if pid:
+            self.children[pid] = self.time.time()
+            self.logger.info('Booted worker %d', pid)
+            return pid
+        # in the child, which must never return to the caller of run():
+        # it would go on to stop the workers in its copy of children
+        status = 1
+        try:
+            try:
+                self.run_worker()
+                status = 0
+            except SystemExit as e:
+                status = exit_status(e.code)
+            except:
+                self.logger.exception('Worker failed')
+        finally:
+            self.os._exit(status)
+
+    def run_worker(self):
+        signal = self.signal
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        # the master forwards SIGTERM when the terminal sends SIGINT to the
+        # whole process group; don't let the children die halfway on it
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self.worker_exit)
+        app = self.loader()
+        server = self.create_server(app, sockets=self.sockets,
+                                    **self.worker_kw)
+        server.run()
+
+    def worker_exit(self, signum, frame):
+        # the server's run() catches SystemExit and waits for the task
+        # threads to finish what they are doing
+        raise SystemExit(0)
+
+    def reap(self):
+        while self.children or self.retiring:
+            try:
+                pid, status = self.os.waitpid(-1, self.os.WNOHANG)
+            except OSError as e:
+                if e.args[0] == errno.ECHILD:
+                    self.children.clear()
+                    self.retiring.clear()
+                    return
+                raise
+            if not pid:
+                return
+            if self.retiring.pop(pid, None) is not None:
+                continue
+            if self.children.pop(pid, None) is not None and self.alive:
+                if self.os.WIFSIGNALED(status):
+                    self.logger.warning('Worker %d killed by signal %d',
+                                        pid, self.os.WTERMSIG(status))
+                else:
+                    self.logger.warning('Worker %d exited with code %d',
+                                        pid, self.os.WEXITSTATUS(status))
+
+    def restart_missing(self):
+        now = self.time.time()
+        while len(self.children) < self.workers:
+            if now - self.last_restart < self.restart_delay:
+                return
+            self.last_restart = now
+            self.spawn()
+
+    def reload(self):
+        # Start every replacement before retiring the worker it replaces,
+        # so that there is always someone accepting connections.
+        for pid in list(self.children):
+            self.retiring[pid] = self.children.pop(pid)
+            self.spawn()
+            self.kill(pid, self.signal.SIGTERM)
+
+    def kill(self, pid, signum):
+        try:
+            self.os.kill(pid, signum)
+        except OSError as e:
+            if e.args[0] != errno.ESRCH:
+                raise
+
+    def stop(self):
+        self.alive = False
+        for pid in list(self.children) + list(self.retiring):
+            self.kill(pid, self.signal.SIGTERM)
+        deadline = self.time.time() + self.graceful_timeout
+        while ((self.children or self.retiring) and
+               self.time.time() < deadline):
+            self.reap()
+            if self.children or self.retiring:
+                self.time.sleep(self.poll_interval)
+        for pid in list(self.children) + list(self.retiring):
+            self.kill(pid, self.signal.SIGKILL)
+        self.reap()
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+        if self.adj.unix_socket:
+            cleanup_unix_socket(self.adj.unix_socket)
+
+def serve(loader, workers, **kw):
+    _quiet = kw.pop('_quiet', False) # test shim
+    _master = kw.pop('_master', Master) # test shim
+    if not _quiet: # pragma: no cover
+        logging.basicConfig()
+        logging.getLogger('waitress').setLevel(logging.INFO)
+    master = _master(loader, workers, **kw)
+    if not _quiet: # pragma: no cover
+        master.print_listen('Serving on http://{}:{}')
+    master.run()
@@ -13,6 +13,7 @@
 ##############################################################################
 """Data Chunk Receiver
 """
+import re
 
 from waitress.utilities import find_double_newline
 
@@ -54,6 +55,8 @@ class FixedStreamReceiver(object):
     def getbuf(self):
         return self.buf
 
+newline_re = re.compile(b'\n')
+
 class ChunkedReceiver(object):
 
     chunk_remainder = 0
@@ -73,7 +76,8 @@ class ChunkedReceiver(object):
         return self.buf.__len__()
 
     def received(self, s):
-        # Returns the number of bytes consumed.
+        # Returns the number of bytes consumed.  s may be a memoryview of a
+        # buffer that gets reused, so whatever is kept is copied to bytes.
         if self.completed:
             return 0
         orig_size = len(s)
@@ -88,15 +92,17 @@ class ChunkedReceiver(object):
                 self.chunk_remainder -= written
             elif not self.all_chunks_received:
                 # Receive a control line.
-                s = self.control_line + s
-                pos = s.find(b'\n')
-                if pos < 0:
+                if self.control_line:
+                    s = self.control_line + s
+                match = newline_re.search(s)
+                if match is None:
                     # Control line not finished.
-                    self.control_line = s
-                    s = ''
+                    self.control_line = bytes(s)
+                    s = b''
                 else:
                     # Control line finished.
-                    line = s[:pos]
+                    pos = match.start()
+                    line = bytes(s[:pos])
                     s = s[pos + 1:]
                     self.control_line = b''
                     line = line.strip()
@@ -121,24 +127,27 @@ class ChunkedReceiver(object):
                     # else expect a control line.
             else:
                 # Receive the trailer.
-                trailer = self.trailer + s
-                if trailer.startswith(b'\r\n'):
+                if self.trailer:
+                    trailer = self.trailer + s
+                else:
+                    trailer = s
+                if trailer[:2] == b'\r\n':
                     # No trailer.
                     self.completed = True
                     return orig_size - (len(trailer) - 2)
-                elif trailer.startswith(b'\n'):
+                elif trailer[:1] == b'\n':
                     # No trailer.
                     self.completed = True
                     return orig_size - (len(trailer) - 1)
                 pos = find_double_newline(trailer)
                 if pos < 0:
                     # Trailer not finished.
-                    self.trailer = trailer
+                    self.trailer = bytes(trailer)
                     s = b''
                 else:
                     # Finished the trailer.
                     self.completed = True
-                    self.trailer = trailer[:pos]
+                    self.trailer = bytes(trailer[:pos])
                     return orig_size - (len(trailer) - pos)
         return orig_size
 
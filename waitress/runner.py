@@ -23,6 +23,7 @@ import re
 import sys
 
 from waitress import serve
+from waitress import prefork
 from waitress.adjustments import Adjustments
 
 HELP = """\
@@ -38,6 +39,14 @@ Standard options:
     --call
         Call the given object to get the WSGI application.
 
+    --workers=INT
+        Run a master process that binds the listening sockets and forks
+        this many worker processes to serve them. The master restarts
+        workers that die, replaces them one by one on SIGHUP (calling the
+        object again in each new worker when --call is given) and shuts
+        them down gracefully on SIGTERM or SIGINT. Not available on
+        Windows. Default is 1, which serves from a single process.
+
     --host=ADDR
         Hostname or IP address on which to listen, default is '0.0.0.0',
         which means "all IP addresses on this host".
@@ -111,11 +120,74 @@ Tuning options:
     --threads=INT
         Number of threads used to process application logic, default is 4.
 
+    --max-threads=INT
+        Adjust the number of threads to the load, up to this many. Threads
+        are added while requests wait in the queue. Default is unset (a
+        fixed number of threads).
+
+    --min-threads=INT
+        Lowest number of threads when --max-threads is set. Default is the
+        value of --threads.
+
+    --thread-idle-timeout=INT
+        Seconds a thread may stay idle before the pool shrinks by one when
+        --max-threads is set. Default is 60.
+
+    --max-queue-depth=INT
+        Answer requests with 503 Service Unavailable instead of queueing
+        them when this many are already waiting for a thread. Default is
+        unset (no limit).
+
+    --max-queue-wait=FLOAT
+        Answer requests with 503 Service Unavailable instead of queueing
+        them when the oldest queued request has waited this many seconds.
+        Default is unset (no limit).
+
+    --overload-retry-after=INT
+        Value of the Retry-After header of those 503 responses. Default
+        is 1.
+
+    --io-loops=INT
+        Number of independent I/O loops, each with its own listening sockets
+        bound with SO_REUSEPORT. Not available with --unix-socket. Default
+        is 1.
+
+    --io-backend=STR
+        Event loop serving the connections: wasyncore, or asyncio (Python 3
+        only; uses uvloop if its event loop policy is installed). Not
+        available with --io-loops or --metrics-listen. Default is
+        wasyncore.
+
+    --asgi
+        Serve the application as an ASGI application, from the event loop of
+        --io-backend=asyncio rather than from task threads.
+
+    --pipeline-depth=INT
+        Number of pipelined requests of a connection that may be serviced by
+        task threads at the same time; responses are still sent in order.
+        Default is 1.
+
+    --metrics-listen=host:port
+        Serve Prometheus metrics at /metrics on this address, from the I/O
+        thread. Not available with --workers. Default is not to serve them.
+
     --backlog=INT
         Connection backlog for the server. Default is 1024.
 
+    --accept-batch=INT
+        Number of pending connections accepted at most each time the
+        listening socket is readable. Default is 16.
+
+    --tcp-defer-accept=INT
+        Seconds a new connection is held back by the kernel until the client
+        sends data. Default is 0 (disabled).
+
+    --tcp-fastopen=INT
+        Length of the queue of pending TCP Fast Open connections. Default is
+        0 (disabled).
+
     --recv-bytes=INT
-        Number of bytes to request when calling socket.recv(). Default is
+        Number of bytes to request when calling socket.recv_into(). Default is
         8192.
 
     --send-bytes=INT
@@ -126,17 +198,36 @@ Tuning options:
         A temporary file should be created if the pending output is larger
         than this. Default is 1048576 (1MB).
 
+    --outbuf-high-watermark=INT
+        A task writing a response blocks while more output than this is
+        waiting to be sent on its connection. Default is 16777216 (16MB).
+
+    --outbuf-low-watermark=INT
+        A task blocked by --outbuf-high-watermark resumes once the output
+        waiting to be sent drops to this. Default is 8388608 (8MB).
+
     --inbuf-overflow=INT
         A temporary file should be created if the pending input is larger
         than this. Default is 524288 (512KB).
 
+    --inbuf-use-memfd
+        Keep request bodies larger than --inbuf-overflow in memory, in a
+        file created with os.memfd_create, instead of in a temporary file.
+        Default is False.
+
+    --stream-request-body
+        Start the application as soon as the headers of a request with a
+        body have been received, and hand it the body through wsgi.input
+        as it arrives, holding at most about --inbuf-overflow bytes of it.
+        Default is False.
+
     --connection-limit=INT
         Stop creating new channelse if too many are already active.
         Default is 100.
 
     --cleanup-interval=INT
-        Minimum seconds between cleaning up inactive channels. Default
-        is 30. See '--channel-timeout'.
+        Deprecated and ignored; inactive channels are closed as soon as
+        their timeout elapses. See '--channel-timeout'.
 
     --channel-timeout=INT
         Maximum number of seconds to leave inactive connections open.
@@ -165,6 +256,12 @@ Tuning options:
         The use_poll argument passed to ``asyncore.loop()``. Helps overcome
         open file descriptors limit. Default is False.
 
+    --asyncore-use-selectors
+        Keep sockets registered with a ``selectors`` selector (epoll,
+        kqueue) instead of rebuilding the select()/poll() sets on every
+        loop iteration. Recommended for large connection limits. Default
+        is False.
+
 """
 
 RUNNER_PATTERN = re.compile(r"""
@@ -226,7 +323,7 @@ def show_exception(stream):
     else:
         print('It had no arguments.', file=stream)
 
-def run(argv=sys.argv, _serve=serve):
+def run(argv=sys.argv, _serve=serve, _prefork=prefork.serve):
     """Command line runner."""
     name = os.path.basename(argv[0])
 
@@ -244,6 +341,17 @@ def run(argv=sys.argv, _serve=serve):
         show_help(sys.stderr, name, 'Specify one application only')
         return 1
 
+    try:
+        workers = int(kw.pop('workers', 1))
+    except ValueError:
+        show_help(sys.stderr, name, 'Number of workers must be an integer')
+        return 1
+
+    if workers > 1 and not hasattr(os, 'fork'): # pragma: no cover
+        show_help(sys.stderr, name, 'Workers are not supported on this '
+                  'platform')
+        return 1
+
     try:
         module, obj_name = match(args[0])
     except ValueError as exc:
@@ -265,11 +373,22 @@ def run(argv=sys.argv, _serve=serve):
         show_help(sys.stderr, name, "Bad object name '{0}'".format(obj_name))
         show_exception(sys.stderr)
         return 1
-    if kw['call']:
-        app = app()
+    call = kw['call']
 
     # These arguments are specific to the runner, not waitress itself.
     del kw['call'], kw['help']
 
+    if workers > 1:
+        # Each worker creates its own application after it has been forked.
+        def loader():
+            if call:
+                return app()
+            return app
+        _prefork(loader, workers, **kw)
+        return 0
+
+    if call:
+        app = app()
+
     _serve(app, **kw)
     return 0
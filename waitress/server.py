@@ -12,23 +12,118 @@
 #
 ##############################################################################
 
+import math
 import os
 import os.path
 import socket
-import time
+import threading
 
 from waitress import trigger
 from waitress.adjustments import Adjustments
 from waitress.channel import HTTPChannel
-from waitress.task import ThreadedTaskDispatcher
-from waitress.utilities import cleanup_unix_socket
+from waitress.metrics import (
+    Metrics,
+    MetricsServer,
+)
+from waitress.task import (
+    ThreadedTaskDispatcher,
+    environ_template,
+)
+from waitress.utilities import (
+    cleanup_unix_socket,
+    logger,
+)
 
 from waitress.compat import (
     IPPROTO_IPV6,
     IPV6_V6ONLY,
+    monotonic,
     )
 from . import wasyncore
 
+# (name, adjustment) of the options set on listening TCP sockets
+LISTEN_OPTIONS = (
+    ('TCP_DEFER_ACCEPT', 'tcp_defer_accept'),
+    ('TCP_FASTOPEN', 'tcp_fastopen'),
+)
+
+def set_listen_socket_options(sock, adj):
+    """
+    Sets the LISTEN_OPTIONS requested by ``adj`` on ``sock``, a TCP socket
+    about to listen (or listening already).  The options the platform lacks
+    or refuses are logged and left unset.
+    """
+    for name, attr in LISTEN_OPTIONS:
+        value = getattr(adj, attr)
+        if not value:
+            continue
+        optname = getattr(socket, name, None)
+        if optname is None:
+            logger.warning('%s is not supported on this platform' % name)
+            continue
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, optname, value)
+        except socket.error as why:
+            logger.warning('Could not set %s: %s' % (name, why))
+            continue
+        if name == 'TCP_FASTOPEN' and not fastopen_server_enabled():
+            logger.warning('TCP_FASTOPEN is set, but the '
+                           'net.ipv4.tcp_fastopen sysctl does not enable it '
+                           'for servers')
+
+def listen_socket_options(sock):
+    """
+    Returns ``'NAME=value'`` for each of the LISTEN_OPTIONS in effect on the
+    TCP socket ``sock``, with the value the kernel reports (Linux rounds
+    TCP_DEFER_ACCEPT up to a number of SYN-ACK retransmissions).
+    """
+    options = []
+    for name, attr in LISTEN_OPTIONS:
+        optname = getattr(socket, name, None)
+        if optname is None:
+            continue
+        try:
+            value = sock.getsockopt(socket.IPPROTO_TCP, optname)
+        except socket.error:
+            continue
+        if value and (name != 'TCP_FASTOPEN' or fastopen_server_enabled()):
+            options.append('%s=%d' % (name, value))
+    return options
+
+def fastopen_server_enabled(path='/proc/sys/net/ipv4/tcp_fastopen'):
+    """
+    Whether the kernel accepts TCP Fast Open connections on the sockets
+    that ask for it; on Linux, only if the 0x2 (server) flag of the
+    net.ipv4.tcp_fastopen sysctl is set.
+    """
+    try:
+        with open(path) as f:
+            return bool(int(f.read()) & 2)
+    except (IOError, OSError, ValueError):
+        # not Linux
+        return True
+
+def print_listen_options(socks): # pragma: nocover
+    # after the "Serving on" lines; the options are alike for all sockets
+    for sock in socks:
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            options = listen_socket_options(sock)
+            if options:
+                print('Listen socket options: {}'.format(', '.join(options)))
+            return
+
+def create_dispatcher(adj):
+    """Create a task dispatcher with the threads requested by ``adj``."""
+    dispatcher = ThreadedTaskDispatcher()
+    if adj.max_threads is not None:
+        dispatcher.set_autoscale(
+            adj.min_threads, adj.max_threads, adj.thread_idle_timeout)
+    else:
+        dispatcher.set_thread_count(adj.threads)
+    dispatcher.max_queue_depth = adj.max_queue_depth
+    dispatcher.max_queue_wait = adj.max_queue_wait
+    return dispatcher
+
 def create_server(application,
                   map=None,
                   _start=True,      # test shim
@@ -49,12 +144,54 @@ def create_server(application,
     adj = Adjustments(**kw)
 
     if map is None: # pragma: nocover
-        map = {}
+        map = wasyncore.make_socket_map(adj.asyncore_use_selectors)
 
     dispatcher = _dispatcher
     if dispatcher is None:
-        dispatcher = ThreadedTaskDispatcher()
-        dispatcher.set_thread_count(adj.threads)
+        dispatcher = create_dispatcher(adj)
+
+    if adj.io_backend == 'asyncio':
+        from waitress.aio import create_asyncio_server
+        return create_asyncio_server(application, adj, dispatcher)
+
+    metrics = None
+    if adj.metrics_listen:
+        metrics = Metrics(adj.observer)
+        adj.observer = metrics
+        metrics.queue_depth.function = dispatcher.queue.qsize
+        dispatcher.metrics = metrics
+        # served by the (first) I/O loop, not by the task threads
+        MetricsServer(metrics, adj.metrics_listen[0], map,
+                      adj.channel_timeout)
+
+    if adj.sockets:
+        # Serve on sockets that somebody else bound and is listening on
+        # already (e.g. the pre-fork master in waitress.prefork).
+        effective_listen = []
+        last_serv = None
+        for sock in adj.sockets:
+            if hasattr(socket, 'AF_UNIX') and sock.family == socket.AF_UNIX:
+                server_class = UnixWSGIServer
+                sockinfo = (sock.family, sock.type, sock.proto, None)
+            else:
+                server_class = TcpWSGIServer
+                sockinfo = (sock.family, sock.type, sock.proto,
+                            sock.getsockname())
+            last_serv = server_class(
+                application,
+                map,
+                _start,
+                sock,
+                dispatcher=dispatcher,
+                adj=adj,
+                bind_socket=False,
+                sockinfo=sockinfo,
+                metrics=metrics)
+            effective_listen.append(
+                (last_serv.effective_host, last_serv.effective_port))
+        if len(adj.sockets) == 1:
+            return last_serv
+        return MultiSocketServer(map, adj, effective_listen, dispatcher)
 
     if adj.unix_socket and hasattr(socket, 'AF_UNIX'):
         sockinfo = (socket.AF_UNIX, socket.SOCK_STREAM, None, None)
@@ -65,24 +202,42 @@ def create_server(application,
             _sock,
             dispatcher=dispatcher,
             adj=adj,
-            sockinfo=sockinfo)
+            sockinfo=sockinfo,
+            metrics=metrics)
+
+    # One socket map per I/O loop; every loop gets its own listening socket
+    # for each address, all bound with SO_REUSEPORT.
+    loop_maps = [map]
+    for i in range(adj.io_loops - 1):
+        loop_maps.append(wasyncore.make_socket_map(adj.asyncore_use_selectors))
 
     effective_listen = []
     last_serv = None
     for sockinfo in adj.listen:
-        # When TcpWSGIServer is called, it registers itself in the map. This
-        # side-effect is all we need it for, so we don't store a reference to
-        # or return it to the user.
-        last_serv = TcpWSGIServer(
-            application,
-            map,
-            _start,
-            _sock,
-            dispatcher=dispatcher,
-            adj=adj,
-            sockinfo=sockinfo)
+        for loop_map in loop_maps:
+            # When TcpWSGIServer is called, it registers itself in the map.
+            # This side-effect is all we need it for, so we don't store a
+            # reference to or return it to the user.
+            last_serv = TcpWSGIServer(
+                application,
+                loop_map,
+                _start,
+                _sock,
+                dispatcher=dispatcher,
+                adj=adj,
+                sockinfo=sockinfo,
+                metrics=metrics)
+            # The other loops must bind the very same port, even if the
+            # OS picked it for us.
+            (family, socktype, proto, sockaddr) = sockinfo
+            sockaddr = ((sockaddr[0], last_serv.socket.getsockname()[1]) +
+                        tuple(sockaddr[2:]))
+            sockinfo = (family, socktype, proto, sockaddr)
         effective_listen.append((last_serv.effective_host, last_serv.effective_port))
 
+    if len(loop_maps) > 1:
+        return MultiLoopServer(loop_maps, adj, effective_listen, dispatcher)
+
     # We are running a single server, so we can just return the last server,
     # saves us from having to create one more object
     if len(adj.listen) == 1:
@@ -120,6 +275,11 @@ class MultiSocketServer(object):
                 l[0] = '[{}]'.format(l[0])
 
             print(format_str.format(*l))
+        print_listen_options(self.listen_sockets())
+
+    def listen_sockets(self):
+        return [server.socket for server in self.map.values()
+                if isinstance(server, BaseWSGIServer)]
 
     def run(self):
         try:
@@ -136,10 +296,66 @@ class MultiSocketServer(object):
         wasyncore.close_all(self.map)
 
 
+# This class is used when adj.io_loops > 1.  Each socket map is served by its
+# own wasyncore loop thread (the first one by the thread calling run()), and
+# the kernel spreads new connections between the SO_REUSEPORT listening
+# sockets of the loops.  All loops share a single task dispatcher.
+class MultiLoopServer(MultiSocketServer):
+    threading = threading # test shim
+
+    def __init__(self,
+                 maps=None,
+                 adj=None,
+                 effective_listen=None,
+                 dispatcher=None,
+                 ):
+        MultiSocketServer.__init__(
+            self, maps[0], adj, effective_listen, dispatcher)
+        self.maps = maps
+        self.loop_threads = []
+
+    def run_loop(self, map):
+        self.asyncore.loop(
+            timeout=self.adj.asyncore_loop_timeout,
+            map=map,
+            use_poll=self.adj.asyncore_use_poll,
+        )
+
+    def run(self):
+        for map in self.maps[1:]:
+            thread = self.threading.Thread(
+                target=self.run_loop, args=(map,), name='waitress-loop')
+            thread.daemon = True
+            thread.start()
+            self.loop_threads.append(thread)
+        try:
+            self.run_loop(self.map)
+        except (SystemExit, KeyboardInterrupt):
+            self.close()
+
+    def close(self):
+        self.task_dispatcher.shutdown()
+        for i, map in enumerate(self.maps[1:]):
+            thread = None
+            if i < len(self.loop_threads):
+                thread = self.loop_threads[i]
+            if thread is not None and thread.is_alive():
+                # Sockets must be closed by the thread polling them; once
+                # its map is empty the loop returns.
+                for obj in list(map.values()):
+                    if isinstance(obj, trigger.trigger):
+                        obj.pull_trigger(
+                            lambda map=map: wasyncore.close_all(map))
+                        break
+                thread.join(self.adj.asyncore_loop_timeout + 1)
+            else:
+                wasyncore.close_all(map)
+        wasyncore.close_all(self.map)
+
+
 class BaseWSGIServer(wasyncore.dispatcher, object):
 
     channel_class = HTTPChannel
-    next_channel_cleanup = 0
     socketmod = socket # test shim
     asyncore = wasyncore # test shim
 
@@ -151,6 +367,8 @@ class BaseWSGIServer(wasyncore.dispatcher, object):
                  dispatcher=None,  # dispatcher
                  adj=None,         # adjustments
                  sockinfo=None,    # opaque object
+                 bind_socket=True,
+                 metrics=None,     # waitress.metrics.Metrics
                  **kw
                  ):
         if adj is None:
@@ -159,7 +377,7 @@ class BaseWSGIServer(wasyncore.dispatcher, object):
             # use a nonglobal socket map by default to hopefully prevent
             # conflicts with apps and libs that use the wasyncore global socket
             # map ala https://github.com/Pylons/waitress/issues/63
-            map = {}
+            map = wasyncore.make_socket_map(adj.asyncore_use_selectors)
         if sockinfo is None:
             sockinfo = adj.listen[0]
 
@@ -168,10 +386,10 @@ class BaseWSGIServer(wasyncore.dispatcher, object):
         self.socktype = sockinfo[1]
         self.application = application
         self.adj = adj
+        self.metrics = metrics
         self.trigger = trigger.trigger(map)
         if dispatcher is None:
-            dispatcher = ThreadedTaskDispatcher()
-            dispatcher.set_thread_count(self.adj.threads)
+            dispatcher = create_dispatcher(self.adj)
 
         self.task_dispatcher = dispatcher
         self.asyncore.dispatcher.__init__(self, _sock, map=map)
@@ -180,11 +398,27 @@ class BaseWSGIServer(wasyncore.dispatcher, object):
             if self.family == socket.AF_INET6: # pragma: nocover
                 self.socket.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 1)
 
-        self.set_reuse_addr()
-        self.bind_server_socket()
+        if bind_socket:
+            self.set_reuse_addr()
+            self.bind_server_socket()
         self.effective_host, self.effective_port = self.getsockname()
         self.server_name = self.get_server_name(self.effective_host)
-        self.active_channels = {}
+        # copied into the environ of each request; see WSGITask
+        self.environ_template = environ_template(self)
+        # The channels connection_limit applies to: those of all the servers
+        # polled from map, but not the other dispatchers in it (triggers,
+        # the metrics server and its channels, ...)
+        for obj in map.values():
+            if isinstance(obj, BaseWSGIServer) and obj is not self:
+                self.active_channels = obj.active_channels
+                break
+        else:
+            self.active_channels = {}
+        # Channel idle timeouts are kept in a timer wheel with one-second
+        # slots, keyed by absolute second of compat.monotonic(); see
+        # maintenance()
+        self.expiry_slots = {}
+        self.expiry_cursor = int(monotonic())
         if _start:
             self.accept_connections()
 
@@ -235,11 +469,11 @@ class BaseWSGIServer(wasyncore.dispatcher, object):
         self.task_dispatcher.add_task(task)
 
     def readable(self):
-        now = time.time()
-        if now >= self.next_channel_cleanup:
-            self.next_channel_cleanup = now + self.adj.cleanup_interval
+        now = monotonic()
+        if now >= self.expiry_cursor or now < self.expiry_cursor - 1:
             self.maintenance(now)
-        return (self.accepting and len(self._map) < self.adj.connection_limit)
+        return (self.accepting and
+                len(self.active_channels) < self.adj.connection_limit)
 
     def writable(self):
         return False
@@ -251,23 +485,42 @@ class BaseWSGIServer(wasyncore.dispatcher, object):
         pass
 
     def handle_accept(self):
-        try:
-            v = self.accept()
-            if v is None:
+        # Drain up to accept_batch connections from the backlog, rather than
+        # going around the loop once for each during a connection storm,
+        # stopping at connection_limit (readable() then keeps the loop from
+        # looking at the listening socket until a channel is closed).
+        map = self._map
+        channels = self.active_channels
+        limit = self.adj.connection_limit
+        for i in range(self.adj.accept_batch):
+            try:
+                v = self.accept()
+                if v is None:
+                    # the backlog is empty
+                    return
+                conn, addr = v
+            except socket.error:
+                # Linux: On rare occasions we get a bogus socket back from
+                # accept.  socketmodule.c:makesockaddr complains that the
+                # address family is unknown.  We don't want the whole server
+                # to shut down because of this.
+                if self.metrics is not None:
+                    self.metrics.socket_errors.inc()
+                if self.adj.log_socket_errors:
+                    self.logger.warning('server accept() threw an exception',
+                                        exc_info=True)
+                return
+            if self.metrics is not None:
+                self.metrics.connections_accepted.inc()
+            # socket.accept() uses accept4(SOCK_CLOEXEC) where available,
+            # but cannot ask for SOCK_NONBLOCK; the channel relies on this
+            # being done here (see HTTPChannel.__init__)
+            conn.setblocking(False)
+            self.set_socket_options(conn)
+            addr = self.fix_addr(addr)
+            self.channel_class(self, conn, addr, self.adj, map=map)
+            if len(channels) >= limit:
                 return
-            conn, addr = v
-        except socket.error:
-            # Linux: On rare occasions we get a bogus socket back from
-            # accept.  socketmodule.c:makesockaddr complains that the
-            # address family is unknown.  We don't want the whole server
-            # to shut down because of this.
-            if self.adj.log_socket_errors:
-                self.logger.warning('server accept() threw an exception',
-                                    exc_info=True)
-            return
-        self.set_socket_options(conn)
-        addr = self.fix_addr(addr)
-        self.channel_class(self, conn, addr, self.adj, map=self._map)
 
     def run(self):
         try:
@@ -288,19 +541,102 @@ class BaseWSGIServer(wasyncore.dispatcher, object):
     def fix_addr(self, addr):
         return addr
 
+    def schedule_expiry(self, channel, when):
+        """
+        Arranges for ``maintenance`` to look at ``channel`` again once the
+        time ``when`` has passed.
+        """
+        slot = max(int(math.ceil(when)), self.expiry_cursor)
+        try:
+            self.expiry_slots[slot].add(channel)
+        except KeyError:
+            self.expiry_slots[slot] = set([channel])
+        channel.expiry_slot = slot
+
+    def cancel_expiry(self, channel):
+        slot = channel.expiry_slot
+        if slot is not None:
+            channel.expiry_slot = None
+            channels = self.expiry_slots.get(slot)
+            if channels is not None:
+                channels.discard(channel)
+
     def maintenance(self, now):
         """
         Closes channels that have not had any activity in a while.
 
         The timeout is configured through adj.channel_timeout (seconds).
+        A channel whose task is running is kept open, unless the task waits
+        for a streamed request body (see stream_request_body) that has
+        stopped arriving: the body is aborted, so that reading it raises
+        IOError in the task, and the channel is closed.
+        Only the channels whose timeout may have elapsed since the last call
+        are looked at.  Their ``last_activity`` is updated freely by the
+        channel and by task threads, so a channel that turns out to have
+        been active is simply scheduled again for its new deadline.
+
+        ``now`` is taken from ``compat.monotonic()``, which is only the wall
+        clock on Python 2; a jump of the clock costs one pass over the
+        scheduled channels, rather than one step per second jumped.
         """
-        cutoff = now - self.adj.channel_timeout
-        for channel in self.active_channels.values():
-            if (not channel.requests) and channel.last_activity < cutoff:
-                channel.will_close = True
+        timeout = self.adj.channel_timeout
+        slots = self.expiry_slots
+        tick = int(now)
+        cursor = self.expiry_cursor
+        if tick < cursor - 1:
+            # The clock was set back.  The deadlines are that much further
+            # away than they should be; count them from now instead.
+            channels = set()
+            for scheduled in slots.values():
+                channels.update(scheduled)
+            slots.clear()
+            self.expiry_cursor = tick
+            for channel in channels:
+                channel.last_activity = min(channel.last_activity, now)
+                self.schedule_expiry(channel, channel.last_activity + timeout)
+            return
+        if tick - cursor < len(slots):
+            due = range(cursor, tick + 1)
+        else:
+            # fewer channel slots than seconds elapsed
+            due = sorted(slot for slot in slots if slot <= tick)
+        self.expiry_cursor = tick + 1
+        for slot in due:
+            channels = slots.pop(slot, None)
+            if not channels:
+                continue
+            for channel in channels:
+                channel.expiry_slot = None
+                deadline = channel.last_activity + timeout
+                request = channel.request
+                if (request is not None and request.streaming and
+                        not request.body_stream.finished and
+                        not request.body_stream.full()):
+                    # The task is waiting for the rest of the body, which
+                    # counts as activity only as long as it keeps coming.
+                    if deadline <= now:
+                        request.body_stream.abort()
+                        self.expire(channel)
+                    else:
+                        self.schedule_expiry(channel, deadline)
+                    continue
+                if channel.requests:
+                    # A task is running; its completion counts as activity.
+                    self.schedule_expiry(channel, now + timeout)
+                    continue
+                if deadline <= now:
+                    self.expire(channel)
+                else:
+                    self.schedule_expiry(channel, deadline)
+
+    def expire(self, channel):
+        # closed once the loop finds it writable
+        channel.will_close = True
+        channel.interest_changed()
 
     def print_listen(self, format_str): # pragma: nocover
         print(format_str.format(self.effective_host, self.effective_port))
+        print_listen_options([self.socket])
 
     def close(self):
         self.trigger.close()
@@ -309,8 +645,18 @@ class BaseWSGIServer(wasyncore.dispatcher, object):
 
 class TcpWSGIServer(BaseWSGIServer):
 
+    def accept_connections(self):
+        # before listen(), which TCP_FASTOPEN must precede on some platforms
+        # (a socket listening already, from adj.sockets, gets them again)
+        set_listen_socket_options(self.socket, self.adj)
+        BaseWSGIServer.accept_connections(self)
+
     def bind_server_socket(self):
         (_, _, _, sockaddr) = self.sockinfo
+        if self.adj.io_loops > 1:
+            # let every I/O loop bind its own socket to this address
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.bind(sockaddr)
 
     def getsockname(self):
@@ -347,6 +693,7 @@ if hasattr(socket, 'AF_UNIX'):
                      dispatcher=None,  # dispatcher
                      adj=None,         # adjustments
                      sockinfo=None,    # opaque object
+                     bind_socket=True,
                      **kw):
             if sockinfo is None:
                 sockinfo = (socket.AF_UNIX, socket.SOCK_STREAM, None, None)
@@ -359,6 +706,7 @@ if hasattr(socket, 'AF_UNIX'):
                 dispatcher=dispatcher,
                 adj=adj,
                 sockinfo=sockinfo,
+                bind_socket=bind_socket,
                 **kw)
 
         def bind_server_socket(self):
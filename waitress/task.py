@@ -17,9 +17,14 @@ import sys
 import threading
 import time
 
+from collections import deque
+from operator import itemgetter
+
 from waitress.buffers import ReadOnlyFileBasedBuffer
+from waitress.parser import environ_keys
 
 from waitress.compat import (
+    monotonic,
     tobytes,
     Queue,
     Empty,
@@ -27,16 +32,12 @@ from waitress.compat import (
 )
 
 from waitress.utilities import (
-    build_http_date,
+    cached_http_date,
     logger,
     queue_logger,
+    ServiceUnavailable,
 )
 
-rename_headers = {  # or keep them without the HTTP_ prefix added
-    'CONTENT_LENGTH': 'CONTENT_LENGTH',
-    'CONTENT_TYPE': 'CONTENT_TYPE',
-}
-
 hop_by_hop = frozenset((
     'connection',
     'keep-alive',
@@ -48,6 +49,59 @@ hop_by_hop = frozenset((
     'upgrade'
 ))
 
+def canonical_header_name(name):
+    """Returns ``name`` with each of its dash separated words capitalized,
+    e.g. ``Content-Type`` for ``content-TYPE``."""
+    return '-'.join([x.capitalize() for x in name.split('-')])
+
+# How many header names and status lines the tables below may learn.
+response_cache_size = 1000
+
+# Header names, as applications spell them, to their canonical_header_name.
+# Names not listed here are added as they are seen.
+header_names = {}
+for name in (
+        'Accept-Ranges', 'Age', 'Allow', 'Cache-Control', 'Connection',
+        'Content-Disposition', 'Content-Encoding', 'Content-Language',
+        'Content-Length', 'Content-Location', 'Content-Range',
+        'Content-Security-Policy', 'Content-Type', 'Date', 'ETag', 'Expires',
+        'Last-Modified', 'Link', 'Location', 'Pragma', 'Retry-After',
+        'Server', 'Set-Cookie', 'Strict-Transport-Security',
+        'Transfer-Encoding', 'Vary', 'Via', 'WWW-Authenticate',
+        'X-Content-Type-Options', 'X-Frame-Options', 'X-XSS-Protection'):
+    for spelling in (name, name.lower(), canonical_header_name(name)):
+        header_names[spelling] = canonical_header_name(name)
+del name, spelling
+
+# (name, value) -> the header line, for lines many responses send as they
+# are.  The Server line of the server's ident is added when first sent.
+header_lines = dict(
+    (hv, tobytes('%s: %s\r\n' % hv)) for hv in (
+        ('Connection', 'close'),
+        ('Connection', 'Keep-Alive'),
+        ('Server', 'waitress'),
+        ('Transfer-Encoding', 'chunked'),
+    ))
+
+# (HTTP version, status) -> status line, added as they are seen
+status_lines = {}
+
+def environ_template(server):
+    """Returns the WSGI environ keys that are the same for every request to
+    ``server``, for WSGITask.get_environment to copy."""
+    return {
+        'SERVER_PORT': str(server.effective_port),
+        'SERVER_NAME': server.server_name,
+        'SERVER_SOFTWARE': server.adj.ident,
+        # the following environment variables are required by the WSGI spec
+        'wsgi.version': (1, 0),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': ReadOnlyFileBasedBuffer,
+        'wsgi.input_terminated': True, # wsgi.input is EOF terminated
+    }
+
 class JustTesting(Exception):
     pass
 
@@ -58,10 +112,33 @@ class ThreadedTaskDispatcher(object):
     logger = logger
     queue_logger = queue_logger
 
+    # Autoscaling bounds, see set_autoscale(); disabled while None.
+    min_threads = None
+    max_threads = None
+
+    # Seconds a thread waits for a task before the pool shrinks by one.
+    idle_timeout = 60
+
+    # A thread is added when a task has waited this many seconds in the
+    # queue, or when a task is queued behind others.
+    scale_up_wait = 0.1
+
+    # How many scaling decisions are kept in scale_events.
+    scale_events_kept = 100
+
+    # Admission control, see overloaded(); disabled while None.
+    max_queue_depth = None
+    max_queue_wait = None
+
+    # waitress.metrics.Metrics, counting the busy threads when set
+    metrics = None
+
     def __init__(self):
         self.threads = {} # { thread number -> 1 }
         self.queue = Queue()
         self.thread_mgmt_lock = threading.Lock()
+        # (time, thread count, reason) for recent autoscaling decisions
+        self.scale_events = deque(maxlen=self.scale_events_kept)
 
     def start_new_thread(self, target, args):
         t = threading.Thread(target=target, name='waitress', args=args)
@@ -72,10 +149,25 @@ class ThreadedTaskDispatcher(object):
         threads = self.threads
         try:
             while threads.get(thread_no):
-                task = self.queue.get()
+                if self.max_threads is None:
+                    task = self.queue.get()
+                else:
+                    try:
+                        task = self.queue.get(timeout=self.idle_timeout)
+                    except Empty:
+                        self.scale(-1, 'idle')
+                        continue
+                    queued_at = getattr(task, 'queued_at', None)
+                    if queued_at is not None:
+                        waited = time.time() - queued_at
+                        if waited > self.scale_up_wait:
+                            self.scale(1, 'queue wait %.3fs' % waited)
                 if task is None:
                     # Special value: kill this thread.
                     break
+                metrics = self.metrics
+                if metrics is not None:
+                    metrics.busy_threads.inc()
                 try:
                     task.service()
                 except Exception as e:
@@ -83,6 +175,9 @@ class ThreadedTaskDispatcher(object):
                         'Exception when servicing %r' % task)
                     if isinstance(e, JustTesting):
                         break
+                finally:
+                    if metrics is not None:
+                        metrics.busy_threads.dec()
         finally:
             with self.thread_mgmt_lock:
                 self.stop_count -= 1
@@ -109,20 +204,78 @@ class ThreadedTaskDispatcher(object):
                     self.queue.put(None)
                     running -= 1
 
+    def set_autoscale(self, min_threads, max_threads, idle_timeout=None):
+        """Let the number of threads follow the load between
+        ``min_threads`` and ``max_threads``, starting with
+        ``min_threads``."""
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        self.set_thread_count(min_threads)
+
+    def scale(self, step, reason):
+        """Add (``step`` = 1) or remove (-1) a thread within the autoscaling
+        bounds.  Returns the new thread count, or None if unchanged."""
+        min_threads, max_threads = self.min_threads, self.max_threads
+        if max_threads is None:
+            # not autoscaling, or shutting down
+            return None
+        with self.thread_mgmt_lock:
+            count = len(self.threads) - self.stop_count + step
+        if not min_threads <= count <= max_threads:
+            return None
+        # set_thread_count is idempotent, so two threads deciding on the
+        # same step at once only change the count once.
+        self.set_thread_count(count)
+        self.scale_events.append((time.time(), count, reason))
+        self.queue_logger.info(
+            'Task thread count is %d (%s)' % (count, reason))
+        return count
+
+    def overloaded(self, queue_depth):
+        """Returns True if a task should be rejected rather than queued
+        behind ``queue_depth`` others."""
+        if queue_depth == 0:
+            return False
+        max_depth = self.max_queue_depth
+        if max_depth is not None and queue_depth >= max_depth:
+            return True
+        max_wait = self.max_queue_wait
+        if max_wait is not None:
+            # The queue is FIFO, so its head has waited longest.
+            try:
+                head = self.queue.queue[0]
+            except IndexError: # pragma: no cover (emptied meanwhile)
+                return False
+            queued_at = getattr(head, 'queued_at', None)
+            if queued_at is not None and time.time() - queued_at > max_wait:
+                return True
+        return False
+
     def add_task(self, task):
         queue_depth = self.queue.qsize()
         if queue_depth > 0:
             self.queue_logger.warning(
                 "Task queue depth is %d" %
                 queue_depth)
+            if self.overloaded(queue_depth):
+                # e.g. HTTPChannel.reject answers with a 503
+                task.reject()
+                return
         try:
             task.defer()
+            if self.max_threads is not None or self.max_queue_wait is not None:
+                task.queued_at = time.time()
             self.queue.put(task)
         except:
             task.cancel()
             raise
+        if queue_depth > 0 and self.max_threads is not None:
+            self.scale(1, 'queue depth %d' % queue_depth)
 
     def shutdown(self, cancel_pending=True, timeout=5):
+        self.min_threads = self.max_threads = None
         self.set_thread_count(0)
         # Ensure the threads shut down.
         threads = self.threads
@@ -207,9 +360,13 @@ class Task(object):
         connection_close_header = None
 
         for (headername, headerval) in self.response_headers:
-            headername = '-'.join(
-                [x.capitalize() for x in headername.split('-')]
-            )
+            try:
+                headername = header_names[headername]
+            except KeyError:
+                name = headername
+                headername = canonical_header_name(name)
+                if len(header_names) < response_cache_size:
+                    header_names[name] = headername
 
             if headername == 'Content-Length':
                 if self.has_body:
@@ -277,25 +434,37 @@ class Task(object):
 
         if not server_header:
             if ident:
-                response_headers.append(('Server', ident))
+                hv = ('Server', ident)
+                response_headers.append(hv)
+                if hv not in header_lines:
+                    header_lines[hv] = tobytes('Server: %s\r\n' % ident)
         else:
             response_headers.append(('Via', ident or 'waitress'))
 
         if not date_header:
-            response_headers.append(('Date', build_http_date(self.start_time)))
+            response_headers.append(
+                ('Date', cached_http_date(self.start_time)))
 
         self.response_headers = response_headers
 
-        first_line = 'HTTP/%s %s' % (self.version, self.status)
+        key = (self.version, self.status)
+        try:
+            first_line = status_lines[key]
+        except KeyError:
+            first_line = tobytes('HTTP/%s %s\r\n' % key)
+            if len(status_lines) < response_cache_size:
+                status_lines[key] = first_line
+        lines = [first_line]
         # NB: sorting headers needs to preserve same-named-header order
-        # as per RFC 2616 section 4.2; thus the key=lambda x: x[0] here;
+        # as per RFC 2616 section 4.2; thus the key=itemgetter(0) here;
         # rely on stable sort to keep relative position of same-named headers
-        next_lines = ['%s: %s' % hv for hv in sorted(
-            self.response_headers, key=lambda x: x[0])]
-        lines = [first_line] + next_lines
-        res = '%s\r\n\r\n' % '\r\n'.join(lines)
-
-        return tobytes(res)
+        for hv in sorted(response_headers, key=itemgetter(0)):
+            line = header_lines.get(hv)
+            if line is None:
+                line = tobytes('%s: %s\r\n' % hv)
+            lines.append(line)
+        lines.append(b'\r\n')
+        return b''.join(lines)
 
     def remove_content_length_header(self):
         response_headers = []
@@ -309,6 +478,10 @@ class Task(object):
 
     def start(self):
         self.start_time = time.time()
+        observer = self.channel.adj.observer
+        if observer is not None:
+            self.request.started_at = monotonic()
+            observer.started(self)
 
     def finish(self):
         if not self.wrote_header:
@@ -316,6 +489,11 @@ class Task(object):
         if self.chunked_response:
             # not self.write, it will chunk it!
             self.channel.write_soon(b'0\r\n\r\n')
+        observer = self.channel.adj.observer
+        if observer is not None:
+            self.request.finished_at = monotonic()
+            observer.finished(self)
+            self.channel.track_flush(self)
 
     def write(self, data):
         if not self.complete:
@@ -331,9 +509,12 @@ class Task(object):
             towrite = data
             cl = self.content_length
             if self.chunked_response:
-                # use chunked encoding response
-                towrite = tobytes(hex(len(data))[2:].upper()) + b'\r\n'
-                towrite += data + b'\r\n'
+                # use chunked encoding response; the framing is queued
+                # separately so that data isn't copied just to frame it
+                channel.write_soon(
+                    tobytes(hex(len(data))[2:].upper()) + b'\r\n')
+                channel.write_soon(data)
+                towrite = b'\r\n'
             elif cl is not None:
                 towrite = data[:cl - self.content_bytes_written]
                 self.content_bytes_written += len(towrite)
@@ -344,6 +525,7 @@ class Task(object):
                     self.logged_write_excess = True
             if towrite:
                 channel.write_soon(towrite)
+            channel.wake_for_output()
         else:
             # Cheat, and tell the application we have written all of the bytes,
             # even though the response shouldn't have a body and we are
@@ -383,6 +565,43 @@ class ErrorTask(Task):
         self.close_on_finish = True
         self.write(tobytes(body))
 
+# (version, ident, retry_after) -> response parts, see
+# build_overloaded_response
+overloaded_responses = {}
+
+def build_overloaded_response(version, ident, retry_after):
+    """
+    Returns the ``503 Service Unavailable`` response sent for requests
+    rejected because the task queue is full, in the format of ErrorTask's
+    responses, as the bytes before and after the value of its Date header.
+    The connection is closed once it has been sent.
+    """
+    if version not in ('1.0', '1.1'):
+        # fall back to a version we support.
+        version = '1.0'
+    key = (version, ident, retry_after)
+    parts = overloaded_responses.get(key)
+    if parts is None:
+        e = ServiceUnavailable(
+            'The server is currently unable to handle the request due to '
+            'a temporary overload.')
+        body = '%s\r\n\r\n%s\r\n\r\n(generated by waitress)' % (
+            e.reason, e.body)
+        head = [
+            'HTTP/%s %s %s' % (version, e.code, e.reason),
+            'Connection: close',
+            'Content-Length: %d' % len(body),
+            'Content-Type: text/plain',
+            'Date: ',
+        ]
+        tail = ['', 'Retry-After: %d' % retry_after]
+        if ident:
+            tail.append('Server: %s' % ident)
+        tail.append('\r\n' + body)
+        parts = (tobytes('\r\n'.join(head)), tobytes('\r\n'.join(tail)))
+        overloaded_responses[key] = parts
+    return parts
+
 class WSGITask(Task):
     """A WSGI task produces a response from a WSGI application.
     """
@@ -542,19 +761,19 @@ class WSGITask(Task):
                 if path.startswith(url_prefix_with_trailing_slash):
                     path = path[len(url_prefix):]
 
-        environ = {}
+        environ = server.environ_template.copy()
+        # looked up per request: sys.stderr may be replaced after startup
+        environ['wsgi.errors'] = sys.stderr # apps should use the logging module
         environ['REQUEST_METHOD'] = request.command.upper()
-        environ['SERVER_PORT'] = str(server.effective_port)
-        environ['SERVER_NAME'] = server.server_name
-        environ['SERVER_SOFTWARE'] = server.adj.ident
         environ['SERVER_PROTOCOL'] = 'HTTP/%s' % self.version
         environ['SCRIPT_NAME'] = url_prefix
         environ['PATH_INFO'] = path
         environ['QUERY_STRING'] = request.query
         host = environ['REMOTE_ADDR'] = channel.addr[0]
 
-        headers = dict(request.headers)
+        headers = request.headers
         if host == server.adj.trusted_proxy:
+            headers = dict(headers)
             wsgi_url_scheme = headers.pop('X_FORWARDED_PROTO',
                                           request.url_scheme)
         else:
@@ -562,23 +781,17 @@ class WSGITask(Task):
         if wsgi_url_scheme not in ('http', 'https'):
             raise ValueError('Invalid X_FORWARDED_PROTO value')
         for key, value in headers.items():
-            value = value.strip()
-            mykey = rename_headers.get(key, None)
-            if mykey is None:
-                mykey = 'HTTP_%s' % key
+            try:
+                mykey = environ_keys[key]
+            except KeyError:
+                # a header the parser had no room left to learn
+                mykey = 'HTTP_' + key
             if mykey not in environ:
-                environ[mykey] = value
+                environ[mykey] = value.strip()
 
-        # the following environment variables are required by the WSGI spec
-        environ['wsgi.version'] = (1, 0)
         environ['wsgi.url_scheme'] = wsgi_url_scheme
-        environ['wsgi.errors'] = sys.stderr # apps should use the logging module
-        environ['wsgi.multithread'] = True
-        environ['wsgi.multiprocess'] = False
-        environ['wsgi.run_once'] = False
         environ['wsgi.input'] = request.get_body_stream()
-        environ['wsgi.file_wrapper'] = ReadOnlyFileBasedBuffer
-        environ['wsgi.input_terminated'] = True # wsgi.input is EOF terminated
+        environ['waitress.input_view'] = request.get_body_view
 
         self.environ = environ
         return environ
@@ -0,0 +1,116 @@
+import asyncio
+import io
+
+def wrap(wsgi_app): # pragma: no cover
+    """Runs a WSGI fixture application as an ASGI application, so that the
+    functional tests written for WSGI also cover asgi=True."""
+    if asyncio.iscoroutinefunction(wsgi_app):
+        return wsgi_app
+
+    async def app(scope, receive, send):
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope['root_path'],
+            'PATH_INFO': scope['path'],
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_PROTOCOL': 'HTTP/' + scope['http_version'],
+            'wsgi.url_scheme': scope['scheme'],
+            'wsgi.input': io.BytesIO(b''.join(body)),
+        }
+        for name, value in scope['headers']:
+            key = name.decode('latin-1').upper().replace('-', '_')
+            if key not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+                key = 'HTTP_' + key
+            environ[key] = value.decode('latin-1')
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return written.append
+
+        written = []
+        app_iter = wsgi_app(environ, start_response)
+        try:
+            for chunk in app_iter:
+                written.append(chunk)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        status, headers = response
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split()[0]),
+            'headers': [
+                (name.encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': b''.join(written)})
+
+    return app
+
+async def app(scope, receive, send): # pragma: no cover
+    path = scope['path']
+    if path == '/stream':
+        # a chunk at a time, with the loop free in between
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/plain')]})
+        for i in range(3):
+            await send({'type': 'http.response.body',
+                        'body': ('chunk%d\n' % i).encode('ascii'),
+                        'more_body': True})
+            await asyncio.sleep(0.01)
+        await send({'type': 'http.response.body'})
+    elif path == '/wait':
+        # a long poll, answered once another request to /release is made
+        release = app.release = asyncio.Event()
+        await release.wait()
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-length', b'8')]})
+        await send({'type': 'http.response.body', 'body': b'released'})
+    elif path == '/error':
+        raise ValueError('error')
+    elif path == '/error_after_start':
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': []})
+        await send({'type': 'http.response.body', 'body': b'ab',
+                    'more_body': True})
+        raise ValueError('error')
+    elif path == '/release':
+        app.release.set()
+        await send({'type': 'http.response.start', 'status': 204,
+                    'headers': []})
+        await send({'type': 'http.response.body'})
+    else:
+        body = ('%s %s' % (scope['method'], path)).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-length',
+                                 str(len(body)).encode('ascii'))]})
+        await send({'type': 'http.response.body', 'body': body})
+
+# applications of the ASGIChannel unit tests, kept here so that
+# test_aio may be imported by Python 2
+
+async def ok(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-length', b'2')]})
+    await send({'type': 'http.response.body', 'body': b'ok'})
+
+async def short(scope, receive, send):
+    # fewer bytes than its Content-Length
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-length', b'4')]})
+    await send({'type': 'http.response.body', 'body': b'ok'})
+
+async def silent(scope, receive, send):
+    pass
+
+async def receive_until_disconnect(scope, receive, send):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
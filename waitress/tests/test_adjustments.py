@@ -1,5 +1,6 @@
 import sys
 import socket
+import warnings
 
 from waitress.compat import (
     PY2,
@@ -90,7 +91,6 @@ class TestAdjustments(unittest.TestCase):
             outbuf_overflow='400',
             inbuf_overflow='500',
             connection_limit='1000',
-            cleanup_interval='1100',
             channel_timeout='1200',
             log_socket_errors='true',
             max_request_header_size='1300',
@@ -99,6 +99,7 @@ class TestAdjustments(unittest.TestCase):
             ident='abc',
             asyncore_loop_timeout='5',
             asyncore_use_poll=True,
+            asyncore_use_selectors='true',
             unix_socket='/tmp/waitress.sock',
             unix_socket_perms='777',
             url_prefix='///foo/',
@@ -117,7 +118,6 @@ class TestAdjustments(unittest.TestCase):
         self.assertEqual(inst.outbuf_overflow, 400)
         self.assertEqual(inst.inbuf_overflow, 500)
         self.assertEqual(inst.connection_limit, 1000)
-        self.assertEqual(inst.cleanup_interval, 1100)
         self.assertEqual(inst.channel_timeout, 1200)
         self.assertEqual(inst.log_socket_errors, True)
         self.assertEqual(inst.max_request_header_size, 1300)
@@ -125,6 +125,7 @@ class TestAdjustments(unittest.TestCase):
         self.assertEqual(inst.expose_tracebacks, True)
         self.assertEqual(inst.asyncore_loop_timeout, 5)
         self.assertEqual(inst.asyncore_use_poll, True)
+        self.assertEqual(inst.asyncore_use_selectors, True)
         self.assertEqual(inst.ident, 'abc')
         self.assertEqual(inst.unix_socket, '/tmp/waitress.sock')
         self.assertEqual(inst.unix_socket_perms, 0o777)
@@ -219,6 +220,179 @@ class TestAdjustments(unittest.TestCase):
     def test_ipv6_disabled(self):
         self.assertRaises(ValueError, self._makeOne, ipv6=False, listen="[::]:8080")
 
+    def test_io_loops(self):
+        inst = self._makeOne(io_loops='2')
+        self.assertEqual(inst.io_loops, 2)
+
+    def test_accept_batch(self):
+        inst = self._makeOne(accept_batch='64')
+        self.assertEqual(inst.accept_batch, 64)
+
+    def test_accept_batch_zero(self):
+        self.assertRaises(ValueError, self._makeOne, accept_batch='0')
+
+    def test_listen_options(self):
+        inst = self._makeOne(tcp_defer_accept='5', tcp_fastopen='256')
+        self.assertEqual(inst.tcp_defer_accept, 5)
+        self.assertEqual(inst.tcp_fastopen, 256)
+
+    def test_listen_options_negative(self):
+        self.assertRaises(ValueError, self._makeOne, tcp_fastopen='-1')
+
+    @unittest.skipIf(PY2, 'asyncio requires Python 3')
+    def test_io_backend(self):
+        inst = self._makeOne(io_backend='asyncio')
+        self.assertEqual(inst.io_backend, 'asyncio')
+
+    @unittest.skipIf(not PY2, 'asyncio requires Python 3')
+    def test_io_backend_asyncio_on_python2(self):
+        try:
+            self._makeOne(io_backend='asyncio')
+        except ValueError as e:
+            self.assertEqual(str(e), 'io_backend asyncio requires Python 3.')
+        else: # pragma: no cover
+            self.fail('ValueError not raised')
+
+    def test_io_backend_unknown(self):
+        self.assertRaises(ValueError, self._makeOne, io_backend='gevent')
+
+    def test_io_backend_asyncio_with_io_loops(self):
+        self.assertRaises(ValueError, self._makeOne, io_backend='asyncio',
+                          io_loops=2)
+
+    def test_io_backend_asyncio_with_metrics_listen(self):
+        self.assertRaises(ValueError, self._makeOne, io_backend='asyncio',
+                          metrics_listen='127.0.0.1:9100')
+
+    @unittest.skipIf(PY2, 'asyncio requires Python 3')
+    def test_asgi(self):
+        inst = self._makeOne(asgi='true', io_backend='asyncio')
+        self.assertEqual(inst.asgi, True)
+
+    def test_asgi_without_asyncio(self):
+        self.assertRaises(ValueError, self._makeOne, asgi=True)
+
+    def test_asgi_with_pipeline_depth(self):
+        self.assertRaises(ValueError, self._makeOne, asgi=True,
+                          io_backend='asyncio', pipeline_depth=2)
+
+    def test_asgi_with_stream_request_body(self):
+        self.assertRaises(ValueError, self._makeOne, asgi=True,
+                          io_backend='asyncio', stream_request_body=True)
+
+    def test_outbuf_watermarks(self):
+        inst = self._makeOne(outbuf_high_watermark='65536',
+                             outbuf_low_watermark='16384')
+        self.assertEqual(inst.outbuf_high_watermark, 65536)
+        self.assertEqual(inst.outbuf_low_watermark, 16384)
+
+    def test_pipeline_depth(self):
+        inst = self._makeOne(pipeline_depth='4')
+        self.assertEqual(inst.pipeline_depth, 4)
+
+    def test_io_loops_with_unix_socket(self):
+        self.assertRaises(ValueError, self._makeOne, io_loops=2,
+                          unix_socket='/tmp/waitress.sock')
+
+    def test_max_threads(self):
+        inst = self._makeOne(threads='2', max_threads='8',
+                             thread_idle_timeout='10')
+        self.assertEqual(inst.min_threads, 2)
+        self.assertEqual(inst.max_threads, 8)
+        self.assertEqual(inst.thread_idle_timeout, 10)
+
+    def test_min_threads(self):
+        inst = self._makeOne(min_threads='1', max_threads='8')
+        self.assertEqual(inst.min_threads, 1)
+
+    def test_min_threads_without_max_threads(self):
+        self.assertRaises(ValueError, self._makeOne, min_threads=1)
+
+    def test_min_threads_greater_than_max_threads(self):
+        self.assertRaises(ValueError, self._makeOne, min_threads=4,
+                          max_threads=2)
+        self.assertRaises(ValueError, self._makeOne, threads=4,
+                          max_threads=2)
+        self.assertRaises(ValueError, self._makeOne, min_threads=0,
+                          max_threads=2)
+
+    def test_bad_thread_idle_timeout(self):
+        self.assertRaises(ValueError, self._makeOne, max_threads=2,
+                          thread_idle_timeout=0)
+
+    def test_admission_control(self):
+        inst = self._makeOne(max_queue_depth='100', max_queue_wait='0.5',
+                             overload_retry_after='10')
+        self.assertEqual(inst.max_queue_depth, 100)
+        self.assertEqual(inst.max_queue_wait, 0.5)
+        self.assertEqual(inst.overload_retry_after, 10)
+
+    def test_max_queue_depth_zero(self):
+        self.assertRaises(ValueError, self._makeOne, max_queue_depth='0')
+
+    def test_cleanup_interval_deprecated(self):
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            inst = self._makeOne(cleanup_interval='1100')
+        self.assertEqual(inst.cleanup_interval, 1100)
+        self.assertEqual(len(w), 1)
+        self.assertTrue(issubclass(w[0].category, DeprecationWarning))
+        self.assertTrue('cleanup_interval' in str(w[0].message))
+
+    def test_cleanup_interval_default_no_warning(self):
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            self._makeOne()
+        self.assertEqual(w, [])
+
+    def test_metrics_listen(self):
+        inst = self._makeOne(metrics_listen='127.0.0.1:9100')
+        self.assertEqual(len(inst.metrics_listen), 1)
+        self.assertEqual(inst.metrics_listen[0][3], ('127.0.0.1', 9100))
+
+    def test_metrics_listen_with_sockets(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.assertRaises(ValueError, self._makeOne, sockets=[sock],
+                              metrics_listen='127.0.0.1:9100')
+        finally:
+            sock.close()
+
+    def test_observer(self):
+        observer = object()
+        inst = self._makeOne(observer=observer)
+        self.assertTrue(inst.observer is observer)
+
+    def test_sockets(self):
+        sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM),
+                   socket.socket(socket.AF_INET, socket.SOCK_STREAM)]
+        try:
+            inst = self._makeOne(sockets=sockets + ['notasocket'])
+            self.assertEqual(inst.sockets, sockets)
+        finally:
+            for sock in sockets:
+                sock.close()
+
+    def test_sockets_with_listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.assertRaises(ValueError, self._makeOne, sockets=[sock],
+                              listen='127.0.0.1:8080')
+            self.assertRaises(ValueError, self._makeOne, sockets=[sock],
+                              port='8080')
+            self.assertRaises(ValueError, self._makeOne, sockets=[sock],
+                              unix_socket='/tmp/waitress.sock')
+        finally:
+            sock.close()
+
+    def test_sockets_with_io_loops(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.assertRaises(ValueError, self._makeOne, sockets=[sock],
+                              io_loops=2)
+        finally:
+            sock.close()
+
     def test_server_header_removable(self):
         inst = self._makeOne(ident=None)
         self.assertEqual(inst.ident, None)
@@ -300,6 +474,20 @@ class TestCLI(unittest.TestCase):
             }, opts)
         self.assertSequenceEqual(args, [])
 
+    def test_workers(self):
+        opts, args = self.parse(['--workers=4'])
+        self.assertDictEqual(
+            opts, {'call': False, 'help': False, 'workers': '4'})
+        self.assertSequenceEqual(args, [])
+
+    def test_sockets_not_an_option(self):
+        import getopt
+        self.assertRaises(getopt.GetoptError, self.parse, ['--sockets=3'])
+
+    def test_observer_not_an_option(self):
+        import getopt
+        self.assertRaises(getopt.GetoptError, self.parse, ['--observer=foo'])
+
     def test_bad_param(self):
         import getopt
         self.assertRaises(getopt.GetoptError, self.parse, ['--no-host'])
@@ -0,0 +1,857 @@
+import socket
+import threading
+import unittest
+
+from waitress.compat import PY2
+
+dummy_app = object()
+
+@unittest.skipIf(PY2, 'asyncio requires Python 3')
+class TestAsyncioWSGIServer(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from waitress.adjustments import Adjustments
+        from waitress.aio import AsyncioWSGIServer
+        adj = Adjustments(**kw)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        return AsyncioWSGIServer(
+            dummy_app, self.sock, adj, DummyTaskDispatcher())
+
+    def tearDown(self):
+        self.sock.close()
+
+    def test_ctor(self):
+        inst = self._makeOne()
+        self.assertEqual(inst.effective_host, '127.0.0.1')
+        self.assertEqual(inst.effective_port, str(self.sock.getsockname()[1]))
+        self.assertEqual(inst.servers, [inst])
+        self.assertEqual(inst.map, {})
+
+    def test_attach(self):
+        inst = self._makeOne()
+        loop = DummyLoop()
+        inst.attach(loop)
+        self.assertTrue(inst.accepting)
+        self.assertEqual(loop.readers, {self.sock: inst.handle_accept})
+        self.assertEqual(loop.later, [(1, inst.tick)])
+
+    def test_update_accepting_connection_limit(self):
+        inst = self._makeOne(connection_limit=2)
+        loop = DummyLoop()
+        inst.attach(loop)
+        inst.starting = 1
+        inst.map[1] = None
+        inst.update_accepting()
+        self.assertFalse(inst.accepting)
+        self.assertEqual(loop.readers, {})
+        inst.starting = 0
+        inst.update_accepting()
+        self.assertTrue(inst.accepting)
+        self.assertEqual(loop.readers, {self.sock: inst.handle_accept})
+
+    def _connectClients(self, inst, count):
+        clients = [socket.create_connection(self.sock.getsockname())
+                   for i in range(count)]
+        for client in clients:
+            self.addCleanup(client.close)
+        connected = []
+        def connect(conn, addr):
+            self.addCleanup(conn.close)
+            connected.append(addr)
+            inst.map[len(inst.map)] = conn
+            inst.update_accepting()
+        inst.connect = connect
+        return connected
+
+    def test_handle_accept_batch(self):
+        inst = self._makeOne(accept_batch=2)
+        inst.attach(DummyLoop())
+        connected = self._connectClients(inst, 3)
+        inst.handle_accept()
+        self.assertEqual(len(connected), 2)
+        inst.handle_accept()
+        self.assertEqual(len(connected), 3)
+        inst.handle_accept()
+        self.assertEqual(len(connected), 3)
+
+    def test_handle_accept_stops_at_connection_limit(self):
+        inst = self._makeOne(connection_limit=2)
+        loop = DummyLoop()
+        inst.attach(loop)
+        connected = self._connectClients(inst, 3)
+        inst.handle_accept()
+        self.assertEqual(len(connected), 2)
+        self.assertFalse(inst.accepting)
+        self.assertEqual(loop.readers, {})
+
+    def test_handle_accept_error(self):
+        import errno
+        inst = self._makeOne()
+        inst.attach(DummyLoop())
+        inst.logger = DummyLogger()
+        inst.socket = DummyListeningSock(errno.EMFILE)
+        inst.handle_accept()
+        self.assertEqual(len(inst.logger.warnings), 1)
+        inst.socket = DummyListeningSock(errno.EWOULDBLOCK)
+        inst.handle_accept()
+        self.assertEqual(len(inst.logger.warnings), 1)
+        inst.socket = self.sock
+
+    def test_accepted_failed(self):
+        inst = self._makeOne()
+        inst.attach(DummyLoop())
+        inst.starting = 1
+        conn = DummySock()
+        inst.accepted(DummyFuture(exception=OSError()), conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(inst.starting, 0)
+
+    def test_accepted_succeeded(self):
+        inst = self._makeOne()
+        inst.attach(DummyLoop())
+        inst.starting = 0
+        conn = DummySock()
+        inst.accepted(DummyFuture(), conn)
+        self.assertFalse(conn.closed)
+
+    def test_pull_trigger_once(self):
+        inst = self._makeOne()
+        loop = DummyLoop()
+        inst.attach(loop)
+        inst.pull_trigger()
+        inst.pull_trigger()
+        self.assertEqual(loop.threadsafe, [inst.triggered])
+
+    def test_triggered(self):
+        inst = self._makeOne()
+        loop = DummyLoop()
+        inst.attach(loop)
+        inst.pull_trigger()
+        busy = DummyChannel(requests=[None])
+        idle = DummyChannel()
+        inst.busy_channels.update((busy, idle))
+        inst.triggered()
+        self.assertFalse(inst.pulled)
+        self.assertTrue(busy.polled)
+        self.assertTrue(idle.polled)
+        self.assertEqual(inst.busy_channels, set([busy]))
+
+    def test_triggered_task_done_while_polling(self):
+        from waitress.aio import AsyncioChannel
+        inst = self._makeOne()
+        inst.attach(DummyLoop())
+        transport = DummyTransport()
+        self.addCleanup(transport.sock.close)
+        channel = AsyncioChannel(
+            inst, transport, ('127.0.0.1', 1), inst.adj, inst.map)
+        channel.data_received(b'GET / HTTP/1.1\r\n\r\n')
+        channel.data_received(b'GET /next HTTP/1.1\r\n\r\n')
+        self.assertEqual(channel.pending, b'GET /next HTTP/1.1\r\n\r\n')
+        poll = channel.poll
+        def poll_then_finish():
+            poll()
+            # the task thread empties requests once poll() has looked
+            channel.requests = []
+            channel.poll = poll
+        channel.poll = poll_then_finish
+        inst.triggered()
+        self.assertTrue(channel in inst.busy_channels)
+        inst.triggered()
+        self.assertEqual(channel.pending, b'')
+        self.assertEqual(channel.requests[0].path, '/next')
+
+    def test_channel_pull_trigger(self):
+        from waitress.aio import AsyncioChannel
+        inst = self._makeOne()
+        loop = DummyLoop()
+        inst.attach(loop)
+        transport = DummyTransport()
+        self.addCleanup(transport.sock.close)
+        channel = AsyncioChannel(
+            inst, transport, ('127.0.0.1', 1), inst.adj, inst.map)
+        channel.pull_trigger()
+        self.assertEqual(inst.busy_channels, set([channel]))
+        self.assertEqual(loop.threadsafe, [inst.triggered])
+
+    def test_tick(self):
+        inst = self._makeOne()
+        loop = DummyLoop()
+        inst.attach(loop)
+        inst.expiry_cursor = 0
+        inst.tick()
+        self.assertTrue(inst.expiry_cursor > 1)
+        self.assertEqual(loop.later, [(1, inst.tick), (1, inst.tick)])
+
+    def test_expire(self):
+        inst = self._makeOne()
+        channel = DummyChannel()
+        inst.expire(channel)
+        self.assertTrue(channel.will_close)
+        self.assertTrue(channel.polled)
+
+    def test_close(self):
+        inst = self._makeOne()
+        loop = DummyLoop()
+        inst.attach(loop)
+        channel = DummyChannel()
+        inst.active_channels[1] = channel
+        inst.close()
+        self.assertEqual(loop.readers, {})
+        self.assertEqual(inst.socket, None)
+        self.assertTrue(inst.task_dispatcher.was_shutdown)
+        self.assertTrue(channel.closed)
+
+@unittest.skipIf(PY2, 'asyncio requires Python 3')
+class TestAsyncioChannel(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from waitress.adjustments import Adjustments
+        from waitress.aio import AsyncioChannel
+        server = DummyServer(Adjustments(**kw))
+        self.transport = DummyTransport()
+        self.map = {}
+        return AsyncioChannel(
+            server, self.transport, ('127.0.0.1', 1), server.adj, self.map)
+
+    def tearDown(self):
+        self.transport.sock.close()
+
+    def test_ctor(self):
+        inst = self._makeOne()
+        self.assertTrue(inst.connected)
+        self.assertEqual(self.map, {inst._fileno: inst})
+
+    def test_data_received(self):
+        inst = self._makeOne()
+        inst.data_received(b'GET / HTTP/1.1\r\n\r\n')
+        self.assertTrue(inst in inst.server.busy_channels)
+        self.assertEqual(len(inst.server.tasks), 1)
+        # not read until the task is done
+        self.assertTrue(inst.read_paused)
+        self.assertEqual(self.transport.paused, True)
+        inst.data_received(b'GET /next HTTP/1.1\r\n\r\n')
+        self.assertEqual(inst.pending, b'GET /next HTTP/1.1\r\n\r\n')
+        self.assertEqual(len(inst.server.tasks), 1)
+
+    def test_poll_parses_pending_and_resumes(self):
+        inst = self._makeOne()
+        inst.data_received(b'GET / HTTP/1.1\r\n\r\n')
+        inst.data_received(b'GET /next HTTP/1.1\r\n\r\n')
+        self.assertTrue(inst.read_paused)
+        # the first task is done
+        inst.requests = []
+        inst.poll()
+        self.assertEqual(inst.pending, b'')
+        self.assertEqual(len(inst.server.tasks), 2)
+        self.assertEqual(inst.requests[0].path, '/next')
+        self.assertTrue(inst.read_paused)
+        inst.requests = []
+        inst.poll()
+        self.assertFalse(inst.read_paused)
+        self.assertEqual(self.transport.paused, False)
+
+    def test_protocol_connection_made(self):
+        from waitress.adjustments import Adjustments
+        from waitress.aio import AsyncioChannel, ChannelProtocol
+        server = DummyServer(Adjustments())
+        server.channel_class = AsyncioChannel
+        server.map = {}
+        server.starting = 1
+        protocol = ChannelProtocol(server, ('127.0.0.1', 1))
+        self.transport = DummyTransport()
+        protocol.connection_made(self.transport)
+        self.assertEqual(server.starting, 0)
+        channel = protocol.channel
+        self.assertEqual(channel.addr, ('127.0.0.1', 1))
+        self.assertEqual(server.map, {channel._fileno: channel})
+        protocol.data_received(b'GET / HTTP/1.1\r\n\r\n')
+        self.assertEqual(server.tasks, [channel])
+
+    def test_poll_flushes_and_resumes(self):
+        inst = self._makeOne()
+        inst.read_paused = True
+        inst.write_soon(b'abc')
+        inst.poll()
+        self.assertEqual(self.transport.written, [b'abc'])
+        self.assertFalse(inst.read_paused)
+        self.assertEqual(self.transport.paused, False)
+
+    def test_send_write_paused(self):
+        inst = self._makeOne()
+        inst.write_paused = True
+        self.assertEqual(inst.send(b'abc'), 0)
+        self.assertEqual(inst.sendmsg([b'abc']), 0)
+        self.assertEqual(self.transport.written, [])
+
+    def test_sendmsg(self):
+        inst = self._makeOne()
+        self.assertEqual(inst.sendmsg([b'ab', b'c']), 3)
+        self.assertEqual(self.transport.written, [b'ab', b'c'])
+
+    def test_flush_some_if_lockable_locked(self):
+        inst = self._makeOne()
+        inst.loop = DummyLoop()
+        # held by a task thread
+        acquired = threading.Event()
+        release = threading.Event()
+        def hold():
+            with inst.outbuf_lock:
+                acquired.set()
+                release.wait()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait()
+        try:
+            inst._flush_some_if_lockable()
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(inst.loop.soon, [inst.poll])
+
+    def test_connection_lost(self):
+        from waitress.aio import ChannelProtocol
+        inst = self._makeOne()
+        protocol = ChannelProtocol(inst.server, None)
+        protocol.channel = inst
+        inst.server.busy_channels.add(inst)
+        protocol.connection_lost(None)
+        self.assertFalse(inst.connected)
+        self.assertEqual(self.map, {})
+        self.assertEqual(inst.server.busy_channels, set())
+        self.assertTrue(self.transport.closed)
+
+    def test_pause_resume_writing(self):
+        from waitress.aio import ChannelProtocol
+        inst = self._makeOne()
+        protocol = ChannelProtocol(inst.server, None)
+        protocol.channel = inst
+        protocol.pause_writing()
+        inst.write_soon(b'abc')
+        inst.poll()
+        self.assertEqual(self.transport.written, [])
+        protocol.resume_writing()
+        self.assertEqual(self.transport.written, [b'abc'])
+
+@unittest.skipIf(PY2, 'asyncio requires Python 3')
+class TestASGIChannel(unittest.TestCase):
+
+    def setUp(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.transport.sock.close()
+        self.loop.close()
+
+    def _makeOne(self, app=None, **kw):
+        from waitress.adjustments import Adjustments
+        from waitress.aio import ASGIChannel
+        server = DummyServer(Adjustments(**kw))
+        server.loop = self.loop
+        server.application = app
+        self.transport = DummyTransport()
+        return ASGIChannel(
+            server, self.transport, ('127.0.0.1', 5), server.adj, {})
+
+    def _makeTask(self, inst, data):
+        from waitress.parser import HTTPRequestParser
+        request = HTTPRequestParser(inst.adj)
+        while data and not request.completed:
+            data = data[request.received(data):]
+        return inst.task_class(inst, request)
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def _written(self):
+        return b''.join(bytes(data) for data in self.transport.written)
+
+    def test_get_scope(self):
+        inst = self._makeOne(url_prefix='/app')
+        inst.server.effective_host = '127.0.0.1'
+        inst.server.effective_port = '8080'
+        task = self._makeTask(
+            inst, b'POST /caf%C3%A9?a=1 HTTP/1.1\r\nX-Foo: bar\r\n'
+                  b'Content-Type: text/plain\r\n\r\n')
+        scope = task.get_scope()
+        self.assertEqual(scope['type'], 'http')
+        self.assertEqual(scope['asgi']['version'], '3.0')
+        self.assertEqual(scope['http_version'], '1.1')
+        self.assertEqual(scope['method'], 'POST')
+        self.assertEqual(scope['scheme'], 'http')
+        self.assertEqual(scope['path'], u'/caf\xe9')
+        self.assertEqual(scope['query_string'], b'a=1')
+        self.assertEqual(scope['root_path'], '/app')
+        self.assertEqual(sorted(scope['headers']), [
+            (b'content-type', b'text/plain'), (b'x-foo', b'bar')])
+        self.assertEqual(scope['client'], ('127.0.0.1', 5))
+        self.assertEqual(scope['server'], ('127.0.0.1', 8080))
+        self.assertTrue(task.get_scope() is scope)
+
+    def test_get_scope_trusted_proxy(self):
+        inst = self._makeOne(trusted_proxy='127.0.0.1')
+        inst.server.effective_host = '127.0.0.1'
+        task = self._makeTask(
+            inst, b'GET / HTTP/1.1\r\nX-Forwarded-Proto: https\r\n\r\n')
+        scope = task.get_scope()
+        self.assertEqual(scope['scheme'], 'https')
+        self.assertEqual(scope['headers'], [])
+
+    def test_get_scope_bad_proxy_scheme(self):
+        inst = self._makeOne(trusted_proxy='127.0.0.1')
+        task = self._makeTask(
+            inst, b'GET / HTTP/1.1\r\nX-Forwarded-Proto: ftp\r\n\r\n')
+        self.assertRaises(ValueError, task.get_scope)
+
+    def test_get_scope_unix_socket(self):
+        inst = self._makeOne()
+        inst.addr = ('localhost', None)
+        inst.server.effective_port = '/tmp/waitress.sock'
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        scope = task.get_scope()
+        self.assertEqual(scope['client'], None)
+        self.assertEqual(scope['server'], ('/tmp/waitress.sock', None))
+
+    def test_receive(self):
+        inst = self._makeOne(inbuf_overflow=4)
+        task = self._makeTask(
+            inst, b'POST / HTTP/1.1\r\nContent-Length: 6\r\n\r\nabcdef')
+        self.assertEqual(self._run(task.receive()), {
+            'type': 'http.request', 'body': b'abcd', 'more_body': True})
+        self.assertEqual(self._run(task.receive()), {
+            'type': 'http.request', 'body': b'ef', 'more_body': False})
+        # then only the client going away is left
+        self.loop.call_soon(inst.handle_close)
+        self.assertEqual(self._run(task.receive()),
+                         {'type': 'http.disconnect'})
+
+    def test_receive_waits_for_disconnect(self):
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        self._run(task.receive())
+        self.loop.call_later(0.01, inst.handle_close)
+        self.assertEqual(self._run(task.receive()),
+                         {'type': 'http.disconnect'})
+        self.assertTrue(inst.closed_waiter.done())
+        self.assertFalse(inst.connected)
+
+    def test_receive_after_complete(self):
+        # the request has been received and answered: nothing to wait for
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        self._run(task.receive())
+        task.response_complete = True
+        self.assertEqual(self._run(task.receive()),
+                         {'type': 'http.disconnect'})
+        self.assertEqual(inst.closed_waiter, None)
+        self.assertTrue(inst.connected)
+
+    def test_receive_empty_body(self):
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        self.assertEqual(self._run(task.receive()), {
+            'type': 'http.request', 'body': b'', 'more_body': False})
+
+    def test_receive_after_response(self):
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        task.response_complete = True
+        self.assertEqual(self._run(task.receive()),
+                         {'type': 'http.disconnect'})
+
+    def test_send(self):
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        self._run(task.send({
+            'type': 'http.response.start', 'status': 404,
+            'headers': [(b'content-length', b'2')]}))
+        self.assertEqual(task.status, '404 Not Found')
+        self.assertEqual(task.content_length, 2)
+        self._run(task.send({'type': 'http.response.body', 'body': b'no'}))
+        self.assertTrue(task.response_complete)
+        self.assertTrue(self._written().endswith(b'\r\n\r\nno'))
+
+    def test_send_start_twice(self):
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        message = {'type': 'http.response.start', 'status': 200}
+        self._run(task.send(message))
+        self.assertRaises(AssertionError, self._run, task.send(message))
+
+    def test_send_body_after_last(self):
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        self._run(task.send({'type': 'http.response.start', 'status': 200}))
+        message = {'type': 'http.response.body', 'body': b'ok'}
+        self._run(task.send(message))
+        self.assertRaises(AssertionError, self._run, task.send(message))
+
+    def test_send_unsupported_type(self):
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        self.assertRaises(ValueError, self._run, task.send(
+            {'type': 'websocket.accept'}))
+
+    def test_send_header_with_newline(self):
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        self.assertRaises(ValueError, self._run, task.send({
+            'type': 'http.response.start', 'status': 200,
+            'headers': [(b'x-foo', b'a\r\nb')]}))
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        self.assertRaises(ValueError, self._run, task.send({
+            'type': 'http.response.start', 'status': 200,
+            'headers': [(b'x-foo\n', b'a')]}))
+
+    def test_send_unknown_status(self):
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        self._run(task.send({'type': 'http.response.start', 'status': 599}))
+        self.assertEqual(task.status, '599')
+
+    def test_send_body_before_start(self):
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        self.assertRaises(AssertionError, self._run, task.send(
+            {'type': 'http.response.body', 'body': b'no'}))
+
+    def test_send_hop_by_hop_header(self):
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        self.assertRaises(AssertionError, self._run, task.send({
+            'type': 'http.response.start', 'status': 200,
+            'headers': [(b'connection', b'close')]}))
+
+    def test_send_disconnected(self):
+        from waitress.channel import ClientDisconnected
+        inst = self._makeOne()
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        inst.handle_close()
+        self.assertRaises(ClientDisconnected, self._run, task.send(
+            {'type': 'http.response.start', 'status': 200}))
+
+    def test_send_waits_for_drain(self):
+        inst = self._makeOne(outbuf_high_watermark=4, outbuf_low_watermark=2)
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        inst.requests = [task.request]
+        self._run(task.send({'type': 'http.response.start', 'status': 200}))
+        inst.write_paused = True
+        self.loop.call_later(0.01, ChannelProtocol_resume, inst)
+        self._run(task.send({'type': 'http.response.body', 'body': b'abcdef',
+                             'more_body': True}))
+        self.assertTrue(inst.buffered() <= 2)
+        self.assertTrue(self._written().endswith(b'abcdef\r\n'))
+
+    def test_send_disconnected_while_draining(self):
+        from waitress.channel import ClientDisconnected
+        inst = self._makeOne(outbuf_high_watermark=4, outbuf_low_watermark=2)
+        task = self._makeTask(inst, b'GET / HTTP/1.1\r\n\r\n')
+        inst.requests = [task.request]
+        self._run(task.send({'type': 'http.response.start', 'status': 200}))
+        inst.write_paused = True
+        self.loop.call_later(0.01, inst.handle_close)
+        self.assertRaises(ClientDisconnected, self._run, task.send(
+            {'type': 'http.response.body', 'body': b'abcdef',
+             'more_body': True}))
+
+    def test_wait_for_drain_disconnected(self):
+        from waitress.channel import ClientDisconnected
+        inst = self._makeOne()
+        inst.handle_close()
+        self.assertRaises(ClientDisconnected, inst._wait_for_drain, inst)
+
+    def test_serve(self):
+        from waitress.tests.fixtureapps import asgi
+        inst = self._makeOne(asgi.ok)
+        inst.data_received(b'GET / HTTP/1.1\r\n\r\n')
+        self.assertEqual(inst.server.tasks, [inst])
+        self._run(inst.serve())
+        self.assertEqual(inst.requests, [])
+        self.assertTrue(self._written().startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(self._written().endswith(b'\r\n\r\nok'))
+        self.assertTrue(inst.connected)
+
+    def test_serve_short_response(self):
+        from waitress.tests.fixtureapps import asgi
+        inst = self._makeOne(asgi.short)
+        inst.data_received(b'GET / HTTP/1.1\r\n\r\n')
+        with self.assertLogs('waitress', 'WARNING'):
+            self._run(inst.serve())
+        # the client can't tell where the response ends otherwise
+        self.assertTrue(inst.close_when_flushed or not inst.connected)
+
+    def test_serve_bad_request(self):
+        from waitress.tests.fixtureapps import asgi
+        inst = self._makeOne(asgi.ok, max_request_body_size=2)
+        inst.data_received(
+            b'POST / HTTP/1.1\r\nContent-Length: 5\r\n\r\nabcde')
+        self._run(inst.serve())
+        self.assertTrue(self._written().startswith(
+            b'HTTP/1.1 413 Request Entity Too Large\r\n'))
+
+    def test_serve_without_start(self):
+        from waitress.tests.fixtureapps import asgi
+        inst = self._makeOne(asgi.silent)
+        inst.logger = DummyLogger()
+        inst.data_received(b'GET / HTTP/1.1\r\n\r\n')
+        self._run(inst.serve())
+        self.assertTrue(self._written().startswith(
+            b'HTTP/1.1 500 Internal Server Error\r\n'))
+        self.assertEqual(len(inst.logger.exceptions), 1)
+
+    def test_serve_client_disconnected(self):
+        from waitress.tests.fixtureapps import asgi
+        inst = self._makeOne(asgi.receive_until_disconnect)
+        inst.logger = DummyLogger()
+        inst.data_received(b'GET / HTTP/1.1\r\n\r\n')
+        # while the application waits for more than the body
+        self.loop.call_later(0.01, inst.handle_close)
+        self._run(inst.serve())
+        self.assertEqual(len(inst.logger.infos), 1)
+        self.assertEqual(inst.logger.exceptions, [])
+
+    def test_reading_while_serving(self):
+        inst = self._makeOne(recv_bytes=8)
+        inst.data_received(b'GET / HTTP/1.1\r\n\r\n')
+        self.assertFalse(inst.readable())
+        # still reading, to learn of the client going away
+        self.assertFalse(inst.read_paused)
+        inst.data_received(b'GET /next HTTP/1.1\r\n\r\n')
+        self.assertEqual(inst.pending, b'GET /next HTTP/1.1\r\n\r\n')
+        self.assertTrue(inst.read_paused)
+
+@unittest.skipIf(PY2, 'asyncio requires Python 3')
+class Test_create_asyncio_server(unittest.TestCase):
+
+    def _callFUT(self, **kw):
+        from waitress.adjustments import Adjustments
+        from waitress.aio import create_asyncio_server
+        inst = create_asyncio_server(
+            dummy_app, Adjustments(**kw), DummyTaskDispatcher())
+        self.addCleanup(inst.close)
+        return inst
+
+    def test_one_socket(self):
+        from waitress.aio import AsyncioWSGIServer
+        inst = self._callFUT(listen='127.0.0.1:0')
+        self.assertEqual(inst.__class__, AsyncioWSGIServer)
+        self.assertEqual(inst.servers, [inst])
+
+    def test_asgi(self):
+        from waitress.aio import ASGIServer
+        inst = self._callFUT(listen='127.0.0.1:0', io_backend='asyncio',
+                             asgi=True)
+        self.assertEqual(inst.__class__, ASGIServer)
+
+    def test_several_sockets(self):
+        from waitress.aio import AsyncioMultiSocketServer
+        inst = self._callFUT(listen='127.0.0.1:0 127.0.0.1:0')
+        self.assertEqual(inst.__class__, AsyncioMultiSocketServer)
+        self.assertEqual(len(inst.servers), 2)
+        self.assertTrue(inst.servers[0].map is inst.servers[1].map)
+        self.assertEqual(inst.listen_sockets(),
+                         [server.socket for server in inst.servers])
+        inst.close()
+        self.assertEqual(
+            [server.socket for server in inst.servers], [None, None])
+
+    def test_several_sockets_bind_fails(self):
+        import waitress.aio
+        busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(busy.close)
+        busy.bind(('127.0.0.1', 0))
+        busy.listen(1)
+        bound = []
+        bind_socket = waitress.aio.bind_socket
+        def record(sockinfo, adj):
+            sock = bind_socket(sockinfo, adj)
+            bound.append(sock)
+            return sock
+        waitress.aio.bind_socket = record
+        try:
+            self.assertRaises(
+                socket.error, self._callFUT,
+                listen='127.0.0.1:0 127.0.0.1:%d' % busy.getsockname()[1])
+        finally:
+            waitress.aio.bind_socket = bind_socket
+        self.assertEqual(len(bound), 1)
+        # the socket bound before the failure is not left listening
+        self.assertEqual(bound[0].fileno(), -1)
+
+    @unittest.skipIf(not hasattr(socket, 'AF_UNIX'), 'Unix sockets only')
+    def test_unix_socket(self):
+        import os
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), 'waitress.sock')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.addCleanup(os.remove, path)
+        inst = self._callFUT(unix_socket=path, unix_socket_perms='600')
+        self.assertEqual(inst.effective_host, 'unix')
+        self.assertEqual(inst.effective_port, path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertEqual(inst.fix_addr(None), ('localhost', None))
+
+def ChannelProtocol_resume(channel):
+    from waitress.aio import ChannelProtocol
+    protocol = ChannelProtocol(channel.server, None)
+    protocol.channel = channel
+    protocol.resume_writing()
+
+class DummyLogger(object):
+
+    def __init__(self):
+        self.exceptions = []
+        self.infos = []
+        self.warnings = []
+
+    def exception(self, msg):
+        self.exceptions.append(msg)
+
+    def info(self, msg):
+        self.infos.append(msg)
+
+    def warning(self, msg, exc_info=False):
+        self.warnings.append(msg)
+
+class DummyLoop(object):
+
+    def __init__(self):
+        self.readers = {}
+        self.later = []
+        self.soon = []
+        self.threadsafe = []
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        del self.readers[fd]
+
+    def call_later(self, delay, callback):
+        self.later.append((delay, callback))
+        return DummyHandle()
+
+    def call_soon(self, callback):
+        self.soon.append(callback)
+
+    def call_soon_threadsafe(self, callback):
+        self.threadsafe.append(callback)
+
+class DummyHandle(object):
+
+    def cancel(self):
+        pass
+
+class DummyFuture(object):
+
+    def __init__(self, exception=None):
+        self._exception = exception
+
+    def cancelled(self):
+        return False
+
+    def exception(self):
+        return self._exception
+
+class DummySock(object):
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+class DummyListeningSock(object):
+
+    def __init__(self, errno):
+        self.errno = errno
+
+    def accept(self):
+        raise socket.error(self.errno, 'accept failed')
+
+class DummyTransport(object):
+
+    closed = False
+    paused = None
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.written = []
+
+    def get_extra_info(self, name):
+        return self.sock
+
+    def write(self, data):
+        self.written.append(data)
+
+    def writelines(self, segments):
+        self.written.extend(segments)
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def close(self):
+        self.closed = True
+
+class DummyChannel(object):
+
+    polled = False
+    closed = False
+    will_close = False
+
+    def __init__(self, requests=()):
+        self.requests = list(requests)
+
+    def poll(self):
+        self.polled = True
+
+    def writable(self):
+        return False
+
+    def handle_close(self):
+        self.closed = True
+
+class DummyTaskDispatcher(object):
+
+    was_shutdown = False
+
+    def __init__(self):
+        self.tasks = []
+
+    def add_task(self, task):
+        self.tasks.append(task)
+
+    def shutdown(self):
+        self.was_shutdown = True
+
+class DummyServer(object):
+
+    metrics = None
+    server_name = 'localhost'
+    effective_host = '127.0.0.1'
+    effective_port = '80'
+
+    def __init__(self, adj):
+        self.adj = adj
+        self.loop = DummyLoop()
+        self.busy_channels = set()
+        self.servers = []
+        self.tasks = []
+        self.active_channels = {}
+        self.expiry_slots = {}
+
+    def add_task(self, task):
+        self.tasks.append(task)
+
+    def pull_trigger(self):
+        pass
+
+    def schedule_expiry(self, channel, deadline):
+        pass
+
+    def cancel_expiry(self, channel):
+        pass
@@ -1,6 +1,8 @@
 import unittest
 import io
 
+from waitress.compat import PY2
+
 class TestFileBasedBuffer(unittest.TestCase):
 
     def _makeOne(self, file=None, from_buffer=None):
@@ -122,6 +124,62 @@ class TestTempfileBasedBuffer(unittest.TestCase):
         r = inst.newfile()
         self.assertTrue(hasattr(r, 'fileno')) # file
 
+    def test_ctor_from_bytesio_buffer(self):
+        from waitress.buffers import BytesIOBasedBuffer
+        from_buffer = BytesIOBasedBuffer()
+        from_buffer.append(b'abcdef')
+        from_buffer.get(2, skip=True)
+        inst = self._makeOne(from_buffer)
+        self.assertEqual(len(inst), 4)
+        self.assertEqual(inst.get(), b'cdef')
+
+    def test_getview(self):
+        inst = self._makeOne()
+        inst.append(b'abcdef')
+        inst.skip(2)
+        view = inst.getview()
+        self.assertTrue(isinstance(view, memoryview))
+        self.assertEqual(view.tobytes(), b'cdef')
+        inst.close()
+        # the mapping outlives the file
+        self.assertEqual(view.tobytes(), b'cdef')
+
+    def test_getview_keeps_position(self):
+        inst = self._makeOne()
+        inst.append(b'abcdef')
+        inst.skip(2)
+        inst.getview()
+        self.assertEqual(inst.get(2, skip=True), b'cd')
+        self.assertEqual(inst.getview().tobytes(), b'ef')
+
+    def test_getview_empty(self):
+        inst = self._makeOne()
+        self.assertEqual(inst.getview().tobytes(), b'')
+
+class TestMemfdBasedBuffer(unittest.TestCase):
+
+    def _makeOne(self, from_buffer=None):
+        from waitress.buffers import MemfdBasedBuffer
+        return MemfdBasedBuffer(from_buffer=from_buffer)
+
+    def test_newfile(self):
+        import os
+        inst = self._makeOne()
+        r = inst.newfile()
+        self.assertTrue(hasattr(r, 'fileno')) # file
+        if hasattr(os, 'memfd_create'):
+            self.assertTrue('waitress-buffer' in os.readlink(
+                '/proc/self/fd/%d' % r.fileno()))
+        r.close()
+
+    def test_append_and_getview(self):
+        inst = self._makeOne()
+        inst.append(b'abc')
+        inst.append(b'def')
+        self.assertEqual(inst.getview().tobytes(), b'abcdef')
+        self.assertEqual(inst.get(4, skip=True), b'abcd')
+        self.assertEqual(inst.getview().tobytes(), b'ef')
+
 class TestBytesIOBasedBuffer(unittest.TestCase):
 
     def _makeOne(self, from_buffer=None):
@@ -143,6 +201,12 @@ class TestBytesIOBasedBuffer(unittest.TestCase):
         r = inst.newfile()
         self.assertTrue(hasattr(r, 'read'))
 
+    def test_getview(self):
+        inst = self._makeOne()
+        inst.append(b'abcdef')
+        inst.skip(1)
+        self.assertEqual(inst.getview().tobytes(), b'bcdef')
+
 class TestReadOnlyFileBasedBuffer(unittest.TestCase):
 
     def _makeOne(self, file, block_size=8192):
@@ -173,6 +237,39 @@ class TestReadOnlyFileBasedBuffer(unittest.TestCase):
         self.assertEqual(inst.file.seeked, 0)
         self.assertTrue(hasattr(inst, 'close'))
 
+    def test_prepare_no_fileno(self):
+        f = io.BytesIO(b'abc')
+        inst = self._makeOne(f)
+        inst.prepare()
+        self.assertEqual(inst.sendfile_fd, None)
+
+    def test_prepare_regular_file(self):
+        import os
+        import tempfile
+        f = tempfile.TemporaryFile()
+        try:
+            f.write(b'abc')
+            f.seek(0)
+            inst = self._makeOne(f)
+            self.assertEqual(inst.prepare(), 3)
+            if hasattr(os, 'sendfile'):
+                self.assertEqual(inst.sendfile_fd, f.fileno())
+            else: # pragma: no cover
+                self.assertEqual(inst.sendfile_fd, None)
+        finally:
+            f.close()
+
+    def test_prepare_not_a_regular_file(self):
+        import os
+        r, w = os.pipe()
+        f = os.fdopen(r, 'rb')
+        try:
+            inst = self._makeOne(f)
+            self.assertEqual(inst._get_sendfile_fd(), None)
+        finally:
+            f.close()
+            os.close(w)
+
     def test_get_numbytes_neg_one(self):
         f = io.BytesIO(b'abcdef')
         inst = self._makeOne(f)
@@ -339,6 +436,18 @@ class TestOverflowableBuffer(unittest.TestCase):
         self.assertFalse(inst.buf is None)
         self.assertEqual(r, b'xxxxx')
 
+    def test_get_segments_buf_None(self):
+        inst = self._makeOne()
+        inst.strbuf = b'x' * 5
+        self.assertEqual(inst.get_segments(3), [b'xxxxx'])
+        self.assertTrue(inst.buf is None)
+
+    def test_get_segments_buf_not_None(self):
+        inst = self._makeOne(overflow=5)
+        inst.append(b'x' * 10000)
+        self.assertEqual(inst.get_segments(3), [b'xxx'])
+        self.assertEqual(len(inst), 10000)
+
     def test_skip_buf_None(self):
         inst = self._makeOne()
         inst.strbuf = b'data'
@@ -422,6 +531,411 @@ class TestOverflowableBuffer(unittest.TestCase):
         inst.close()
         self.assertTrue(buf.closed)
 
+class TestSegmentBuffer(unittest.TestCase):
+
+    def _makeOne(self, overflow=10000):
+        from waitress.buffers import SegmentBuffer
+        return SegmentBuffer(overflow)
+
+    def test___len__(self):
+        inst = self._makeOne()
+        self.assertEqual(len(inst), 0)
+        inst.append(b'abc')
+        self.assertEqual(len(inst), 3)
+
+    def test___len__buf_is_not_None(self):
+        inst = self._makeOne()
+        inst.buf = DummyBuffer(length=5)
+        self.assertEqual(len(inst), 5)
+
+    def test___nonzero__(self):
+        inst = self._makeOne()
+        self.assertEqual(bool(inst), False)
+        inst.append(b'abc')
+        self.assertEqual(bool(inst), True)
+
+    def test___nonzero___on_int_overflow_buffer(self):
+        from waitress.compat import MAXINT
+        inst = self._makeOne()
+        inst.buf = DummyBuffer(length=MAXINT + 1)
+        self.assertEqual(bool(inst), True)
+
+    def test_append_empty(self):
+        inst = self._makeOne()
+        inst.append(b'')
+        self.assertEqual(len(inst.segments), 0)
+
+    def test_append_coalesces_small_segments(self):
+        inst = self._makeOne()
+        inst.append(b'abc')
+        inst.append(b'def')
+        self.assertEqual(list(inst.segments), [b'abcdef'])
+
+    def test_append_large_segments_not_copied(self):
+        inst = self._makeOne()
+        data = b'x' * 2000
+        inst.append(b'abc')
+        inst.append(data)
+        inst.append(b'def')
+        self.assertEqual(len(inst.segments), 3)
+        self.assertTrue(inst.segments[1] is data)
+        self.assertEqual(len(inst), 2006)
+
+    def test_append_copies_bytearray(self):
+        inst = self._makeOne()
+        data = bytearray(b'abc')
+        inst.append(data)
+        data[:] = b'xyz'
+        self.assertEqual(inst.get(), b'abc')
+
+    def test_append_memoryview(self):
+        inst = self._makeOne()
+        inst.append(memoryview(b'abcdef')[1:4])
+        self.assertEqual(inst.segments[0].__class__, bytes)
+        self.assertEqual(inst.get(), b'bcd')
+
+    def test_append_overflow(self):
+        from waitress.buffers import TempfileBasedBuffer
+        inst = self._makeOne(overflow=2000)
+        inst.append(b'x' * 1500)
+        inst.skip(500)
+        inst.append(b'y' * 1500)
+        self.assertTrue(inst.overflowed)
+        self.assertEqual(inst.buf.__class__, TempfileBasedBuffer)
+        self.assertEqual(len(inst.segments), 0)
+        self.assertEqual(len(inst), 2500)
+        self.assertEqual(inst.get(), b'x' * 1000 + b'y' * 1500)
+        inst.append(b'z')
+        self.assertEqual(len(inst), 2501)
+
+    def test_append_after_getfile_overflow(self):
+        from waitress.buffers import TempfileBasedBuffer
+        inst = self._makeOne(overflow=10)
+        inst.append(b'abc')
+        inst.getfile()
+        inst.append(b'x' * 10)
+        self.assertTrue(inst.overflowed)
+        self.assertEqual(inst.buf.__class__, TempfileBasedBuffer)
+        self.assertEqual(inst.get(), b'abc' + b'x' * 10)
+
+    def test_append_with_len_more_than_max_int(self):
+        from waitress.compat import MAXINT
+        inst = self._makeOne()
+        inst.overflowed = True
+        buf = DummyBuffer(length=MAXINT)
+        inst.buf = buf
+        result = inst.append(b'x')
+        self.assertEqual(result, None)
+
+    def test_get(self):
+        inst = self._makeOne()
+        inst.append(b'x' * 2000)
+        inst.append(b'y' * 2000)
+        self.assertEqual(inst.get(1999), b'x' * 1999)
+        self.assertEqual(inst.get(2001), b'x' * 2000 + b'y')
+        self.assertEqual(inst.get(), b'x' * 2000 + b'y' * 2000)
+        self.assertEqual(inst.get(100000), b'x' * 2000 + b'y' * 2000)
+        self.assertEqual(len(inst), 4000)
+
+    def test_get_whole_segment_not_copied(self):
+        inst = self._makeOne()
+        data = b'x' * 2000
+        inst.append(data)
+        self.assertTrue(inst.get(2000) is data)
+
+    def test_get_skip(self):
+        inst = self._makeOne()
+        inst.append(b'x' * 2000)
+        inst.append(b'y' * 2000)
+        self.assertEqual(inst.get(2001, skip=True), b'x' * 2000 + b'y')
+        self.assertEqual(len(inst), 1999)
+        self.assertEqual(inst.get(), b'y' * 1999)
+
+    def test_get_empty(self):
+        inst = self._makeOne()
+        self.assertEqual(inst.get(), b'')
+
+    def test_get_segments(self):
+        inst = self._makeOne()
+        inst.append(b'x' * 2000)
+        inst.append(b'y' * 2000)
+        inst.skip(10)
+        segments = inst.get_segments(2500)
+        self.assertEqual([bytes(s) for s in segments],
+                         [b'x' * 1990, b'y' * 510])
+        self.assertEqual(len(inst), 3990)
+
+    def test_get_segments_buf_not_None(self):
+        inst = self._makeOne(overflow=5)
+        inst.append(b'x' * 10000)
+        self.assertEqual(inst.get_segments(3), [b'xxx'])
+
+    def test_skip(self):
+        inst = self._makeOne()
+        inst.append(b'x' * 2000)
+        inst.append(b'y' * 2000)
+        inst.skip(1000)
+        self.assertEqual(inst.offset, 1000)
+        self.assertEqual(len(inst.segments), 2)
+        inst.skip(1000)
+        self.assertEqual(inst.offset, 0)
+        self.assertEqual(len(inst.segments), 1)
+        inst.skip(2000)
+        self.assertEqual(len(inst.segments), 0)
+        self.assertEqual(len(inst), 0)
+
+    def test_skip_too_much(self):
+        inst = self._makeOne()
+        inst.append(b'abc')
+        self.assertRaises(ValueError, inst.skip, 4)
+
+    def test_skip_buf_not_None(self):
+        inst = self._makeOne(overflow=5)
+        inst.append(b'x' * 10)
+        inst.skip(4)
+        self.assertEqual(len(inst), 6)
+
+    def test_prune_buf_None(self):
+        inst = self._makeOne()
+        inst.append(b'abc')
+        inst.prune()
+        self.assertEqual(inst.get(), b'abc')
+
+    def test_prune_with_buf_overflow(self):
+        inst = self._makeOne(overflow=10)
+        inst.append(b'x' * 20)
+        inst.skip(15)
+        inst.prune()
+        self.assertFalse(inst.overflowed)
+        self.assertEqual(inst.buf, None)
+        self.assertEqual(inst.get(), b'x' * 5)
+
+    def test_overflowed_buffers_gauge(self):
+        from waitress.metrics import overflowed_buffers
+        before = overflowed_buffers.get()
+        inst = self._makeOne(overflow=10)
+        inst.append(b'x' * 20)
+        self.assertEqual(overflowed_buffers.get(), before + 1)
+        inst.skip(15)
+        inst.prune()
+        self.assertEqual(overflowed_buffers.get(), before)
+        inst.append(b'x' * 20)
+        inst.close()
+        self.assertEqual(overflowed_buffers.get(), before)
+        inst.close()
+        self.assertEqual(overflowed_buffers.get(), before)
+
+    def test_prune_with_buf_overflow_still_large(self):
+        inst = self._makeOne(overflow=10)
+        inst.append(b'x' * 20)
+        inst.skip(5)
+        inst.prune()
+        self.assertTrue(inst.overflowed)
+        self.assertEqual(len(inst), 15)
+
+    def test_prune_with_buflen_more_than_max_int(self):
+        from waitress.compat import MAXINT
+        inst = self._makeOne()
+        inst.overflowed = True
+        inst.buf = DummyBuffer(length=MAXINT + 1)
+        result = inst.prune()
+        self.assertEqual(result, None)
+
+    def test_getfile(self):
+        inst = self._makeOne()
+        inst.append(b'x' * 2000)
+        inst.append(b'y' * 2000)
+        inst.skip(1000)
+        f = inst.getfile()
+        self.assertEqual(f.read(), b'x' * 1000 + b'y' * 2000)
+        self.assertEqual(len(inst.segments), 0)
+
+    def test_getfile_overflowed(self):
+        inst = self._makeOne(overflow=10)
+        inst.append(b'x' * 20)
+        f = inst.getfile()
+        self.assertEqual(f.read(), b'x' * 20)
+
+    def test_close(self):
+        inst = self._makeOne()
+        inst.append(b'abc')
+        inst.close()
+        self.assertEqual(len(inst), 0)
+
+    def test_close_withbuf(self):
+        class Buffer(object):
+            def close(self):
+                self.closed = True
+        buf = Buffer()
+        inst = self._makeOne()
+        inst.buf = buf
+        inst.close()
+        self.assertTrue(buf.closed)
+
+    def test_spool(self):
+        from waitress.buffers import MemfdBasedBuffer, SegmentBuffer
+        inst = SegmentBuffer(10, MemfdBasedBuffer)
+        inst.append(b'x' * 20)
+        self.assertTrue(inst.overflowed)
+        self.assertTrue(isinstance(inst.buf, MemfdBasedBuffer))
+        self.assertEqual(inst.getview().tobytes(), b'x' * 20)
+        inst.close()
+
+    def test_getview_empty(self):
+        inst = self._makeOne()
+        self.assertEqual(inst.getview().tobytes(), b'')
+
+    @unittest.skipIf(PY2, "memoryview has no obj on Python 2")
+    def test_getview_one_segment(self):
+        inst = self._makeOne()
+        data = b'x' * 2000
+        inst.append(data)
+        inst.skip(10)
+        view = inst.getview()
+        self.assertTrue(view.obj is data)
+        self.assertEqual(len(view), 1990)
+
+    def test_getview_joins_segments(self):
+        inst = self._makeOne()
+        inst.append(b'a' * 2000)
+        inst.append(b'b' * 2000)
+        inst.skip(1000)
+        view = inst.getview()
+        self.assertEqual(view.tobytes(), b'a' * 1000 + b'b' * 2000)
+        self.assertEqual(len(inst.segments), 1)
+        self.assertEqual(len(inst), 3000)
+        self.assertEqual(inst.getview().tobytes(), view.tobytes())
+
+    def test_getview_after_getfile(self):
+        inst = self._makeOne()
+        inst.append(b'abc')
+        inst.getfile()
+        self.assertEqual(inst.getview().tobytes(), b'abc')
+
+class TestStreamBuffer(unittest.TestCase):
+
+    def _makeOne(self, limit=10, timeout=None):
+        from waitress.buffers import StreamBuffer
+        return StreamBuffer(limit, timeout)
+
+    def _feed(self, inst, chunks, finish=True):
+        import threading
+        def feed():
+            for chunk in chunks:
+                inst.append(chunk)
+            if finish:
+                inst.finish()
+        thread = threading.Thread(target=feed)
+        thread.start()
+        return thread
+
+    def test_read_blocks_until_size(self):
+        inst = self._makeOne(limit=100)
+        thread = self._feed(inst, [b'ab', b'cd', b'ef'], finish=False)
+        self.assertEqual(inst.read(5), b'abcde')
+        thread.join()
+        self.assertEqual(len(inst), 6)
+
+    def test_read_all(self):
+        inst = self._makeOne(limit=4)
+        inst.wake = lambda: None
+        thread = self._feed(inst, [b'abc'] * 10)
+        self.assertEqual(inst.read(), b'abc' * 10)
+        self.assertEqual(inst.read(), b'')
+        thread.join()
+
+    def test_read_size_none(self):
+        inst = self._makeOne()
+        inst.append(b'abc')
+        inst.finish()
+        self.assertEqual(inst.read(None), b'abc')
+
+    def test_read_past_end(self):
+        inst = self._makeOne()
+        inst.append(b'abc')
+        inst.finish()
+        self.assertEqual(inst.read(10), b'abc')
+        self.assertEqual(inst.read(10), b'')
+
+    def test_full_and_wake(self):
+        woken = []
+        inst = self._makeOne(limit=4)
+        inst.wake = lambda: woken.append(True)
+        inst.append(b'abcdef')
+        self.assertTrue(inst.full())
+        self.assertEqual(inst.read(1), b'a')
+        self.assertEqual(woken, [])
+        self.assertEqual(inst.read(2), b'bc')
+        self.assertFalse(inst.full())
+        self.assertEqual(woken, [True])
+
+    def test_readline(self):
+        inst = self._makeOne(limit=100)
+        thread = self._feed(inst, [b'ab', b'c\nde', b'f\n', b'g'])
+        self.assertEqual(inst.readline(), b'abc\n')
+        self.assertEqual(inst.readline(2), b'de')
+        self.assertEqual(inst.readline(), b'f\n')
+        self.assertEqual(inst.readline(), b'g')
+        self.assertEqual(inst.readline(), b'')
+        thread.join()
+
+    def test_readlines_and_iter(self):
+        inst = self._makeOne(limit=100)
+        inst.append(b'a\nb\nc\n')
+        self.assertEqual(inst.readlines(3), [b'a\n', b'b\n'])
+        inst.finish()
+        self.assertEqual(list(inst), [b'c\n'])
+
+    def test_abort_wakes_reader(self):
+        import threading
+        inst = self._makeOne()
+        thread = threading.Thread(target=inst.abort)
+        thread.start()
+        self.assertRaises(IOError, inst.read, 5)
+        thread.join()
+
+    def test_read_times_out(self):
+        inst = self._makeOne(timeout=0.05)
+        inst.append(b'abc')
+        self.assertRaises(IOError, inst.read, 5)
+        self.assertTrue(inst.aborted)
+        inst.append(b'def')
+        self.assertEqual(len(inst), 3)
+
+    def test_read_timeout_restarts_on_progress(self):
+        inst = self._makeOne(limit=100, timeout=0.2)
+        def feed():
+            import time
+            for chunk in (b'ab', b'cd', b'ef'):
+                time.sleep(0.1)
+                inst.append(chunk)
+        import threading
+        thread = threading.Thread(target=feed)
+        thread.start()
+        self.assertEqual(inst.read(6), b'abcdef')
+        thread.join()
+        self.assertFalse(inst.aborted)
+
+    def test_append_after_close(self):
+        inst = self._makeOne()
+        inst.append(b'abc')
+        inst.close()
+        inst.append(b'def')
+        self.assertEqual(len(inst), 3)
+        self.assertFalse(inst.full())
+        self.assertRaises(IOError, inst.read)
+
+    def test_getfile(self):
+        inst = self._makeOne()
+        self.assertTrue(inst.getfile() is inst)
+        self.assertTrue(bool(inst))
+
+    def test_getview(self):
+        inst = self._makeOne()
+        inst.append(b'abc')
+        inst.finish()
+        self.assertEqual(inst.getview().tobytes(), b'abc')
+
 class KindaFilelike(object):
 
     def __init__(self, bytes, close=None, tellresults=None):
@@ -1,6 +1,8 @@
 import unittest
 import io
 
+from waitress.compat import PY2
+
 class TestHTTPChannel(unittest.TestCase):
 
     def _makeOne(self, sock, addr, adj, map=None):
@@ -21,6 +23,9 @@ class TestHTTPChannel(unittest.TestCase):
         inst, _, map = self._makeOneWithMap()
         self.assertEqual(inst.addr, '127.0.0.1')
         self.assertEqual(map[100], inst)
+        self.assertTrue(inst.connected)
+        # made non-blocking by the server that accepted it
+        self.assertFalse(inst.socket.blocking)
 
     def test_total_outbufs_len_an_outbuf_size_gt_sys_maxint(self):
         from waitress.compat import MAXINT
@@ -86,6 +91,18 @@ class TestHTTPChannel(unittest.TestCase):
         self.assertEqual(len(inst.logger.exceptions), 1)
         self.assertTrue(outbuf.closed)
 
+    def test_handle_write_outbuf_raises_socketerror_counted(self):
+        import socket
+        from waitress.metrics import Metrics
+        inst, sock, map = self._makeOneWithMap()
+        inst.server = DummyServer()
+        inst.server.metrics = Metrics()
+        inst.requests = []
+        inst.outbufs = [DummyBuffer(b'abc', socket.error)]
+        inst.logger = DummyLogger()
+        inst.handle_write()
+        self.assertEqual(inst.server.metrics.socket_errors.get(), 1)
+
     def test_handle_write_outbuf_raises_othererror(self):
         inst, sock, map = self._makeOneWithMap()
         inst.requests = []
@@ -172,25 +189,72 @@ class TestHTTPChannel(unittest.TestCase):
         inst.requests = True
         self.assertEqual(inst.readable(), False)
 
+    def test_readable_close_when_flushed(self):
+        # the output of the task may all have been sent already
+        inst, sock, map = self._makeOneWithMap()
+        inst.requests = []
+        inst.close_when_flushed = True
+        self.assertEqual(inst.readable(), False)
+
+    def test_received_stops_after_connection_close(self):
+        inst, sock, map = self._makeOneWithMap()
+        inst.server = DummyServer()
+        inst.received(b'GET /a HTTP/1.1\nConnection: close\n\n'
+                      b'GET /b HTTP/1.1\n\n')
+        self.assertEqual(len(inst.requests), 1)
+        self.assertEqual(inst.requests[0].path, '/a')
+        self.assertTrue(inst.closing)
+        inst.requests = []
+        self.assertEqual(inst.readable(), False)
+        self.assertEqual(inst.received(b'GET /c HTTP/1.1\n\n'), False)
+        self.assertEqual(len(inst.server.tasks), 1)
+
     def test_handle_read_no_error(self):
         inst, sock, map = self._makeOneWithMap()
         inst.will_close = False
-        inst.recv = lambda *arg: b'abc'
+        def recv_into(buf):
+            buf[:3] = b'abc'
+            return 3
+        inst.recv_into = recv_into
         inst.last_activity = 0
         L = []
-        inst.received = lambda x: L.append(x)
+        inst.received = lambda x: L.append(bytes(x))
         result = inst.handle_read()
         self.assertEqual(result, None)
         self.assertNotEqual(inst.last_activity, 0)
         self.assertEqual(L, [b'abc'])
 
+    def test_handle_read_reuses_buffer(self):
+        inst, sock, map = self._makeOneWithMap()
+        buffers = []
+        def recv_into(buf):
+            buffers.append(buf)
+            buf[:1] = b'a'
+            return 1
+        inst.recv_into = recv_into
+        inst.received = lambda x: None
+        inst.handle_read()
+        inst.handle_read()
+        self.assertEqual(len(buffers[0]), inst.adj.recv_bytes)
+        self.assertTrue(buffers[0] is buffers[1])
+
+    def test_handle_read_closed(self):
+        inst, sock, map = self._makeOneWithMap()
+        inst.recv_into = lambda buf: 0
+        inst.last_activity = 0
+        L = []
+        inst.received = lambda x: L.append(x)
+        inst.handle_read()
+        self.assertEqual(inst.last_activity, 0)
+        self.assertEqual(L, [])
+
     def test_handle_read_error(self):
         import socket
         inst, sock, map = self._makeOneWithMap()
         inst.will_close = False
-        def recv(b):
+        def recv_into(b):
             raise socket.error
-        inst.recv = recv
+        inst.recv_into = recv_into
         inst.last_activity = 0
         inst.logger = DummyLogger()
         result = inst.handle_read()
@@ -198,6 +262,29 @@ class TestHTTPChannel(unittest.TestCase):
         self.assertEqual(inst.last_activity, 0)
         self.assertEqual(len(inst.logger.exceptions), 1)
 
+    def test_handle_read_counted(self):
+        from waitress.metrics import Metrics
+        inst, sock, map = self._makeOneWithMap()
+        inst.server = DummyServer()
+        inst.server.metrics = Metrics()
+        inst.recv_into = lambda buf: 5
+        inst.received = lambda data: None
+        inst.handle_read()
+        self.assertEqual(inst.server.metrics.bytes_received.get(), 5)
+
+    def test_handle_read_error_counted(self):
+        import socket
+        from waitress.metrics import Metrics
+        inst, sock, map = self._makeOneWithMap()
+        inst.server = DummyServer()
+        inst.server.metrics = Metrics()
+        def recv_into(buf):
+            raise socket.error
+        inst.recv_into = recv_into
+        inst.adj.log_socket_errors = False
+        inst.handle_read()
+        self.assertEqual(inst.server.metrics.socket_errors.get(), 1)
+
     def test_write_soon_empty_byte(self):
         inst, sock, map = self._makeOneWithMap()
         wrote = inst.write_soon(b'')
@@ -209,6 +296,85 @@ class TestHTTPChannel(unittest.TestCase):
         wrote = inst.write_soon(b'a')
         self.assertEqual(wrote, 1)
         self.assertEqual(len(inst.outbufs[0]), 1)
+        self.assertEqual(inst.bytes_written, 1)
+
+    def _makeWatermarked(self):
+        import threading
+        inst, sock, map = self._makeOneWithMap()
+        inst.outbuf_lock = threading.Condition()
+        inst.adj = DummyAdjustments()
+        inst.adj.outbuf_high_watermark = 4
+        inst.adj.outbuf_low_watermark = 2
+        inst.server = DummyServer()
+        inst.write_soon(b'abcde')
+        return inst
+
+    def _writeInThread(self, inst, data, writer=None):
+        import threading
+        errors = []
+        def write():
+            try:
+                (writer or inst).write_soon(data)
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=write)
+        thread.start()
+        while not inst.writers_waiting:
+            thread.join(0.001)
+        return thread, errors
+
+    def test_write_soon_above_high_watermark_blocks(self):
+        inst = self._makeWatermarked()
+        thread, errors = self._writeInThread(inst, b'f')
+        self.assertTrue(inst.server.trigger_pulled)
+        self.assertTrue(inst.force_flush)
+        self.assertEqual(inst.bytes_written, 5)
+        with inst.outbuf_lock:
+            inst._flush_some()
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(inst.writers_waiting, 0)
+        self.assertEqual(inst.bytes_written, 6)
+        self.assertEqual(inst.socket.sent, b'abcde')
+
+    def test_write_soon_blocked_client_disconnected(self):
+        from waitress.channel import ClientDisconnected
+        inst = self._makeWatermarked()
+        thread, errors = self._writeInThread(inst, b'f')
+        inst.handle_close()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0], ClientDisconnected))
+        self.assertEqual(inst.bytes_written, 5)
+
+    def test_write_soon_filewrapper_not_counted(self):
+        from waitress.buffers import ReadOnlyFileBasedBuffer
+        inst, sock, map = self._makeOneWithMap()
+        inst.adj = DummyAdjustments()
+        inst.adj.outbuf_high_watermark = 4
+        wrapper = ReadOnlyFileBasedBuffer(io.BytesIO(b'abcdef'), 8192)
+        wrapper.prepare()
+        inst.write_soon(wrapper)
+        inst.write_soon(b'a')
+        self.assertEqual(inst.bytes_written, 7)
+        self.assertEqual(inst.buffered(), 1)
+
+    def test_wake_for_output(self):
+        inst, sock, map = self._makeOneWithMap()
+        inst.server = DummyServer()
+        inst.wake_for_output()
+        self.assertFalse(inst.server.trigger_pulled)
+        inst.write_soon(b'abc')
+        inst.wake_for_output()
+        self.assertTrue(inst.server.trigger_pulled)
+        self.assertTrue(inst.force_flush)
+
+    def test_writable_close_when_flushed(self):
+        inst, sock, map = self._makeOneWithMap()
+        inst.close_when_flushed = True
+        self.assertTrue(inst.writable())
+        inst.handle_write()
+        self.assertTrue(sock.closed)
 
     def test_write_soon_filewrapper(self):
         from waitress.buffers import ReadOnlyFileBasedBuffer
@@ -223,7 +389,129 @@ class TestHTTPChannel(unittest.TestCase):
         self.assertEqual(len(outbufs), 3)
         self.assertEqual(outbufs[0], orig_outbuf)
         self.assertEqual(outbufs[1], wrapper)
-        self.assertEqual(outbufs[2].__class__.__name__, 'OverflowableBuffer')
+        self.assertEqual(outbufs[2].__class__.__name__, 'SegmentBuffer')
+
+    def test__flush_some_sendfile(self):
+        inst, sock, map = self._makeOneWithMap()
+        outbuf = DummySendfileBuffer(b'abcdef')
+        inst.outbufs = [outbuf, DummyBuffer(b'')]
+        calls = []
+        def sendfile(fd, offset, count):
+            calls.append((fd, offset, count))
+            return 4 if len(calls) == 1 else count
+        inst.sendfile = sendfile
+        result = inst._flush_some()
+        self.assertEqual(result, True)
+        self.assertEqual(calls, [(5, 0, 6), (5, 4, 2)])
+        self.assertEqual(sock.sent, b'')
+        self.assertEqual(len(inst.outbufs), 1)
+        self.assertTrue(outbuf.closed)
+
+    def test__flush_some_sendfile_unsupported(self):
+        import errno
+        inst, sock, map = self._makeOneWithMap()
+        outbuf = DummySendfileBuffer(b'abcdef')
+        inst.outbufs = [outbuf, DummyBuffer(b'')]
+        def sendfile(fd, offset, count):
+            raise OSError(errno.EINVAL, 'Invalid argument')
+        inst.sendfile = sendfile
+        result = inst._flush_some()
+        self.assertEqual(result, True)
+        self.assertEqual(outbuf.sendfile_fd, None)
+        self.assertEqual(sock.sent, b'abcdef')
+
+    def test__flush_some_sendfile_error(self):
+        import errno
+        inst, sock, map = self._makeOneWithMap()
+        inst.outbufs = [DummySendfileBuffer(b'abcdef'), DummyBuffer(b'')]
+        def sendfile(fd, offset, count):
+            raise OSError(errno.EIO, 'I/O error')
+        inst.sendfile = sendfile
+        self.assertRaises(OSError, inst._flush_some)
+
+    def _gatherOutbufs(self, inst, *outbufs):
+        inst.outbufs = list(outbufs)
+        calls = []
+        def sendmsg(segments):
+            calls.append(list(segments))
+            return 4
+        inst.sendmsg = sendmsg
+        inst.send = lambda data: 0
+        return calls
+
+    def test__send_some_gathers_outbufs(self):
+        from waitress import channel
+        inst, sock, map = self._makeOneWithMap()
+        first = DummyBuffer(b'abc')
+        second = DummyBuffer(b'defg')
+        empty = DummyBuffer(b'')
+        calls = self._gatherOutbufs(inst, first, empty, second)
+        orig = channel.HAS_SENDMSG
+        channel.HAS_SENDMSG = True
+        try:
+            result = inst._send_some()
+        finally:
+            channel.HAS_SENDMSG = orig
+        self.assertEqual(result, 4)
+        self.assertEqual(calls, [[b'abc', b'defg']])
+        self.assertEqual(first.skipped, 3)
+        self.assertFalse(hasattr(empty, 'skipped'))
+        self.assertEqual(second.skipped, 1)
+
+    def test__send_some_stops_at_send_bytes(self):
+        from waitress import channel
+        inst, sock, map = self._makeOneWithMap()
+        inst.adj.send_bytes = 3
+        first = DummyBuffer(b'abc')
+        second = DummyBuffer(b'defg')
+        self._gatherOutbufs(inst, first, second)
+        sent = []
+        def send(data):
+            sent.append(data)
+            return len(data)
+        inst.send = send
+        orig = channel.HAS_SENDMSG
+        channel.HAS_SENDMSG = True
+        try:
+            result = inst._send_some()
+        finally:
+            channel.HAS_SENDMSG = orig
+        self.assertEqual(result, 3)
+        self.assertEqual(sent, [b'abc'])
+        self.assertEqual(second.data, b'defg')
+
+    def test__send_some_stops_at_sendfile_outbuf(self):
+        inst, sock, map = self._makeOneWithMap()
+        first = DummyBuffer(b'abc')
+        wrapper = DummySendfileBuffer(b'defg')
+        self._gatherOutbufs(inst, first, wrapper)
+        inst.send = lambda data: len(data)
+        result = inst._send_some()
+        self.assertEqual(result, 3)
+        self.assertEqual(wrapper.remain, 4)
+
+    def test__send_some_without_sendmsg(self):
+        from waitress import channel
+        inst, sock, map = self._makeOneWithMap()
+        first = DummyBuffer(b'abc')
+        second = DummyBuffer(b'defg')
+        calls = self._gatherOutbufs(inst, first, second)
+        inst.send = lambda data: len(data)
+        orig = channel.HAS_SENDMSG
+        channel.HAS_SENDMSG = False
+        try:
+            result = inst._send_some()
+        finally:
+            channel.HAS_SENDMSG = orig
+        self.assertEqual(result, 3)
+        self.assertEqual(calls, [])
+        self.assertEqual(first.skipped, 3)
+        self.assertFalse(hasattr(second, 'skipped'))
+
+    def test__send_some_nothing_to_send(self):
+        inst, sock, map = self._makeOneWithMap()
+        self._gatherOutbufs(inst, DummyBuffer(b''))
+        self.assertEqual(inst._send_some(), 0)
 
     def test__flush_some_empty_outbuf(self):
         inst, sock, map = self._makeOneWithMap()
@@ -279,6 +567,8 @@ class TestHTTPChannel(unittest.TestCase):
             def get(self, numbytes):
                 self.length = 0
                 return b'123'
+            def get_segments(self, numbytes):
+                return [self.get(numbytes)]
             def skip(self, *args): pass
         buf = DummyHugeOutbuffer()
         inst.outbufs = [buf]
@@ -294,6 +584,15 @@ class TestHTTPChannel(unittest.TestCase):
         self.assertEqual(inst.connected, False)
         self.assertEqual(sock.closed, True)
 
+    def test_handle_close_drops_flush_marks(self):
+        inst, sock, map = self._makeOneWithMap()
+        inst.adj.observer = DummyObserver()
+        inst.write_soon(b'abc')
+        inst.track_flush(DummyTask())
+        inst.handle_close()
+        self.assertEqual(len(inst.flush_marks), 0)
+        self.assertEqual(inst.adj.observer.events, [])
+
     def test_handle_close_outbuf_raises_on_close(self):
         inst, sock, map = self._makeOneWithMap()
         def doraise():
@@ -311,6 +610,8 @@ class TestHTTPChannel(unittest.TestCase):
         inst.add_channel(map)
         self.assertEqual(map[fileno], inst)
         self.assertEqual(inst.server.active_channels[fileno], inst)
+        self.assertEqual(inst.server.expiries[inst],
+                         inst.last_activity + inst.adj.channel_timeout)
 
     def test_del_channel(self):
         inst, sock, map = self._makeOneWithMap()
@@ -319,6 +620,7 @@ class TestHTTPChannel(unittest.TestCase):
         inst.del_channel(map)
         self.assertEqual(map.get(fileno), None)
         self.assertEqual(inst.server.active_channels.get(fileno), None)
+        self.assertFalse(inst in inst.server.expiries)
 
     def test_received(self):
         inst, sock, map = self._makeOneWithMap()
@@ -327,6 +629,20 @@ class TestHTTPChannel(unittest.TestCase):
         self.assertEqual(inst.server.tasks, [inst])
         self.assertTrue(inst.requests)
 
+    def test_received_with_observer(self):
+        inst, sock, map = self._makeOneWithMap()
+        inst.server = DummyServer()
+        inst.adj.observer = observer = DummyObserver()
+        inst.received(b'GET /a HTTP/1.1\n\nGET /b HTTP/1.1\n\n')
+        requests = inst.requests
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(
+            observer.events,
+            [('received', requests[0]), ('received', requests[1]),
+             ('queued', requests[0]), ('queued', requests[1])])
+        for request in requests:
+            self.assertTrue(request.received_at <= request.queued_at)
+
     def test_received_no_chunk(self):
         inst, sock, map = self._makeOneWithMap()
         self.assertEqual(inst.received(b''), False)
@@ -391,6 +707,101 @@ class TestHTTPChannel(unittest.TestCase):
         self.assertEqual(len(inst.requests), 2)
         self.assertEqual(len(inst.server.tasks), 1)
 
+    @unittest.skipIf(PY2, "re can't search a memoryview on Python 2")
+    def test_received_memoryview_pipelined(self):
+        from waitress.adjustments import Adjustments
+        inst, sock, map = self._makeOneWithMap()
+        inst.server = DummyServer()
+        inst.adj = Adjustments()
+        buf = bytearray(
+            b'GET /a HTTP/1.1\r\n\r\n'
+            b'POST /b HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc'
+            b'GET /c HTTP/1.1\r\nHost: ')
+        inst.received(memoryview(buf))
+        # the caller reuses its buffer once received() returns
+        buf[:] = b'x' * len(buf)
+        self.assertEqual([r.path for r in inst.requests], ['/a', '/b'])
+        self.assertEqual(inst.requests[1].get_body_stream().read(), b'abc')
+        self.assertEqual(inst.request.header_plus,
+                         b'GET /c HTTP/1.1\r\nHost: ')
+        inst.received(memoryview(b'example.com\r\n\r\n'))
+        self.assertEqual(inst.request, None)
+        self.assertEqual(inst.requests[0].headers['HOST'], 'example.com')
+
+    def _makeStreaming(self):
+        from waitress.adjustments import Adjustments
+        adj = Adjustments(stream_request_body=True, inbuf_overflow=4)
+        inst, sock, map = self._makeOneWithMap(adj=adj)
+        inst.server = DummyServer()
+        return inst
+
+    def test_received_stream_request_body(self):
+        inst = self._makeStreaming()
+        inst.received(b'GET / HTTP/1.1\nContent-Length: 6\n\nabc')
+        request = inst.request
+        self.assertTrue(request.streaming)
+        self.assertEqual(inst.requests, [request])
+        self.assertEqual(inst.server.tasks, [inst])
+        stream = request.body_stream
+        self.assertEqual(stream.wake, inst.pull_trigger)
+        self.assertEqual(inst.readable(), True)
+        inst.received(b'de')
+        self.assertEqual(inst.readable(), False) # the buffer is full
+        self.assertEqual(stream.read(2), b'ab')
+        self.assertEqual(inst.readable(), True)
+        inst.received(b'fGET / HTTP/1.1\n\n')
+        self.assertTrue(stream.finished)
+        self.assertEqual(inst.request, None)
+        self.assertEqual(inst.server.tasks, [inst])
+        self.assertEqual(inst.pending, b'GET / HTTP/1.1\n\n')
+        self.assertEqual(inst.readable(), False)
+        self.assertEqual(inst.writable(), False)
+
+    def test_handle_write_parses_pending(self):
+        inst = self._makeStreaming()
+        inst.pending = b'GET / HTTP/1.1\n\n'
+        inst.requests = []
+        self.assertEqual(inst.writable(), True)
+        inst.handle_write()
+        self.assertEqual(inst.pending, b'')
+        self.assertEqual(len(inst.requests), 1)
+        self.assertEqual(inst.server.tasks, [inst])
+
+    def test_handle_write_drops_pending_when_closing(self):
+        inst = self._makeStreaming()
+        inst.pending = b'GET / HTTP/1.1\n\n'
+        inst.requests = []
+        inst.close_when_flushed = True
+        inst.handle_write()
+        self.assertEqual(inst.pending, b'')
+        self.assertEqual(inst.requests, [])
+
+    def test_handle_close_aborts_streamed_body(self):
+        inst = self._makeStreaming()
+        inst.received(b'GET / HTTP/1.1\nContent-Length: 6\n\nabc')
+        stream = inst.request.body_stream
+        inst.handle_close()
+        self.assertTrue(stream.aborted)
+
+    def test_service_streamed_body_not_finished(self):
+        inst = self._makeStreaming()
+        inst.received(b'GET / HTTP/1.1\nContent-Length: 6\n\nabc')
+        request = inst.request
+        inst.task_class = DummyTaskClass()
+        inst.service()
+        self.assertEqual(inst.requests, [])
+        self.assertTrue(inst.close_when_flushed)
+        self.assertTrue(request.body_stream.aborted)
+        self.assertEqual(inst.readable(), False)
+
+    def test_service_streamed_body_finished(self):
+        inst = self._makeStreaming()
+        inst.received(b'GET / HTTP/1.1\nContent-Length: 3\n\nabc')
+        inst.task_class = DummyTaskClass()
+        inst.service()
+        self.assertEqual(inst.requests, [])
+        self.assertFalse(inst.close_when_flushed)
+
     def test_received_headers_finished_expect_continue_false(self):
         inst, sock, map = self._makeOneWithMap()
         inst.server = DummyServer()
@@ -447,6 +858,200 @@ class TestHTTPChannel(unittest.TestCase):
         self.assertTrue(inst.force_flush)
         self.assertTrue(inst.last_activity)
 
+    def _makePipelined(self, depth=3):
+        from waitress.adjustments import Adjustments
+        adj = Adjustments(pipeline_depth=depth)
+        inst, sock, map = self._makeOneWithMap(adj=adj)
+        inst.server = DummyServer()
+        inst.task_class = PathTask
+        return inst
+
+    def test_received_pipeline_depth(self):
+        from waitress.channel import PipelineSlot
+        inst = self._makePipelined()
+        self.assertEqual(inst.readable(), True)
+        inst.received(b'GET /a HTTP/1.1\n\nGET /b HTTP/1.1\n\n')
+        slots = inst.server.tasks
+        self.assertEqual(len(slots), 2)
+        self.assertTrue(isinstance(slots[0], PipelineSlot))
+        self.assertEqual([s.request.path for s in slots], ['/a', '/b'])
+        self.assertEqual(inst.requests, [s.request for s in slots])
+        self.assertEqual(slots[0].outbufs, None) # writes to the channel
+        self.assertEqual(len(slots[1].outbufs), 1)
+        self.assertEqual(inst.readable(), True)
+        inst.received(b'GET /c HTTP/1.1\n\n')
+        self.assertEqual(len(inst.server.tasks), 3)
+        self.assertEqual(inst.readable(), False)
+
+    def test_pipeline_slots_finish_out_of_order(self):
+        inst = self._makePipelined()
+        inst.received(b'GET /a HTTP/1.1\n\nGET /b HTTP/1.1\n\n'
+                      b'GET /c HTTP/1.1\n\n')
+        a, b, c = inst.server.tasks
+        c.service()
+        b.service()
+        self.assertEqual(inst.outbufs[-1].get(), b'')
+        self.assertEqual(len(inst.requests), 3)
+        a.service()
+        self.assertEqual(inst.requests, [])
+        self.assertEqual(len(inst.slots), 0)
+        self.assertEqual(
+            b''.join(o.get() for o in inst.outbufs), b'/a/b/c')
+        self.assertEqual(inst.bytes_written, 6)
+        self.assertEqual(inst.readable(), True)
+
+    def test_pipeline_slot_adopted_while_running(self):
+        inst = self._makePipelined()
+        inst.received(b'GET /a HTTP/1.1\n\nGET /b HTTP/1.1\n\n')
+        a, b = inst.server.tasks
+        b.write_soon(b'one')
+        b.wake_for_output()
+        self.assertFalse(inst.server.trigger_pulled)
+        a.service()
+        self.assertEqual(b.outbufs, None)
+        b.write_soon(b'two')
+        self.assertEqual(
+            b''.join(o.get() for o in inst.outbufs), b'/aonetwo')
+        self.assertEqual(inst.bytes_written, 8)
+
+    def test_pipeline_slot_track_flush(self):
+        inst = self._makePipelined()
+        inst.adj.observer = DummyObserver()
+        inst.received(b'GET /a HTTP/1.1\n\nGET /b HTTP/1.1\n\n')
+        a, b = inst.server.tasks
+        b.service()
+        self.assertEqual(b.flush_task.request, b.request)
+        self.assertEqual(len(inst.flush_marks), 0)
+        a.service()
+        self.assertEqual(inst.flush_marks[-1][1].request, b.request)
+        self.assertEqual(inst.flush_marks[-1][0], 4)
+
+    def test_pipeline_slot_close_on_finish(self):
+        inst = self._makePipelined()
+        inst.received(b'GET /a HTTP/1.1\nX-Close: 1\n\n'
+                      b'GET /b HTTP/1.1\n\nGET /c HTTP/1.1\n\n')
+        a, b, c = inst.server.tasks
+        b.service()
+        a.service()
+        self.assertTrue(inst.close_when_flushed)
+        self.assertEqual(inst.requests, [])
+        self.assertEqual(len(inst.slots), 0)
+        self.assertEqual(inst.readable(), False)
+        c.service()
+        self.assertEqual(
+            b''.join(o.get() for o in inst.outbufs), b'/a')
+
+    def test_pipeline_slot_reject(self):
+        inst = self._makePipelined()
+        inst.received(b'GET /a HTTP/1.1\n\nGET /b HTTP/1.1\n\n')
+        a, b = inst.server.tasks
+        b.reject()
+        a.service()
+        data = b''.join(o.get() for o in inst.outbufs)
+        self.assertTrue(data.startswith(b'/aHTTP/1.1 503 Service Unavailable'))
+        self.assertTrue(inst.close_when_flushed)
+        self.assertEqual(inst.requests, [])
+
+    def test_pipeline_slot_cancel(self):
+        inst = self._makePipelined()
+        inst.received(b'GET /a HTTP/1.1\n\n')
+        slot, = inst.server.tasks
+        self.assertEqual(slot.defer(), None)
+        slot.cancel()
+        self.assertEqual(inst.requests, [])
+        self.assertTrue(inst.close_when_flushed)
+
+    def test_pipeline_slot_waits_for_its_turn(self):
+        import threading
+        inst = self._makePipelined()
+        inst.outbuf_lock = threading.Condition()
+        inst.adj.outbuf_high_watermark = 4
+        inst.adj.outbuf_low_watermark = 2
+        inst.received(b'GET /a HTTP/1.1\n\nGET /b HTTP/1.1\n\n')
+        a, b = inst.server.tasks
+        b.write_soon(b'abcde')
+        thread, errors = self._writeInThread(inst, b'f', b)
+        a.service()
+        # now first in line, it waits for the channel's output to drain
+        self.assertEqual(b.outbufs, None)
+        self.assertEqual(inst.writers_waiting, 1)
+        inst.sendmsg = lambda segments: inst.send(b''.join(segments))
+        with inst.outbuf_lock:
+            inst._flush_some()
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(inst.socket.sent, b'/aabcde')
+        self.assertEqual(inst.outbufs[-1].get(), b'f')
+
+    def test_received_pipeline_depth_defers_continue(self):
+        inst = self._makePipelined()
+        inst.received(b'GET /a HTTP/1.1\n\n'
+                      b'PUT /b HTTP/1.1\nExpect: 100-continue\n'
+                      b'Content-Length: 1\n\n')
+        self.assertEqual(inst.sent_continue, False)
+        slot, = inst.server.tasks
+        slot.service()
+        inst.received(b'')
+        self.assertEqual(inst.sent_continue, False)
+        inst.received(b'\n')
+        self.assertEqual(inst.sent_continue, True)
+        self.assertEqual(inst.socket.sent, b'/aHTTP/1.1 100 Continue\r\n\r\n')
+
+    def test_received_pipeline_depth_body_before_continue(self):
+        inst = self._makePipelined()
+        inst.received(b'GET /a HTTP/1.1\n\n'
+                      b'PUT /b HTTP/1.1\nExpect: 100-continue\n'
+                      b'Content-Length: 1\n\nx')
+        self.assertEqual(inst.sent_continue, False)
+        # the PUT waits for the GET to be done, see below
+        self.assertEqual(len(inst.server.tasks), 1)
+        self.assertEqual(inst.requests[1].expect_continue, False)
+
+    def test_received_pipeline_depth_leaves_rest_pending(self):
+        inst = self._makePipelined(depth=2)
+        inst.received(b'GET /a HTTP/1.1\n\nGET /b HTTP/1.1\n\n'
+                      b'GET /c HTTP/1.1\n\n')
+        a, b = inst.server.tasks
+        self.assertEqual(len(inst.requests), 2)
+        self.assertEqual(inst.pending, b'GET /c HTTP/1.1\n\n')
+        self.assertEqual(inst.readable(), False)
+        self.assertEqual(inst.writable(), False)
+        a.service()
+        self.assertEqual(inst.writable(), True)
+        inst.handle_write()
+        self.assertEqual(inst.pending, b'')
+        self.assertEqual([s.request.path for s in inst.server.tasks],
+                         ['/a', '/b', '/c'])
+
+    def test_received_pipeline_depth_stops_after_close(self):
+        inst = self._makePipelined()
+        inst.received(b'GET /a HTTP/1.1\nConnection: close\n\n'
+                      b'GET /b HTTP/1.1\n\n')
+        slot, = inst.server.tasks
+        self.assertEqual(slot.request.path, '/a')
+        self.assertTrue(inst.closing)
+        self.assertEqual(inst.pending, b'')
+        self.assertEqual(inst.readable(), False)
+        self.assertEqual(inst.received(b'GET /c HTTP/1.1\n\n'), False)
+        self.assertEqual(len(inst.server.tasks), 1)
+
+    def test_pipeline_serializes_unsafe_methods(self):
+        inst = self._makePipelined()
+        inst.received(b'GET /a HTTP/1.1\n\nPOST /b HTTP/1.1\n\n'
+                      b'GET /c HTTP/1.1\n\n')
+        self.assertEqual(len(inst.requests), 3)
+        a, = inst.server.tasks
+        a.service()
+        # the POST runs alone, once the GET before it is done
+        self.assertEqual([s.request.path for s in inst.server.tasks],
+                         ['/a', '/b'])
+        inst.server.tasks[1].service()
+        self.assertEqual([s.request.path for s in inst.server.tasks],
+                         ['/a', '/b', '/c'])
+        inst.server.tasks[2].service()
+        self.assertEqual(
+            b''.join(o.get() for o in inst.outbufs), b'/a/b/c')
+
     def test_service_with_one_request(self):
         inst, sock, map = self._makeOneWithMap()
         request = DummyRequest()
@@ -520,6 +1125,20 @@ class TestHTTPChannel(unittest.TestCase):
         self.assertEqual(inst.error_task_class.serviced, False)
         self.assertTrue(request.closed)
 
+    def test_service_with_request_client_disconnected(self):
+        from waitress.channel import ClientDisconnected
+        inst, sock, map = self._makeOneWithMap()
+        inst.server = DummyServer()
+        request = DummyRequest()
+        inst.requests = [request]
+        inst.task_class = DummyTaskClass(ClientDisconnected)
+        inst.logger = DummyLogger()
+        inst.service()
+        self.assertEqual(inst.requests, [])
+        self.assertEqual(len(inst.logger.infos), 1)
+        self.assertEqual(inst.logger.exceptions, [])
+        self.assertTrue(inst.close_when_flushed)
+
     def test_service_with_requests_raises_didnt_write_header_expose_tbs(self):
         inst, sock, map = self._makeOneWithMap()
         inst.adj.expose_tracebacks = True
@@ -570,6 +1189,84 @@ class TestHTTPChannel(unittest.TestCase):
         inst.cancel()
         self.assertEqual(inst.requests, [])
 
+    def test_reject(self):
+        inst, sock, map = self._makeOneWithMap()
+        inst.adj.overload_retry_after = 3
+        requests = [DummyRequest(), DummyRequest()]
+        inst.requests = requests
+        inst.reject()
+        self.assertEqual(inst.requests, [])
+        self.assertTrue(requests[0].closed)
+        self.assertTrue(requests[1].closed)
+        self.assertTrue(inst.close_when_flushed)
+        response = inst.outbufs[0].get()
+        self.assertTrue(
+            response.startswith(b'HTTP/1.0 503 Service Unavailable\r\n'))
+        self.assertTrue(b'\r\nRetry-After: 3\r\n' in response)
+        self.assertTrue(b'\r\nDate: ' in response)
+        inst.handle_write()
+        self.assertEqual(sock.sent, response)
+        self.assertTrue(inst.will_close)
+
+    def test__flush_some_counted(self):
+        from waitress.metrics import Metrics
+        inst, sock, map = self._makeOneWithMap()
+        inst.server = DummyServer()
+        inst.server.metrics = Metrics()
+        inst.outbufs[0].append(b'abc')
+        inst._flush_some()
+        self.assertEqual(inst.server.metrics.bytes_sent.get(), 3)
+
+    def test_add_and_del_channel_counted(self):
+        from waitress.metrics import Metrics
+        inst, sock, map = self._makeOneWithMap()
+        metrics = inst.server.metrics = Metrics()
+        inst.add_channel(map)
+        self.assertEqual(metrics.active_channels.get(), 1)
+        inst.del_channel(map)
+        self.assertEqual(metrics.active_channels.get(), 0)
+        inst.del_channel(map)
+        self.assertEqual(metrics.active_channels.get(), 0)
+
+    def test_reject_counted(self):
+        from waitress.metrics import Metrics
+        inst, sock, map = self._makeOneWithMap()
+        metrics = inst.server.metrics = Metrics()
+        inst.requests = [DummyRequest()]
+        inst.reject()
+        self.assertEqual(metrics.responses['5'].get(), 1)
+
+    def test_track_flush_already_sent(self):
+        inst, sock, map = self._makeOneWithMap()
+        inst.adj.observer = observer = DummyObserver()
+        inst.write_soon(b'abc')
+        inst._flush_some()
+        task = DummyTask()
+        inst.track_flush(task)
+        self.assertEqual(observer.events, [('flushed', task)])
+        self.assertTrue(task.request.flushed_at)
+
+    def test_track_flush_when_sent(self):
+        inst, sock, map = self._makeOneWithMap()
+        inst.adj.observer = observer = DummyObserver()
+        task1, task2 = DummyTask(), DummyTask()
+        inst.write_soon(b'abc')
+        inst.track_flush(task1)
+        inst.write_soon(b'defg')
+        inst.track_flush(task2)
+        self.assertEqual(observer.events, [])
+        sends = [3, 0]
+        sock.send = lambda data: sends.pop(0)
+        inst._flush_some()
+        self.assertEqual(observer.events, [('flushed', task1)])
+        self.assertEqual(inst.bytes_sent, 3)
+        sock.send = lambda data: len(data)
+        inst._flush_some()
+        self.assertEqual(
+            observer.events, [('flushed', task1), ('flushed', task2)])
+        self.assertEqual(inst.bytes_sent, 7)
+        self.assertEqual(len(inst.flush_marks), 0)
+
     def test_defer(self):
         inst, sock, map = self._makeOneWithMap()
         self.assertEqual(inst.defer(), None)
@@ -630,6 +1327,9 @@ class DummyBuffer(object):
         self.data = b''
         return data
 
+    def get_segments(self, numbytes):
+        return [self.get(numbytes)]
+
     def skip(self, num, x):
         self.skipped = num
 
@@ -639,10 +1339,37 @@ class DummyBuffer(object):
     def close(self):
         self.closed = True
 
+class DummySendfileBuffer(object):
+    closed = False
+    sendfile_fd = 5
+
+    def __init__(self, data):
+        self.file = io.BytesIO(data)
+        self.remain = len(data)
+
+    def __len__(self):
+        return self.remain
+
+    def get(self, numbytes):
+        return self.file.getvalue()[self.file.tell():][:numbytes]
+
+    def get_segments(self, numbytes):
+        return [self.get(numbytes)]
+
+    def skip(self, num, allow_prune=0):
+        self.file.seek(num, 1)
+        self.remain -= num
+
+    def close(self):
+        self.closed = True
+
 class DummyAdjustments(object):
     outbuf_overflow = 1048576
+    outbuf_high_watermark = 16777216
+    outbuf_low_watermark = 8388608
     inbuf_overflow = 512000
     cleanup_interval = 900
+    channel_timeout = 300
     send_bytes = 9000
     url_scheme = 'http'
     channel_timeout = 300
@@ -651,18 +1378,29 @@ class DummyAdjustments(object):
     expose_tracebacks = True
     ident = 'waitress'
     max_request_header_size = 10000
+    overload_retry_after = 1
+    observer = None
+    pipeline_depth = 1
 
 class DummyServer(object):
     trigger_pulled = False
     adj = DummyAdjustments()
+    metrics = None
 
     def __init__(self):
         self.tasks = []
         self.active_channels = {}
+        self.expiries = {}
 
     def add_task(self, task):
         self.tasks.append(task)
 
+    def schedule_expiry(self, channel, when):
+        self.expiries[channel] = when
+
+    def cancel_expiry(self, channel):
+        self.expiries.pop(channel, None)
+
     def pull_trigger(self):
         self.trigger_pulled = True
 
@@ -676,6 +1414,8 @@ class DummyParser(object):
     retval = None
     error = None
     connection_close = False
+    body_stream = None
+    streaming = False
 
     def received(self, data):
         self.data = data
@@ -688,6 +1428,9 @@ class DummyRequest(object):
     path = '/'
     version = '1.0'
     closed = False
+    received_at = None
+    queued_at = None
+    streaming = False
 
     def __init__(self):
         self.headers = {}
@@ -695,14 +1438,51 @@ class DummyRequest(object):
     def close(self):
         self.closed = True
 
+class DummyTask(object):
+
+    def __init__(self):
+        self.request = DummyRequest()
+
+class PathTask(object):
+    # writes the path of its request, like a response
+    wrote_header = True
+
+    def __init__(self, channel, request):
+        self.channel = channel
+        self.request = request
+        self.close_on_finish = 'X_CLOSE' in request.headers
+
+    def service(self):
+        self.channel.write_soon(self.request.path.encode('latin-1'))
+        if self.channel.adj.observer is not None:
+            self.channel.track_flush(self)
+
+class DummyObserver(object):
+
+    def __init__(self):
+        self.events = []
+
+    def received(self, request):
+        self.events.append(('received', request))
+
+    def queued(self, request):
+        self.events.append(('queued', request))
+
+    def flushed(self, task):
+        self.events.append(('flushed', task))
+
 class DummyLogger(object):
 
     def __init__(self):
         self.exceptions = []
+        self.infos = []
 
     def exception(self, msg):
         self.exceptions.append(msg)
 
+    def info(self, msg):
+        self.infos.append(msg)
+
 class DummyError(object):
     code = '431'
     reason = 'Bleh'
@@ -10,6 +10,7 @@ import time
 import unittest
 from waitress import server
 from waitress.compat import (
+    PY2,
     httplib,
     tobytes
 )
@@ -442,6 +443,81 @@ class PipeliningTests(object):
             self.assertEqual(length, len(response_body))
             self.assertEqual(response_body, expect_body)
 
+class ParallelPipeliningTests(PipeliningTests):
+
+    def setUp(self):
+        from waitress.tests.fixtureapps import echo
+        self.start_subprocess(echo.app, pipeline_depth=4, threads=4)
+
+class StreamingTests(object):
+
+    def setUp(self):
+        from waitress.tests.fixtureapps import echo
+        self.start_subprocess(echo.app, stream_request_body=True,
+                              inbuf_overflow=1024, channel_timeout=2)
+
+    def tearDown(self):
+        self.stop_subprocess()
+
+    def test_send_with_large_body(self):
+        body = b'x' * 100000
+        to_send = tobytes("GET / HTTP/1.1\n"
+                          "Content-Length: %d\n\n" % len(body)) + body
+        self.connect()
+        self.sock.sendall(to_send)
+        fp = self.sock.makefile('rb', 0)
+        line, headers, response_body = read_http(fp)
+        self.assertline(line, '200', 'OK', 'HTTP/1.1')
+        self.assertEqual(headers.get('content-length'), str(len(body)))
+        self.assertEqual(response_body, body)
+
+    def test_chunking_request_with_content(self):
+        control_line = b"20;\r\n" # 20 hex = 32 dec
+        s = b'This string has 32 characters.\r\n'
+        expected = s * 100
+        header = tobytes(
+            "GET / HTTP/1.1\n"
+            "Transfer-Encoding: chunked\n\n"
+        )
+        self.connect()
+        self.sock.send(header)
+        fp = self.sock.makefile('rb', 0)
+        for n in range(100):
+            self.sock.send(control_line + s)
+        self.sock.send(b"0\r\n\r\n")
+        line, headers, response_body = read_http(fp)
+        self.assertline(line, '200', 'OK', 'HTTP/1.1')
+        self.assertEqual(response_body, expected)
+
+    def test_pipelining_after_streamed_body(self):
+        s = ("GET / HTTP/1.1\r\n"
+             "Content-Length: %d\r\n"
+             "\r\n"
+             "%s")
+        bodies = ['x' * 5000, 'second', 'x' * 3000]
+        to_send = tobytes(''.join(s % (len(body), body) for body in bodies))
+        self.connect()
+        self.sock.sendall(to_send)
+        fp = self.sock.makefile('rb', 0)
+        for body in bodies:
+            line, headers, response_body = read_http(fp)
+            self.assertline(line, '200', 'OK', 'HTTP/1.1')
+            self.assertEqual(response_body, tobytes(body))
+
+    def test_stalled_body_expired(self):
+        to_send = tobytes("GET / HTTP/1.1\n"
+                          "Content-Length: 100000\n\n") + b'x' * 5000
+        self.connect()
+        self.sock.sendall(to_send)
+        self.sock.settimeout(20)
+        # closed once channel_timeout has passed without more of the body,
+        # after the 500 of the task if it got to answer first
+        fp = self.sock.makefile('rb', 0)
+        response = fp.read()
+        if response:
+            self.assertTrue(response.startswith(
+                b'HTTP/1.1 500 Internal Server Error\r\n'))
+
 class ExpectContinueTests(object):
 
     def setUp(self):
@@ -1358,6 +1434,13 @@ class TcpEchoTests(EchoTests, TcpTests, unittest.TestCase):
 class TcpPipeliningTests(PipeliningTests, TcpTests, unittest.TestCase):
     pass
 
+class TcpParallelPipeliningTests(
+        ParallelPipeliningTests, TcpTests, unittest.TestCase):
+    pass
+
+class TcpStreamingTests(StreamingTests, TcpTests, unittest.TestCase):
+    pass
+
 class TcpExpectContinueTests(ExpectContinueTests, TcpTests, unittest.TestCase):
     pass
 
@@ -1382,6 +1465,209 @@ class TcpInternalServerErrorTests(
 class TcpFileWrapperTests(FileWrapperTests, TcpTests, unittest.TestCase):
     pass
 
+class FixtureSelectorsServer(FixtureTcpWSGIServer):
+    """Polls its sockets with a wasyncore.selector_map.
+    """
+
+    def __init__(self, application, queue, **kw): # pragma: no cover
+        kw['asyncore_use_selectors'] = True
+        super(FixtureSelectorsServer, self).__init__(application, queue, **kw)
+
+class SelectorsTests(TcpTests):
+
+    server = FixtureSelectorsServer
+
+class SelectorsEchoTests(EchoTests, SelectorsTests, unittest.TestCase):
+    pass
+
+class SelectorsPipeliningTests(
+        PipeliningTests, SelectorsTests, unittest.TestCase):
+    pass
+
+class SelectorsParallelPipeliningTests(
+        ParallelPipeliningTests, SelectorsTests, unittest.TestCase):
+    pass
+
+class SelectorsStreamingTests(
+        StreamingTests, SelectorsTests, unittest.TestCase):
+    pass
+
+class SelectorsNoContentLengthTests(
+        NoContentLengthTests, SelectorsTests, unittest.TestCase):
+    pass
+
+class SelectorsWriteCallbackTests(
+        WriteCallbackTests, SelectorsTests, unittest.TestCase):
+    pass
+
+class SelectorsFileWrapperTests(
+        FileWrapperTests, SelectorsTests, unittest.TestCase):
+    pass
+
+if not PY2:
+
+    class FixtureAsyncioServer(object):
+        """Serves with io_backend='asyncio' and relays back what it's bound to.
+        """
+
+        family = socket.AF_INET # Testing
+
+        def __init__(self, application, queue, **kw): # pragma: no cover
+            # Coverage doesn't see this as it's ran in a separate process.
+            self.server = server.create_server(
+                application, host='127.0.0.1', port=0, io_backend='asyncio',
+                **kw)
+            queue.put(('127.0.0.1', int(self.server.effective_port)))
+
+        def run(self): # pragma: no cover
+            self.server.run()
+
+    class AsyncioTests(TcpTests):
+
+        server = FixtureAsyncioServer
+
+    class AsyncioEchoTests(EchoTests, AsyncioTests, unittest.TestCase):
+        pass
+
+    class AsyncioPipeliningTests(
+            PipeliningTests, AsyncioTests, unittest.TestCase):
+        pass
+
+    class AsyncioParallelPipeliningTests(
+            ParallelPipeliningTests, AsyncioTests, unittest.TestCase):
+        pass
+
+    class AsyncioStreamingTests(
+            StreamingTests, AsyncioTests, unittest.TestCase):
+        pass
+
+    class AsyncioExpectContinueTests(
+            ExpectContinueTests, AsyncioTests, unittest.TestCase):
+        pass
+
+    class AsyncioBadContentLengthTests(
+            BadContentLengthTests, AsyncioTests, unittest.TestCase):
+        pass
+
+    class AsyncioNoContentLengthTests(
+            NoContentLengthTests, AsyncioTests, unittest.TestCase):
+        pass
+
+    class AsyncioWriteCallbackTests(
+            WriteCallbackTests, AsyncioTests, unittest.TestCase):
+        pass
+
+    class AsyncioTooLargeTests(TooLargeTests, AsyncioTests, unittest.TestCase):
+        pass
+
+    class AsyncioInternalServerErrorTests(
+            InternalServerErrorTests, AsyncioTests, unittest.TestCase):
+        pass
+
+    class AsyncioFileWrapperTests(
+            FileWrapperTests, AsyncioTests, unittest.TestCase):
+        pass
+
+    class FixtureASGIServer(FixtureAsyncioServer):
+        """Serves with asgi=True; WSGI fixture applications are adapted.
+        """
+
+        def __init__(self, application, queue, **kw): # pragma: no cover
+            from waitress.tests.fixtureapps import asgi
+            kw['asgi'] = True
+            super(FixtureASGIServer, self).__init__(
+                asgi.wrap(application), queue, **kw)
+
+    class ASGITests(TcpTests):
+
+        server = FixtureASGIServer
+
+    class ASGIAppTests(ASGITests, unittest.TestCase):
+
+        def setUp(self):
+            from waitress.tests.fixtureapps import asgi
+            self.start_subprocess(asgi.app)
+
+        def tearDown(self):
+            self.stop_subprocess()
+
+        def test_path(self):
+            to_send = tobytes('GET /caf%C3%A9 HTTP/1.1\r\n\r\n')
+            self.connect()
+            self.sock.send(to_send)
+            fp = self.sock.makefile('rb', 0)
+            line, headers, response_body = read_http(fp)
+            self.assertline(line, '200', 'OK', 'HTTP/1.1')
+            self.assertEqual(response_body, u'GET /caf\xe9'.encode('utf-8'))
+
+        def test_stream(self):
+            to_send = tobytes('GET /stream HTTP/1.1\r\n\r\n')
+            self.connect()
+            self.sock.send(to_send)
+            fp = self.sock.makefile('rb', 0)
+            line, headers, response_body = read_http(fp)
+            self.assertline(line, '200', 'OK', 'HTTP/1.1')
+            self.assertEqual(headers['transfer-encoding'], 'chunked')
+            self.assertEqual(
+                response_body,
+                b'7\r\nchunk0\n\r\n7\r\nchunk1\n\r\n7\r\nchunk2\n\r\n'
+                b'0\r\n\r\n')
+
+        def test_long_poll(self):
+            # the waiting request holds up neither the loop nor a thread
+            self.connect()
+            self.sock.send(tobytes('GET /wait HTTP/1.1\r\n\r\n'))
+            time.sleep(0.2)
+            other = self.create_socket()
+            try:
+                other.connect(self.bound_to)
+                other.send(tobytes('GET /release HTTP/1.1\r\n\r\n'))
+                line, headers, response_body = read_http(
+                    other.makefile('rb', 0))
+                self.assertline(line, '204', 'No Content', 'HTTP/1.1')
+            finally:
+                other.close()
+            fp = self.sock.makefile('rb', 0)
+            line, headers, response_body = read_http(fp)
+            self.assertline(line, '200', 'OK', 'HTTP/1.1')
+            self.assertEqual(response_body, b'released')
+
+        def test_error_before_start(self):
+            to_send = tobytes('GET /error HTTP/1.1\r\n\r\n')
+            self.connect()
+            self.sock.send(to_send)
+            fp = self.sock.makefile('rb', 0)
+            line, headers, response_body = read_http(fp)
+            self.assertline(line, '500', 'Internal Server Error', 'HTTP/1.1')
+            self.assertTrue(response_body.startswith(b'Internal Server Error'))
+
+        def test_error_after_start(self):
+            to_send = tobytes('GET /error_after_start HTTP/1.1\r\n\r\n')
+            self.connect()
+            self.sock.send(to_send)
+            fp = self.sock.makefile('rb', 0)
+            line, headers, response_body = read_http(fp)
+            self.assertline(line, '200', 'OK', 'HTTP/1.1')
+            # the response is cut short and the connection closed
+            self.assertEqual(response_body, b'2\r\nab\r\n')
+
+    class ASGIEchoTests(EchoTests, ASGITests, unittest.TestCase):
+        pass
+
+    class ASGIPipeliningTests(PipeliningTests, ASGITests, unittest.TestCase):
+        pass
+
+    class ASGIExpectContinueTests(
+            ExpectContinueTests, ASGITests, unittest.TestCase):
+        pass
+
+    class ASGIBadContentLengthTests(
+            BadContentLengthTests, ASGITests, unittest.TestCase):
+        pass
+
+    class ASGITooLargeTests(TooLargeTests, ASGITests, unittest.TestCase):
+        pass
+
 if hasattr(socket, 'AF_UNIX'):
 
     class FixtureUnixWSGIServer(server.UnixWSGIServer):
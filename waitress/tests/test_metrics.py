@@ -0,0 +1,353 @@
+import socket
+import threading
+import unittest
+
+class TestCounter(unittest.TestCase):
+
+    def _makeOne(self, labels=None):
+        from waitress.metrics import Counter
+        return Counter('test_total', 'Some help.', labels)
+
+    def test_inc(self):
+        inst = self._makeOne()
+        inst.inc()
+        inst.inc(5)
+        self.assertEqual(inst.get(), 6)
+        self.assertEqual(len(inst.cells), 1)
+
+    def test_inc_other_threads(self):
+        inst = self._makeOne()
+        inst.inc()
+        threads = [threading.Thread(target=inst.inc, args=(2,))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(inst.get(), 7)
+
+    def test_samples(self):
+        inst = self._makeOne({'status': '2xx'})
+        inst.inc(3)
+        self.assertEqual(list(inst.samples()),
+                         [('test_total', {'status': '2xx'}, 3)])
+
+class TestGauge(unittest.TestCase):
+
+    def _makeOne(self, function=None):
+        from waitress.metrics import Gauge
+        return Gauge('test', 'Some help.', function=function)
+
+    def test_inc_dec(self):
+        inst = self._makeOne()
+        inst.inc(3)
+        inst.dec()
+        self.assertEqual(inst.get(), 2)
+
+    def test_function(self):
+        inst = self._makeOne(function=lambda: 42)
+        inst.inc()
+        self.assertEqual(inst.get(), 42)
+
+class TestHistogram(unittest.TestCase):
+
+    def _makeOne(self):
+        from waitress.metrics import Histogram
+        return Histogram('test_seconds', 'Some help.', buckets=(0.1, 1.0))
+
+    def test_samples(self):
+        inst = self._makeOne()
+        for value in (0.05, 0.1, 0.5, 2.0):
+            inst.observe(value)
+        self.assertEqual(list(inst.samples()), [
+            ('test_seconds_bucket', {'le': '0.1'}, 2),
+            ('test_seconds_bucket', {'le': '1.0'}, 3),
+            ('test_seconds_bucket', {'le': '+Inf'}, 4),
+            ('test_seconds_sum', None, 2.65),
+            ('test_seconds_count', None, 4),
+        ])
+
+    def test_samples_empty(self):
+        inst = self._makeOne()
+        samples = list(inst.samples())
+        self.assertEqual(samples[2], ('test_seconds_bucket', {'le': '+Inf'}, 0))
+        self.assertEqual(samples[4], ('test_seconds_count', None, 0))
+
+class TestMetrics(unittest.TestCase):
+
+    def _makeOne(self, observer=None):
+        from waitress.metrics import Metrics
+        return Metrics(observer)
+
+    def test_render(self):
+        inst = self._makeOne()
+        inst.requests.inc(2)
+        inst.responses['2'].inc()
+        inst.queue_depth.function = lambda: 3
+        lines = inst.render().decode('ascii').splitlines()
+        self.assertTrue('# TYPE waitress_requests_total counter' in lines)
+        self.assertTrue('waitress_requests_total 2' in lines)
+        self.assertTrue('waitress_responses_total{status="2xx"} 1' in lines)
+        self.assertTrue('waitress_responses_total{status="5xx"} 0' in lines)
+        self.assertTrue('waitress_queue_depth 3' in lines)
+        self.assertTrue('# TYPE waitress_app_seconds histogram' in lines)
+        self.assertTrue(
+            'waitress_app_seconds_bucket{le="+Inf"} 0' in lines)
+        # one HELP and TYPE per name
+        self.assertEqual(
+            len([l for l in lines if l.startswith(
+                '# HELP waitress_responses_total ')]), 1)
+
+    def test_observer_events(self):
+        observer = DummyObserver()
+        inst = self._makeOne(observer)
+        task = DummyTask('404 Not Found')
+        inst.received(task.request)
+        inst.queued(task.request)
+        inst.started(task)
+        inst.finished(task)
+        inst.flushed(task)
+        self.assertEqual(observer.events, [
+            ('received', task.request), ('queued', task.request),
+            ('started', task), ('finished', task), ('flushed', task)])
+        self.assertEqual(inst.requests.get(), 1)
+        self.assertEqual(inst.responses['4'].get(), 1)
+        samples = dict((name, value) for name, labels, value
+                       in inst.queue_wait.samples())
+        self.assertEqual(samples['waitress_queue_wait_seconds_count'], 1)
+        self.assertAlmostEqual(
+            samples['waitress_queue_wait_seconds_sum'], 1.5)
+        samples = dict((name, value) for name, labels, value
+                       in inst.app_time.samples())
+        self.assertAlmostEqual(samples['waitress_app_seconds_sum'], 2.0)
+        samples = dict((name, value) for name, labels, value
+                       in inst.latency.samples())
+        self.assertAlmostEqual(
+            samples['waitress_request_duration_seconds_sum'], 5.0)
+
+    def test_observer_events_unknown_status(self):
+        inst = self._makeOne()
+        task = DummyTask('999 Odd')
+        task.request.queued_at = task.request.received_at = None
+        inst.started(task)
+        inst.finished(task)
+        inst.flushed(task)
+        self.assertEqual(
+            sum(counter.get() for counter in inst.responses.values()), 0)
+
+class TestMetricsChannel(unittest.TestCase):
+
+    def _makeOne(self):
+        from waitress.metrics import (
+            Metrics,
+            MetricsChannel,
+        )
+        self.sock, self.client = socket.socketpair()
+        self.map = {}
+        return MetricsChannel(Metrics(), self.sock, self.map)
+
+    def tearDown(self):
+        self.sock.close()
+        self.client.close()
+
+    def test_respond(self):
+        inst = self._makeOne()
+        response = inst.respond(b'GET /metrics?x=1 HTTP/1.1\r\n\r\n')
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.0 200 OK\r\n'))
+        content_length = ('Content-Length: %d\r\n' % len(body)).encode()
+        self.assertTrue(content_length in head + b'\r\n')
+        self.assertTrue(b'waitress_requests_total 0\n' in body)
+
+    def test_respond_head(self):
+        inst = self._makeOne()
+        response = inst.respond(b'HEAD /metrics HTTP/1.1\r\n\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.0 200 OK\r\n'))
+        self.assertTrue(response.endswith(b'\r\n\r\n'))
+
+    def test_respond_not_found(self):
+        inst = self._makeOne()
+        response = inst.respond(b'GET / HTTP/1.1\r\n\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.0 404 Not Found\r\n'))
+
+    def test_respond_bad_method(self):
+        inst = self._makeOne()
+        response = inst.respond(b'POST /metrics HTTP/1.1\r\n\r\n')
+        self.assertTrue(
+            response.startswith(b'HTTP/1.0 405 Method Not Allowed\r\n'))
+
+    def test_respond_garbage(self):
+        inst = self._makeOne()
+        response = inst.respond(b'\r\n\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.0 400 Bad Request\r\n'))
+
+    def test_request_response(self):
+        inst = self._makeOne()
+        self.client.sendall(b'GET /metrics HTTP/1.0\r\n')
+        inst.handle_read()
+        self.assertEqual(inst.outbuf, b'')
+        self.assertTrue(inst.readable())
+        self.client.sendall(b'\r\n')
+        inst.handle_read()
+        self.assertFalse(inst.readable())
+        self.assertTrue(inst.writable())
+        response = inst.outbuf
+        inst.handle_write()
+        self.assertEqual(self.map, {})
+        self.assertEqual(self.client.recv(len(response) + 1), response)
+
+    def test_request_too_large(self):
+        inst = self._makeOne()
+        inst.max_request_size = 10
+        self.client.sendall(b'GET /metrics HTTP/1.0\r\n')
+        inst.handle_read()
+        self.assertEqual(self.map, {})
+
+    def test_deadline(self):
+        from waitress.metrics import (
+            Metrics,
+            MetricsChannel,
+        )
+        self.sock, self.client = socket.socketpair()
+        self.map = {}
+        channels = set()
+        inst = MetricsChannel(Metrics(), self.sock, self.map, 10, channels)
+        self.assertEqual(channels, set([inst]))
+        # a partial request doesn't move the deadline
+        deadline = inst.deadline
+        self.client.sendall(b'GET /metrics HTTP/1.0\r\n')
+        inst.handle_read()
+        self.assertEqual(inst.deadline, deadline)
+        self.client.sendall(b'\r\n')
+        inst.handle_read()
+        self.assertTrue(inst.deadline >= deadline)
+        inst.close()
+        self.assertEqual(channels, set())
+        self.assertEqual(self.map, {})
+
+class TestMetricsServer(unittest.TestCase):
+
+    def _makeOne(self, map, metrics=None, timeout=120):
+        from waitress.metrics import (
+            Metrics,
+            MetricsServer,
+        )
+        if metrics is None:
+            metrics = Metrics()
+        sockinfo = (socket.AF_INET, socket.SOCK_STREAM, 0, ('127.0.0.1', 0))
+        inst = MetricsServer(metrics, sockinfo, map, timeout)
+        self.addCleanup(inst.close)
+        return inst
+
+    def _accept(self, inst, count):
+        from waitress import wasyncore
+        clients = []
+        for i in range(count):
+            client = socket.create_connection(
+                ('127.0.0.1', inst.effective_port))
+            self.addCleanup(client.close)
+            clients.append(client)
+        for i in range(count * 10):
+            if len(inst.channels) >= count or not inst.readable():
+                break
+            wasyncore.loop(timeout=0.05, map=inst._map, count=1)
+        return clients
+
+    def test_max_channels(self):
+        from waitress import wasyncore
+        map = {}
+        inst = self._makeOne(map)
+        inst.max_channels = 2
+        self.addCleanup(wasyncore.close_all, map)
+        self._accept(inst, 3)
+        self.assertEqual(len(inst.channels), 2)
+        self.assertFalse(inst.readable())
+        self.assertEqual(len(map), 3)
+
+    def test_idle_channels_closed(self):
+        from waitress import wasyncore
+        map = {}
+        inst = self._makeOne(map, timeout=0)
+        self.addCleanup(wasyncore.close_all, map)
+        inst.readable = lambda: True
+        clients = self._accept(inst, 1)
+        self.assertEqual(len(inst.channels), 1)
+        del inst.readable
+        self.assertTrue(inst.readable())
+        channel, = inst.channels
+        self.assertTrue(channel.will_close)
+        self.assertFalse(channel.readable())
+        self.assertTrue(channel.writable())
+        wasyncore.loop(timeout=0.05, map=map, count=1)
+        self.assertEqual(inst.channels, set())
+        self.assertEqual(list(map.values()), [inst])
+        self.assertEqual(clients[0].recv(1), b'')
+        # looked for once a second only
+        clients = self._accept(inst, 1)
+        self.assertEqual(len(inst.channels), 1)
+
+    def test_serves_metrics(self):
+        from waitress.metrics import (
+            Metrics,
+            MetricsServer,
+        )
+        from waitress import wasyncore
+        map = {}
+        metrics = Metrics()
+        metrics.requests.inc(7)
+        sockinfo = (socket.AF_INET, socket.SOCK_STREAM, 0, ('127.0.0.1', 0))
+        inst = MetricsServer(metrics, sockinfo, map)
+        try:
+            self.assertTrue(inst.readable())
+            self.assertFalse(inst.writable())
+            client = socket.create_connection(
+                ('127.0.0.1', inst.effective_port))
+            client.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+            response = b''
+            client.settimeout(0)
+            for i in range(50):
+                wasyncore.loop(timeout=0.1, map=map, count=1)
+                try:
+                    data = client.recv(65536)
+                except socket.error:
+                    continue
+                if not data:
+                    break
+                response += data
+            client.close()
+            self.assertTrue(b'\nwaitress_requests_total 7\n' in response)
+        finally:
+            wasyncore.close_all(map)
+
+class DummyObserver(object):
+
+    def __init__(self):
+        self.events = []
+
+    def received(self, request):
+        self.events.append(('received', request))
+
+    def queued(self, request):
+        self.events.append(('queued', request))
+
+    def started(self, task):
+        self.events.append(('started', task))
+
+    def finished(self, task):
+        self.events.append(('finished', task))
+
+    def flushed(self, task):
+        self.events.append(('flushed', task))
+
+class DummyRequest(object):
+    received_at = 10.0
+    queued_at = 10.5
+    started_at = 12.0
+    finished_at = 14.0
+    flushed_at = 15.0
+
+class DummyTask(object):
+
+    def __init__(self, status):
+        self.status = status
+        self.request = DummyRequest()
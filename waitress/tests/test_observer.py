@@ -0,0 +1,15 @@
+import unittest
+
+class TestRequestObserver(unittest.TestCase):
+
+    def _makeOne(self):
+        from waitress.observer import RequestObserver
+        return RequestObserver()
+
+    def test_methods_do_nothing(self):
+        inst = self._makeOne()
+        self.assertEqual(inst.received(None), None)
+        self.assertEqual(inst.queued(None), None)
+        self.assertEqual(inst.started(None), None)
+        self.assertEqual(inst.finished(None), None)
+        self.assertEqual(inst.flushed(None), None)
@@ -16,6 +16,7 @@
 import unittest
 
 from waitress.compat import (
+    PY2,
     text_,
     tobytes,
 )
@@ -82,6 +83,47 @@ GET /foobar HTTP/8.4
         self.assertFalse(self.parser.completed)
         self.assertEqual(self.parser.headers, {})
 
+    @unittest.skipIf(PY2, "re can't search a memoryview on Python 2")
+    def test_received_memoryview(self):
+        data = bytearray(b'GET /foobar HTTP/1.1\r\nHost: ')
+        result = self.parser.received(memoryview(data))
+        self.assertEqual(result, len(data))
+        data[:] = b'x' * len(data)
+        data = bytearray(b'localhost\r\n\r\nGET / HTTP/1.1')
+        result = self.parser.received(memoryview(data))
+        self.assertEqual(result, 13)
+        data[:] = b'x' * len(data)
+        self.assertTrue(self.parser.completed)
+        self.assertEqual(self.parser.path, '/foobar')
+        self.assertEqual(self.parser.headers, {'HOST': 'localhost'})
+
+    def test_received_trickled_header(self):
+        data = b'GET /foobar HTTP/1.1\r\nHost: localhost\r\n\r\nabc'
+        for i in range(len(data) - 3):
+            result = self.parser.received(data[i:i + 1])
+            self.assertEqual(result, 1)
+            if i == 0:
+                header_plus = self.parser.header_plus
+            elif not self.parser.completed:
+                # grown in place
+                self.assertTrue(self.parser.header_plus is header_plus)
+        self.assertTrue(self.parser.completed)
+        self.assertEqual(self.parser.header_plus, b'')
+        self.assertEqual(self.parser.headers, {'HOST': 'localhost'})
+
+    def test_received_terminator_split_across_reads(self):
+        for head, tail in ((b'\n', b'\n'), (b'\r\n', b'\r\n'),
+                           (b'\r\n\r', b'\n'), (b'\r', b'\n\r\nx')):
+            from waitress.parser import HTTPRequestParser
+            parser = HTTPRequestParser(self.parser.adj)
+            data = b'GET /foobar HTTP/1.1' + head
+            self.assertEqual(parser.received(data), len(data))
+            self.assertFalse(parser.completed)
+            result = parser.received(tail)
+            self.assertEqual(result, len(tail.rstrip(b'x')))
+            self.assertTrue(parser.completed)
+            self.assertEqual(parser.path, '/foobar')
+
     def test_received_already_completed(self):
         self.parser.completed = True
         result = self.parser.received(b'a')
@@ -174,6 +216,32 @@ foo: bar"""
         self.assertEqual(self.parser.first_line, b'GET /foobar HTTP/8.4')
         self.assertEqual(self.parser.headers['FOO'], 'bar')
 
+    def test_parse_header_learns_header_keys(self):
+        from waitress import parser
+        data = b"GET /foobar HTTP/1.1\nX-Learned-Name: a\nx-learned-name: b"
+        self.parser.parse_header(data)
+        self.assertEqual(self.parser.headers['X_LEARNED_NAME'], 'a, b')
+        self.assertEqual(parser.header_keys[b'X-Learned-Name'],
+                         'X_LEARNED_NAME')
+        self.assertEqual(parser.header_keys[b'x-learned-name'],
+                         'X_LEARNED_NAME')
+        self.assertEqual(parser.environ_keys['X_LEARNED_NAME'],
+                         'HTTP_X_LEARNED_NAME')
+        self.assertEqual(parser.environ_keys['CONTENT_TYPE'], 'CONTENT_TYPE')
+
+    def test_parse_header_header_keys_full(self):
+        from waitress import parser
+        saved = parser.header_cache_size
+        parser.header_cache_size = 0
+        try:
+            data = b"GET /foobar HTTP/1.1\nX-Unlearned-Name: a"
+            self.parser.parse_header(data)
+        finally:
+            parser.header_cache_size = saved
+        self.assertEqual(self.parser.headers['X_UNLEARNED_NAME'], 'a')
+        self.assertFalse(b'X-Unlearned-Name' in parser.header_keys)
+        self.assertFalse('X_UNLEARNED_NAME' in parser.environ_keys)
+
     def test_parse_header_no_cr_in_headerplus(self):
         data = b"GET /foobar HTTP/8.4"
         self.parser.parse_header(data)
@@ -201,6 +269,64 @@ foo: bar"""
         self.parser.parse_header(data)
         self.assertEqual(self.parser.connection_close, True)
 
+    def test_received_stream_request_body(self):
+        from waitress.buffers import StreamBuffer
+        self.parser.adj.stream_request_body = True
+        data = b"GET /foobar HTTP/1.1\nContent-Length: 6\n\n"
+        self.assertEqual(self.parser.received(data), len(data))
+        stream = self.parser.body_stream
+        self.assertTrue(isinstance(stream, StreamBuffer))
+        self.assertTrue(self.parser.get_body_stream() is stream)
+        self.assertEqual(self.parser.received(b'abc'), 3)
+        self.assertFalse(stream.finished)
+        self.assertEqual(self.parser.received(b'def'), 3)
+        self.assertTrue(self.parser.completed)
+        self.assertTrue(stream.finished)
+        self.assertEqual(stream.read(), b'abcdef')
+
+    def test_received_stream_request_body_chunked_error(self):
+        self.parser.adj.stream_request_body = True
+        self.parser.streaming = True
+        data = b"GET /foobar HTTP/1.1\nTransfer-Encoding: chunked\n\n"
+        self.parser.received(data)
+        self.parser.received(b'garbage\n')
+        self.assertTrue(self.parser.completed)
+        self.assertTrue(self.parser.error is not None)
+        self.assertTrue(self.parser.body_stream.aborted)
+
+    def test_received_stream_request_body_chunked_no_content_length(self):
+        self.parser.adj.stream_request_body = True
+        self.parser.streaming = True
+        data = b"GET /foobar HTTP/1.1\nTransfer-Encoding: chunked\n\n"
+        self.parser.received(data)
+        self.parser.received(b'3\r\nabc\r\n0\r\n\r\n')
+        self.assertTrue(self.parser.completed)
+        self.assertTrue(self.parser.body_stream.finished)
+        self.assertFalse('CONTENT_LENGTH' in self.parser.headers)
+
+    def test_get_body_view(self):
+        data = b"GET /foobar HTTP/1.1\nContent-Length: 6\n\nabcdef"
+        consumed = self.parser.received(data)
+        self.parser.received(data[consumed:])
+        self.assertTrue(self.parser.completed)
+        self.assertEqual(self.parser.get_body_view().tobytes(), b'abcdef')
+
+    def test_get_body_view_no_body(self):
+        self.parser.received(b"GET /foobar HTTP/1.1\n\n")
+        self.assertEqual(self.parser.get_body_view().tobytes(), b'')
+
+    def test_inbuf_use_memfd(self):
+        from waitress.buffers import MemfdBasedBuffer
+        self.parser.adj.inbuf_use_memfd = True
+        self.parser.adj.inbuf_overflow = 4
+        data = b"GET /foobar HTTP/1.1\nContent-Length: 6\n\nabcdef"
+        consumed = self.parser.received(data)
+        self.parser.received(data[consumed:])
+        buf = self.parser.body_rcv.getbuf()
+        self.assertTrue(isinstance(buf.buf, MemfdBasedBuffer))
+        self.assertEqual(self.parser.get_body_view().tobytes(), b'abcdef')
+        self.parser.close()
+
     def test_close_with_body_rcv(self):
         body_rcv = DummyBodyStream()
         self.parser.body_rcv = body_rcv
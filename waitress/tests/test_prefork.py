@@ -0,0 +1,403 @@
+import errno
+import os
+import signal
+import socket
+import sys
+import unittest
+
+if not sys.platform.startswith("win"):
+
+    class Test_bind_sockets(unittest.TestCase):
+
+        def _callFUT(self, **kw):
+            from waitress.adjustments import Adjustments
+            from waitress.prefork import bind_sockets
+            return bind_sockets(Adjustments(**kw))
+
+        def test_listen(self):
+            sockets = self._callFUT(listen='127.0.0.1:0 127.0.0.1:0')
+            try:
+                self.assertEqual(len(sockets), 2)
+                for sock in sockets:
+                    self.assertEqual(sock.getsockname()[0], '127.0.0.1')
+                    client = socket.create_connection(sock.getsockname())
+                    client.close()
+            finally:
+                for sock in sockets:
+                    sock.close()
+
+        def test_unix_socket(self):
+            import tempfile
+            path = os.path.join(tempfile.mkdtemp(), 'waitress.sock')
+            sockets = self._callFUT(unix_socket=path, unix_socket_perms='600')
+            try:
+                self.assertEqual(len(sockets), 1)
+                self.assertEqual(sockets[0].getsockname(), path)
+                self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            finally:
+                sockets[0].close()
+                os.remove(path)
+                os.rmdir(os.path.dirname(path))
+
+        def test_bind_fails(self):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.listen(1)
+            try:
+                self.assertRaises(
+                    socket.error, self._callFUT,
+                    listen='127.0.0.1:0 127.0.0.1:%d' % sock.getsockname()[1])
+            finally:
+                sock.close()
+
+    class TestMaster(unittest.TestCase):
+
+        def _makeOne(self, loader=None, workers=2, **kw):
+            from waitress.prefork import Master
+            if loader is None:
+                loader = lambda: dummy_app
+            inst = Master(loader, workers, sockets=['sock'], **kw)
+            inst.os = DummyOS()
+            inst.signal = DummySignal()
+            inst.time = DummyTime()
+            inst.logger = DummyLogger()
+            return inst
+
+        def test_ctor(self):
+            inst = self._makeOne(listen='127.0.0.1:0', threads='2')
+            self.assertEqual(inst.sockets, ['sock'])
+            self.assertEqual(inst.worker_kw, {'threads': '2'})
+            self.assertEqual(inst.adj.threads, 2)
+
+        def test_ctor_binds_sockets(self):
+            from waitress.prefork import Master
+            inst = Master(None, 1, host='127.0.0.1', port=0)
+            try:
+                self.assertEqual(len(inst.sockets), 1)
+                self.assertEqual(inst.worker_kw, {})
+            finally:
+                inst.close()
+
+        def test_install_signals(self):
+            inst = self._makeOne()
+            inst.install_signals()
+            self.assertEqual(
+                inst.signal.handlers,
+                {signal.SIGTERM: inst.handle_signal,
+                 signal.SIGINT: inst.handle_signal,
+                 signal.SIGHUP: inst.handle_signal})
+
+        def test_spawn_parent(self):
+            inst = self._makeOne()
+            inst.os.forks = [42]
+            self.assertEqual(inst.spawn(), 42)
+            self.assertEqual(list(inst.children), [42])
+            self.assertEqual(inst.os.exited, None)
+
+        def test_spawn_child(self):
+            inst = self._makeOne(threads='2')
+            servers = []
+            def create_server(app, **kw):
+                server = DummyServer(app, kw)
+                servers.append(server)
+                return server
+            inst.create_server = create_server
+            inst.os.forks = [0]
+            inst.spawn()
+            self.assertEqual(inst.os.exited, 0)
+            self.assertEqual(inst.children, {})
+            self.assertEqual(len(servers), 1)
+            self.assertTrue(servers[0].app is dummy_app)
+            self.assertEqual(servers[0].kw,
+                             {'sockets': ['sock'], 'threads': '2'})
+            self.assertTrue(servers[0].ran)
+            self.assertEqual(inst.signal.handlers, {
+                signal.SIGHUP: signal.SIG_DFL,
+                signal.SIGINT: signal.SIG_IGN,
+                signal.SIGTERM: inst.worker_exit,
+            })
+
+        def test_spawn_child_fails(self):
+            def loader():
+                raise ValueError
+            inst = self._makeOne(loader=loader)
+            inst.os.forks = [0]
+            inst.spawn()
+            self.assertEqual(inst.os.exited, 1)
+            self.assertEqual(len(inst.logger.exceptions), 1)
+
+        def test_spawn_child_exits(self):
+            def loader():
+                raise SystemExit(3)
+            inst = self._makeOne(loader=loader)
+            inst.os.forks = [0]
+            inst.spawn()
+            self.assertEqual(inst.os.exited, 3)
+
+        def test_spawn_child_exits_with_message(self):
+            def loader():
+                raise SystemExit('missing config')
+            inst = self._makeOne(loader=loader)
+            inst.os.forks = [0]
+            stderr = sys.stderr
+            sys.stderr = DummyStream()
+            try:
+                inst.spawn()
+                written = sys.stderr.written
+            finally:
+                sys.stderr = stderr
+            self.assertEqual(inst.os.exited, 1)
+            self.assertEqual(written, ['missing config\n'])
+
+        def test_spawn_child_exits_without_code(self):
+            def loader():
+                raise SystemExit()
+            inst = self._makeOne(loader=loader)
+            inst.os.forks = [0]
+            inst.spawn()
+            self.assertEqual(inst.os.exited, 0)
+
+        def test_spawn_child_never_returns(self):
+            # even if logging the failure fails, the child exits
+            def loader():
+                raise ValueError
+            inst = self._makeOne(loader=loader)
+            def exception(msg):
+                raise IOError
+            inst.logger.exception = exception
+            inst.os.forks = [0]
+            self.assertRaises(IOError, inst.spawn)
+            self.assertEqual(inst.os.exited, 1)
+
+        def test_worker_exit(self):
+            inst = self._makeOne()
+            self.assertRaises(SystemExit, inst.worker_exit, signal.SIGTERM,
+                              None)
+
+        def test_reap(self):
+            inst = self._makeOne()
+            inst.children = {1: 0, 2: 0}
+            inst.retiring = {3: 0}
+            inst.os.waits = [(1, 256), (3, 0), (0, 0)]
+            inst.reap()
+            self.assertEqual(inst.children, {2: 0})
+            self.assertEqual(inst.retiring, {})
+            self.assertEqual(inst.logger.warnings,
+                             ['Worker 1 exited with code 1'])
+
+        def test_reap_killed(self):
+            inst = self._makeOne()
+            inst.children = {1: 0}
+            inst.os.waits = [(1, signal.SIGKILL), (0, 0)]
+            inst.reap()
+            self.assertEqual(inst.children, {})
+            self.assertEqual(inst.logger.warnings,
+                             ['Worker 1 killed by signal %d' % signal.SIGKILL])
+
+        def test_reap_no_children(self):
+            inst = self._makeOne()
+            inst.children = {1: 0}
+            inst.retiring = {2: 0}
+            inst.os.waits = [OSError(errno.ECHILD, 'No child processes')]
+            inst.reap()
+            self.assertEqual(inst.children, {})
+            self.assertEqual(inst.retiring, {})
+
+        def test_reap_other_error(self):
+            inst = self._makeOne()
+            inst.children = {1: 0}
+            inst.os.waits = [OSError(errno.EINVAL, 'Invalid argument')]
+            self.assertRaises(OSError, inst.reap)
+
+        def test_restart_missing(self):
+            inst = self._makeOne(workers=3)
+            inst.children = {1: 0}
+            inst.os.forks = [2, 3]
+            inst.time.now = 100
+            inst.restart_missing()
+            # only one restart per restart_delay
+            self.assertEqual(sorted(inst.children), [1, 2])
+            inst.restart_missing()
+            self.assertEqual(sorted(inst.children), [1, 2])
+            inst.time.now = 102
+            inst.restart_missing()
+            self.assertEqual(sorted(inst.children), [1, 2, 3])
+
+        def test_reload(self):
+            inst = self._makeOne()
+            inst.children = {1: 0, 2: 0}
+            inst.os.forks = [3, 4]
+            inst.reload()
+            self.assertEqual(sorted(inst.children), [3, 4])
+            self.assertEqual(sorted(inst.retiring), [1, 2])
+            self.assertEqual(sorted(inst.os.killed),
+                             [(1, signal.SIGTERM), (2, signal.SIGTERM)])
+
+        def test_kill_gone(self):
+            inst = self._makeOne()
+            inst.os.kill_error = OSError(errno.ESRCH, 'No such process')
+            inst.kill(1, signal.SIGTERM)
+
+        def test_kill_error(self):
+            inst = self._makeOne()
+            inst.os.kill_error = OSError(errno.EPERM, 'Not permitted')
+            self.assertRaises(OSError, inst.kill, 1, signal.SIGTERM)
+
+        def test_process_signals(self):
+            inst = self._makeOne()
+            inst.children = {1: 0}
+            inst.os.forks = [2]
+            inst.handle_signal(signal.SIGHUP, None)
+            inst.process_signals()
+            self.assertTrue(inst.alive)
+            self.assertEqual(list(inst.children), [2])
+            inst.handle_signal(signal.SIGTERM, None)
+            inst.process_signals()
+            self.assertFalse(inst.alive)
+
+        def test_stop(self):
+            inst = self._makeOne()
+            inst.children = {1: 0}
+            inst.retiring = {2: 0}
+            inst.os.waits = [(1, 0), (0, 0), (2, 0)]
+            inst.stop()
+            self.assertEqual(sorted(inst.os.killed),
+                             [(1, signal.SIGTERM), (2, signal.SIGTERM)])
+            self.assertEqual(inst.children, {})
+            self.assertEqual(inst.retiring, {})
+            self.assertEqual(len(inst.logger.warnings), 0)
+
+        def test_stop_timeout(self):
+            inst = self._makeOne()
+            inst.graceful_timeout = 1
+            inst.children = {1: 0}
+            inst.os.waits = [(0, 0), (0, 0), (1, 9)]
+            inst.stop()
+            self.assertEqual(inst.os.killed,
+                             [(1, signal.SIGTERM), (1, signal.SIGKILL)])
+            self.assertEqual(inst.children, {})
+
+        def test_run(self):
+            inst = self._makeOne(workers=2)
+            closed = []
+            inst.close = lambda: closed.append(True)
+            inst.os.forks = [1, 2]
+            inst.os.waits = [(0, 0), (0, 0), (1, 0), (2, 0)]
+            def sleep(seconds):
+                inst.handle_signal(signal.SIGTERM, None)
+            inst.time.sleep = sleep
+            inst.run()
+            self.assertFalse(inst.alive)
+            self.assertEqual(sorted(inst.os.killed),
+                             [(1, signal.SIGTERM), (2, signal.SIGTERM)])
+            self.assertEqual(closed, [True])
+
+        def test_close(self):
+            from waitress.prefork import Master
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            inst = Master(None, 1, sockets=[sock])
+            inst.close()
+            self.assertRaises(socket.error, sock.getsockname)
+
+    class Test_serve(unittest.TestCase):
+
+        def test_it(self):
+            from waitress.prefork import serve
+            masters = []
+            class DummyMaster(object):
+                def __init__(self, loader, workers, **kw):
+                    self.args = (loader, workers, kw)
+                    masters.append(self)
+                def run(self):
+                    self.ran = True
+            serve('loader', 3, port='80', _quiet=True, _master=DummyMaster)
+            self.assertEqual(masters[0].args, ('loader', 3, {'port': '80'}))
+            self.assertTrue(masters[0].ran)
+
+dummy_app = object()
+
+class DummyOS(object):
+    WNOHANG = os.WNOHANG
+    WIFSIGNALED = staticmethod(os.WIFSIGNALED)
+    WTERMSIG = staticmethod(os.WTERMSIG)
+    WEXITSTATUS = staticmethod(os.WEXITSTATUS)
+    exited = None
+    kill_error = None
+
+    def __init__(self):
+        self.forks = []
+        self.waits = []
+        self.killed = []
+
+    def fork(self):
+        return self.forks.pop(0)
+
+    def waitpid(self, pid, options):
+        result = self.waits.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def kill(self, pid, signum):
+        if self.kill_error is not None:
+            raise self.kill_error
+        self.killed.append((pid, signum))
+
+    def _exit(self, status):
+        self.exited = status
+
+class DummySignal(object):
+    SIGTERM = signal.SIGTERM
+    SIGINT = signal.SIGINT
+    SIGHUP = getattr(signal, 'SIGHUP', None)
+    SIGKILL = getattr(signal, 'SIGKILL', None)
+    SIG_DFL = signal.SIG_DFL
+    SIG_IGN = signal.SIG_IGN
+
+    def __init__(self):
+        self.handlers = {}
+
+    def signal(self, signum, handler):
+        self.handlers[signum] = handler
+
+class DummyTime(object):
+    now = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class DummyServer(object):
+    ran = False
+
+    def __init__(self, app, kw):
+        self.app = app
+        self.kw = kw
+
+    def run(self):
+        self.ran = True
+
+class DummyStream(object):
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+class DummyLogger(object):
+
+    def __init__(self):
+        self.warnings = []
+        self.exceptions = []
+
+    def info(self, msg, *args):
+        pass
+
+    def warning(self, msg, *args):
+        self.warnings.append(msg % args)
+
+    def exception(self, msg, *args):
+        self.exceptions.append(msg)
@@ -1,5 +1,7 @@
 import unittest
 
+from waitress.compat import PY2
+
 class TestFixedStreamReceiver(unittest.TestCase):
 
     def _makeOne(self, cl, buf):
@@ -137,6 +139,29 @@ class TestChunkedReceiver(unittest.TestCase):
         self.assertEqual(result, 7)
         self.assertEqual(inst.completed, True)
 
+    @unittest.skipIf(PY2, "re can't search a memoryview on Python 2")
+    def test_received_memoryview(self):
+        buf = DummyBuffer()
+        inst = self._makeOne(buf)
+        data = bytearray(b'3\r\nabc\r\n0\r\nX-Trailer: 1\r\n\r\nGET')
+        result = inst.received(memoryview(data))
+        self.assertEqual([bytes(s) for s in buf.data], [b'abc'])
+        data[:] = b'x' * len(data)
+        self.assertEqual(result, len(data) - 3)
+        self.assertEqual(inst.completed, True)
+        self.assertEqual(inst.trailer, b'X-Trailer: 1\r\n\r\n')
+
+    @unittest.skipIf(PY2, "re can't search a memoryview on Python 2")
+    def test_received_memoryview_split_control_line(self):
+        buf = DummyBuffer()
+        inst = self._makeOne(buf)
+        data = bytearray(b'1')
+        inst.received(memoryview(data))
+        data[:] = b'x'
+        self.assertEqual(inst.control_line, b'1')
+        inst.received(memoryview(b'0\r\n'))
+        self.assertEqual(inst.chunk_remainder, 16)
+
     def test_getfile(self):
         buf = DummyBuffer()
         inst = self._makeOne(buf)
@@ -157,6 +157,44 @@ class Test_run(unittest.TestCase):
         ]
         self.assertEqual(runner.run(argv=argv, _serve=check_server), 0)
 
+    def test_bad_workers(self):
+        self.match_output(
+            ['--workers=many', 'a:a'],
+            1,
+            "^Error: Number of workers must be an integer")
+
+    def test_workers(self):
+        import waitress.tests.fixtureapps.runner as _apps
+        def null_serve(app, **kw): # pragma: no cover
+            raise AssertionError('single process server started')
+        def check_prefork(loader, workers, **kw):
+            self.assertIs(loader(), _apps.app)
+            self.assertEqual(workers, 3)
+            self.assertDictEqual(kw, {'port': '80'})
+        argv = [
+            'waitress-serve',
+            '--port=80',
+            '--workers=3',
+            'waitress.tests.fixtureapps.runner:app',
+        ]
+        self.assertEqual(
+            runner.run(argv=argv, _serve=null_serve, _prefork=check_prefork),
+            0)
+
+    def test_workers_call(self):
+        import waitress.tests.fixtureapps.runner as _apps
+        def check_prefork(loader, workers, **kw):
+            # the factory is called by each worker, not by the runner
+            self.assertIs(loader(), _apps.app)
+            self.assertEqual(workers, 2)
+        argv = [
+            'waitress-serve',
+            '--workers=2',
+            '--call',
+            'waitress.tests.fixtureapps.runner:returns_app',
+        ]
+        self.assertEqual(runner.run(argv=argv, _prefork=check_prefork), 0)
+
 class Test_helper(unittest.TestCase):
 
     def test_exception_logging(self):
@@ -1,3 +1,4 @@
+import contextlib
 import errno
 import socket
 import unittest
@@ -50,6 +51,16 @@ class TestWSGIServer(unittest.TestCase):
             _sock=sock)
         return self.inst
 
+    def _makeOneWithLoops(self, io_loops=2):
+        from waitress.server import create_server
+        return create_server(
+            dummy_app,
+            host='127.0.0.1',
+            port=0,
+            map={},
+            io_loops=io_loops,
+            _dispatcher=DummyTaskDispatcher())
+
     def tearDown(self):
         if self.inst is not None:
             self.inst.close()
@@ -68,6 +79,76 @@ class TestWSGIServer(unittest.TestCase):
         self.assertEqual(inst.task_dispatcher.__class__.__name__,
                          'ThreadedTaskDispatcher')
 
+    def test_ctor_makes_autoscaling_dispatcher(self):
+        from waitress.server import create_server
+        self.inst = create_server(dummy_app, host='127.0.0.1', port=0,
+                                  map={}, _start=False, min_threads=1,
+                                  max_threads=3)
+        dispatcher = self.inst.task_dispatcher
+        try:
+            self.assertEqual((dispatcher.min_threads, dispatcher.max_threads),
+                             (1, 3))
+            self.assertEqual(len(dispatcher.threads), 1)
+        finally:
+            dispatcher.shutdown(timeout=1)
+
+    def test_ctor_dispatcher_admission_control(self):
+        from waitress.server import create_server
+        self.inst = create_server(dummy_app, host='127.0.0.1', port=0,
+                                  map={}, _start=False, threads=1,
+                                  max_queue_depth=10, max_queue_wait=0.5)
+        dispatcher = self.inst.task_dispatcher
+        try:
+            self.assertEqual(dispatcher.max_queue_depth, 10)
+            self.assertEqual(dispatcher.max_queue_wait, 0.5)
+        finally:
+            dispatcher.shutdown(timeout=1)
+
+    def test_ctor_environ_template(self):
+        inst = self._makeOneWithMap()
+        template = inst.environ_template
+        self.assertEqual(template['SERVER_PORT'], str(inst.effective_port))
+        self.assertEqual(template['SERVER_NAME'], inst.server_name)
+        self.assertEqual(template['SERVER_SOFTWARE'], 'waitress')
+        self.assertEqual(template['wsgi.version'], (1, 0))
+        self.assertFalse('wsgi.errors' in template)
+        self.assertFalse('REQUEST_METHOD' in template)
+
+    def test_ctor_metrics(self):
+        from waitress.server import create_server
+        from waitress.metrics import MetricsServer
+        observer = object()
+        self.inst = create_server(dummy_app, host='127.0.0.1', port=0,
+                                  map={}, _start=False, threads=1,
+                                  metrics_listen='127.0.0.1:0',
+                                  observer=observer)
+        dispatcher = self.inst.task_dispatcher
+        try:
+            metrics = self.inst.metrics
+            self.assertTrue(dispatcher.metrics is metrics)
+            self.assertTrue(self.inst.adj.observer is metrics)
+            self.assertTrue(metrics.observer is observer)
+            self.assertEqual(metrics.queue_depth.get(), 0)
+            servers = [obj for obj in self.inst._map.values()
+                       if isinstance(obj, MetricsServer)]
+            self.assertEqual(len(servers), 1)
+            self.assertTrue(servers[0].metrics is metrics)
+            self.assertTrue(servers[0].effective_port)
+        finally:
+            dispatcher.shutdown(timeout=1)
+
+    def test_ctor_use_selectors(self):
+        from waitress.server import TcpWSGIServer
+        from waitress import wasyncore
+        self.inst = TcpWSGIServer(
+            dummy_app, host='127.0.0.1', port=0, _start=False,
+            dispatcher=DummyTaskDispatcher(), asyncore_use_selectors=True)
+        if wasyncore.selectors is None: # pragma: no cover
+            self.assertEqual(type(self.inst._map), dict)
+        else:
+            self.assertTrue(isinstance(self.inst._map, wasyncore.selector_map))
+            self.assertTrue(self.inst._fileno in self.inst._map.events)
+
     def test_ctor_start_false(self):
         inst = self._makeOneWithMap(_start=False)
         self.assertEqual(inst.accepting, False)
@@ -105,6 +186,86 @@ class TestWSGIServer(unittest.TestCase):
         inst = self._makeOneWithMulti()
         self.assertEqual(inst.__class__.__name__, 'MultiSocketServer')
 
+    def test_get_server_multi_loop(self):
+        self.inst = inst = self._makeOneWithLoops()
+        self.assertEqual(inst.__class__.__name__, 'MultiLoopServer')
+        self.assertEqual(len(inst.maps), 2)
+        servers = []
+        for map in inst.maps:
+            servers.extend([x for x in map.values()
+                            if x.__class__.__name__ == 'TcpWSGIServer'])
+        self.assertEqual(len(servers), 2)
+        ports = set([x.socket.getsockname()[1] for x in servers])
+        self.assertEqual(len(ports), 1)
+        self.assertEqual(inst.effective_listen,
+                         [(servers[0].effective_host,
+                           servers[0].effective_port)])
+        for server in servers:
+            self.assertEqual(
+                server.socket.getsockopt(
+                    socket.SOL_SOCKET, socket.SO_REUSEPORT), 1)
+
+    def test_run_multi_loop(self):
+        self.inst = inst = self._makeOneWithLoops(io_loops=3)
+        inst.asyncore = DummyAsyncore()
+        inst.threading = DummyThreading()
+        inst.task_dispatcher = DummyTaskDispatcher()
+        inst.run()
+        self.assertTrue(inst.task_dispatcher.was_shutdown)
+        self.assertEqual(
+            [x.args for x in inst.loop_threads],
+            [(inst.maps[1],), (inst.maps[2],)])
+        self.assertTrue(all(x.daemon and x.started
+                            for x in inst.loop_threads))
+        for map in inst.maps:
+            self.assertEqual(map, {})
+
+    def test_close_multi_loop_running(self):
+        import threading
+        self.inst = inst = self._makeOneWithLoops()
+        inst.adj.asyncore_loop_timeout = 0.1
+        thread = threading.Thread(target=inst.run_loop, args=(inst.maps[1],))
+        thread.start()
+        inst.loop_threads.append(thread)
+        inst.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(inst.maps[1], {})
+        self.assertEqual(inst.map, {})
+
+    def _makeListeningSocket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        return sock
+
+    def test_create_with_sockets(self):
+        from waitress.server import create_server
+        sock = self._makeListeningSocket()
+        self.inst = inst = create_server(
+            dummy_app,
+            map={},
+            sockets=[sock],
+            _dispatcher=DummyTaskDispatcher())
+        self.assertEqual(inst.__class__.__name__, 'TcpWSGIServer')
+        self.assertTrue(inst.socket is sock)
+        self.assertEqual(inst.effective_port, str(sock.getsockname()[1]))
+        self.assertEqual(inst.sockinfo[3], sock.getsockname())
+        self.assertTrue(inst.accepting)
+
+    def test_create_with_multiple_sockets(self):
+        from waitress.server import create_server
+        socks = [self._makeListeningSocket(), self._makeListeningSocket()]
+        self.inst = inst = create_server(
+            dummy_app,
+            map={},
+            sockets=socks,
+            _dispatcher=DummyTaskDispatcher())
+        self.assertEqual(inst.__class__.__name__, 'MultiSocketServer')
+        self.assertEqual(
+            sorted([port for (host, port) in inst.effective_listen]),
+            sorted([str(x.getsockname()[1]) for x in socks]))
+
     def test_run(self):
         inst = self._makeOneWithMap(_start=False)
         inst.asyncore = DummyAsyncore()
@@ -138,39 +299,61 @@ class TestWSGIServer(unittest.TestCase):
         inst.accepting = False
         self.assertFalse(inst.readable())
 
-    def test_readable_maplen_gt_connection_limit(self):
+    def test_readable_channels_gt_connection_limit(self):
         inst = self._makeOneWithMap()
         inst.accepting = True
         inst.adj = DummyAdj
-        inst._map = {'a': 1, 'b': 2}
+        inst.active_channels = {'a': 1, 'b': 2}
         self.assertFalse(inst.readable())
 
-    def test_readable_maplen_lt_connection_limit(self):
+    def test_readable_channels_lt_connection_limit(self):
         inst = self._makeOneWithMap()
         inst.accepting = True
         inst.adj = DummyAdj
-        inst._map = {}
+        inst.active_channels = {}
+        # other dispatchers in the map don't count
+        inst._map = {'a': 1, 'b': 2}
         self.assertTrue(inst.readable())
 
+    def test_active_channels_shared_by_map(self):
+        from waitress.server import BaseWSGIServer
+        from waitress.server import create_server
+        inst = self.inst = create_server(
+            dummy_app, listen='127.0.0.1:0 127.0.0.1:0', map={},
+            _dispatcher=DummyTaskDispatcher(), _start=False)
+        servers = [obj for obj in inst.map.values()
+                   if isinstance(obj, BaseWSGIServer)]
+        self.assertEqual(len(servers), 2)
+        self.assertTrue(
+            servers[0].active_channels is servers[1].active_channels)
+
     def test_readable_maintenance_false(self):
-        import time
+        from waitress.compat import monotonic
         inst = self._makeOneWithMap()
-        then = time.time() + 1000
-        inst.next_channel_cleanup = then
+        then = int(monotonic()) + 1
+        inst.expiry_cursor = then
         L = []
         inst.maintenance = lambda t: L.append(t)
         inst.readable()
         self.assertEqual(L, [])
-        self.assertEqual(inst.next_channel_cleanup, then)
+        self.assertEqual(inst.expiry_cursor, then)
+
+    def test_readable_maintenance_clock_set_back(self):
+        from waitress.compat import monotonic
+        inst = self._makeOneWithMap()
+        inst.expiry_cursor = int(monotonic()) + 1000
+        L = []
+        inst.maintenance = lambda t: L.append(t)
+        inst.readable()
+        self.assertEqual(len(L), 1)
 
     def test_readable_maintenance_true(self):
         inst = self._makeOneWithMap()
-        inst.next_channel_cleanup = 0
+        inst.expiry_cursor = 0
         L = []
         inst.maintenance = lambda t: L.append(t)
         inst.readable()
         self.assertEqual(len(L), 1)
-        self.assertNotEqual(inst.next_channel_cleanup, 0)
 
     def test_writable(self):
         inst = self._makeOneWithMap()
@@ -204,6 +387,19 @@ class TestWSGIServer(unittest.TestCase):
         self.assertEqual(inst.socket.accepted, False)
         self.assertEqual(len(inst.logger.logged), 1)
 
+    def test_handle_accept_socket_error_counted(self):
+        from waitress.metrics import Metrics
+        inst = self._makeOneWithMap()
+        inst.adj = DummyAdj
+        inst.metrics = Metrics()
+        def foo():
+            raise socket.error
+        inst.accept = foo
+        inst.logger = DummyLogger()
+        inst.handle_accept()
+        self.assertEqual(inst.metrics.socket_errors.get(), 1)
+        self.assertEqual(inst.metrics.connections_accepted.get(), 0)
+
     def test_handle_accept_noerror(self):
         inst = self._makeOneWithMap()
         innersock = DummySock()
@@ -216,17 +412,216 @@ class TestWSGIServer(unittest.TestCase):
         self.assertEqual(innersock.opts, [('level', 'optname', 'value')])
         self.assertEqual(L, [(inst, innersock, None, inst.adj)])
 
-    def test_maintenance(self):
+    def test_handle_accept_drains_backlog(self):
+        inst = self._makeOneWithMap()
+        conns = [DummySock() for i in range(3)]
+        inst.socket = DummySock(
+            acceptresult=[(conn, ('127.0.0.1', i)) for i, conn in
+                          enumerate(conns)])
+        inst.adj = DummyAdj
+        inst._map = {}
+        L = []
+        inst.channel_class = lambda *arg, **kw: L.append(arg)
+        with _patch(DummyAdj, connection_limit=10):
+            inst.handle_accept()
+        self.assertEqual([arg[1] for arg in L], conns)
+        for conn in conns:
+            self.assertTrue(conn.blocking)
+            self.assertEqual(conn.opts, [('level', 'optname', 'value')])
+
+    def test_handle_accept_stops_at_accept_batch(self):
         inst = self._makeOneWithMap()
+        inst.socket = DummySock(
+            acceptresult=[(DummySock(), None) for i in range(5)])
+        inst.adj = DummyAdj
+        inst._map = {}
+        L = []
+        inst.channel_class = lambda *arg, **kw: L.append(arg)
+        with _patch(DummyAdj, connection_limit=10, accept_batch=2):
+            inst.handle_accept()
+        self.assertEqual(len(L), 2)
+        self.assertEqual(len(inst.socket.acceptresult), 3)
 
-        class DummyChannel(object):
-            requests = []
+    def test_handle_accept_stops_at_connection_limit(self):
+        inst = self._makeOneWithMap()
+        inst.socket = DummySock(
+            acceptresult=[(DummySock(), None) for i in range(5)])
+        inst.adj = DummyAdj
+        inst._map = {}
+        def channel_class(server, conn, addr, adj, map):
+            server.active_channels[len(server.active_channels)] = conn
+        inst.channel_class = channel_class
+        with _patch(DummyAdj, connection_limit=3):
+            inst.handle_accept()
+        self.assertEqual(len(inst.active_channels), 3)
+        self.assertEqual(len(inst.socket.acceptresult), 2)
+
+    def test_handle_accept_counted(self):
+        from waitress.metrics import Metrics
+        inst = self._makeOneWithMap()
+        inst.socket = DummySock(acceptresult=(DummySock(), None))
+        inst.adj = DummyAdj
+        inst.metrics = Metrics()
+        inst.channel_class = lambda *arg, **kw: None
+        inst.handle_accept()
+        self.assertEqual(inst.metrics.connections_accepted.get(), 1)
+
+    def test_maintenance(self):
+        inst = self._makeOneWithMap()
+        inst.adj = DummyAdj
         zombie = DummyChannel()
         zombie.last_activity = 0
-        zombie.running_tasks = False
-        inst.active_channels[100] = zombie
+        inst.expiry_cursor = 0
+        inst.schedule_expiry(zombie, 300)
+        self.assertEqual(zombie.expiry_slot, 300)
         inst.maintenance(10000)
         self.assertEqual(zombie.will_close, True)
+        self.assertEqual(zombie.interest_changes, 1)
+        self.assertEqual(zombie.expiry_slot, None)
+        self.assertEqual(inst.expiry_slots, {})
+        self.assertEqual(inst.expiry_cursor, 10001)
+
+    def test_maintenance_not_due(self):
+        inst = self._makeOneWithMap()
+        inst.adj = DummyAdj
+        channel = DummyChannel()
+        channel.last_activity = 0
+        inst.expiry_cursor = 0
+        inst.schedule_expiry(channel, 300)
+        inst.maintenance(299.5)
+        self.assertEqual(channel.will_close, False)
+        self.assertEqual(inst.expiry_slots, {300: set([channel])})
+        self.assertEqual(inst.expiry_cursor, 300)
+
+    def test_maintenance_active_channel_rescheduled(self):
+        inst = self._makeOneWithMap()
+        inst.adj = DummyAdj
+        channel = DummyChannel()
+        channel.last_activity = 0
+        inst.expiry_cursor = 0
+        inst.schedule_expiry(channel, 300)
+        channel.last_activity = 100.5
+        inst.maintenance(300)
+        self.assertEqual(channel.will_close, False)
+        self.assertEqual(channel.expiry_slot, 401)
+        self.assertEqual(inst.expiry_slots, {401: set([channel])})
+
+    def test_maintenance_busy_channel_rescheduled(self):
+        inst = self._makeOneWithMap()
+        inst.adj = DummyAdj
+        channel = DummyChannel()
+        channel.last_activity = 0
+        channel.requests = [True]
+        inst.expiry_cursor = 0
+        inst.schedule_expiry(channel, 300)
+        inst.maintenance(1000)
+        self.assertEqual(channel.will_close, False)
+        self.assertEqual(channel.expiry_slot, 1300)
+
+    def test_maintenance_stalled_stream_expired(self):
+        from waitress.buffers import StreamBuffer
+        inst = self._makeOneWithMap()
+        inst.adj = DummyAdj
+        channel = DummyChannel()
+        channel.last_activity = 0
+        channel.request = request = DummyStreamingRequest(StreamBuffer(10))
+        channel.requests = [request]
+        inst.expiry_cursor = 0
+        inst.schedule_expiry(channel, 300)
+        inst.maintenance(1000)
+        self.assertEqual(channel.will_close, True)
+        self.assertEqual(channel.interest_changes, 1)
+        self.assertTrue(request.body_stream.aborted)
+
+    def test_maintenance_streaming_channel_not_due(self):
+        from waitress.buffers import StreamBuffer
+        inst = self._makeOneWithMap()
+        inst.adj = DummyAdj
+        channel = DummyChannel()
+        channel.last_activity = 900
+        channel.request = request = DummyStreamingRequest(StreamBuffer(10))
+        channel.requests = [request]
+        inst.expiry_cursor = 0
+        inst.schedule_expiry(channel, 300)
+        inst.maintenance(1000)
+        self.assertEqual(channel.will_close, False)
+        self.assertEqual(channel.expiry_slot, 1200)
+        self.assertFalse(request.body_stream.aborted)
+
+    def test_maintenance_full_stream_not_expired(self):
+        # the task, not the client, is behind
+        from waitress.buffers import StreamBuffer
+        inst = self._makeOneWithMap()
+        inst.adj = DummyAdj
+        channel = DummyChannel()
+        channel.last_activity = 0
+        channel.request = request = DummyStreamingRequest(StreamBuffer(2))
+        request.body_stream.append(b'abc')
+        channel.requests = [request]
+        inst.expiry_cursor = 0
+        inst.schedule_expiry(channel, 300)
+        inst.maintenance(1000)
+        self.assertEqual(channel.will_close, False)
+        self.assertEqual(channel.expiry_slot, 1300)
+        self.assertFalse(request.body_stream.aborted)
+
+    def test_maintenance_clock_jumped_forward(self):
+        inst = self._makeOneWithMap()
+        inst.adj = DummyAdj
+        zombie = DummyChannel()
+        zombie.last_activity = 0
+        later = DummyChannel()
+        later.last_activity = 10 ** 9
+        inst.expiry_cursor = 0
+        inst.schedule_expiry(zombie, 300)
+        inst.schedule_expiry(later, 10 ** 9 + 300)
+        slots = inst.expiry_slots
+        popped = []
+        class Slots(dict):
+            def pop(self, slot, default=None):
+                popped.append(slot)
+                return dict.pop(self, slot, default)
+        inst.expiry_slots = Slots(slots)
+        inst.maintenance(10 ** 8)
+        # only the slots scheduled were looked at
+        self.assertEqual(popped, [300])
+        self.assertEqual(zombie.will_close, True)
+        self.assertEqual(later.will_close, False)
+        self.assertEqual(inst.expiry_slots, {10 ** 9 + 300: set([later])})
+        self.assertEqual(inst.expiry_cursor, 10 ** 8 + 1)
+
+    def test_maintenance_clock_set_back(self):
+        inst = self._makeOneWithMap()
+        inst.adj = DummyAdj
+        idle = DummyChannel()
+        idle.last_activity = 1000
+        inst.expiry_cursor = 1001
+        inst.schedule_expiry(idle, 1300)
+        inst.maintenance(100.5)
+        # the deadline counts from now
+        self.assertEqual(idle.last_activity, 100.5)
+        self.assertEqual(idle.expiry_slot, 401)
+        self.assertEqual(inst.expiry_slots, {401: set([idle])})
+        self.assertEqual(inst.expiry_cursor, 100)
+        inst.maintenance(401)
+        self.assertEqual(idle.will_close, True)
+
+    def test_schedule_expiry_in_the_past(self):
+        inst = self._makeOneWithMap()
+        channel = DummyChannel()
+        inst.expiry_cursor = 500
+        inst.schedule_expiry(channel, 10)
+        self.assertEqual(channel.expiry_slot, 500)
+
+    def test_cancel_expiry(self):
+        inst = self._makeOneWithMap()
+        channel = DummyChannel()
+        inst.schedule_expiry(channel, inst.expiry_cursor + 10)
+        slot = channel.expiry_slot
+        inst.cancel_expiry(channel)
+        self.assertEqual(channel.expiry_slot, None)
+        self.assertEqual(inst.expiry_slots[slot], set())
+        inst.cancel_expiry(channel)
 
     def test_backward_compatibility(self):
         from waitress.server import WSGIServer, TcpWSGIServer
@@ -237,6 +632,112 @@ class TestWSGIServer(unittest.TestCase):
         self.assertNotEqual(Adjustments.port, 1234)
         self.assertEqual(self.inst.adj.port, 1234)
 
+class TestListenSocketOptions(unittest.TestCase):
+
+    def _makeAdj(self, **kw):
+        from waitress.adjustments import Adjustments
+        return Adjustments(**kw)
+
+    def _makeSock(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        sock.bind(('127.0.0.1', 0))
+        return sock
+
+    def test_none_requested(self):
+        from waitress.server import listen_socket_options
+        from waitress.server import set_listen_socket_options
+        sock = DummySock()
+        set_listen_socket_options(sock, self._makeAdj())
+        self.assertEqual(sock.opts, [])
+        sock = self._makeSock()
+        self.assertEqual(listen_socket_options(sock), [])
+
+    def test_setsockopt_fails(self):
+        from waitress.server import set_listen_socket_options
+        from waitress import server
+        class RefusingSock(DummySock):
+            def setsockopt(self, *arg):
+                raise socket.error(errno.ENOPROTOOPT)
+        logger = DummyLogger()
+        saved, server.logger = server.logger, logger
+        try:
+            set_listen_socket_options(
+                RefusingSock(), self._makeAdj(tcp_defer_accept=1))
+        finally:
+            server.logger = saved
+        if hasattr(socket, 'TCP_DEFER_ACCEPT'):
+            self.assertTrue(logger.logged[0].startswith(
+                'Could not set TCP_DEFER_ACCEPT'))
+        else: # pragma: no cover
+            self.assertEqual(logger.logged, [
+                'TCP_DEFER_ACCEPT is not supported on this platform'])
+
+    @unittest.skipIf(not hasattr(socket, 'TCP_DEFER_ACCEPT'),
+                     'TCP_DEFER_ACCEPT is Linux only')
+    def test_tcp_defer_accept(self):
+        import select
+        from waitress.server import listen_socket_options
+        from waitress.server import set_listen_socket_options
+        sock = self._makeSock()
+        set_listen_socket_options(sock, self._makeAdj(tcp_defer_accept=5))
+        sock.listen(5)
+        options = listen_socket_options(sock)
+        # as rounded up by the kernel
+        self.assertEqual(len(options), 1)
+        self.assertTrue(options[0].startswith('TCP_DEFER_ACCEPT='))
+        client = socket.create_connection(sock.getsockname())
+        self.addCleanup(client.close)
+        # not reported until the client sends something
+        self.assertEqual(select.select([sock], [], [], 0.2)[0], [])
+        client.sendall(b'GET / HTTP/1.1\r\n\r\n')
+        self.assertEqual(select.select([sock], [], [], 2)[0], [sock])
+
+    @unittest.skipIf(not hasattr(socket, 'TCP_FASTOPEN'),
+                     'TCP_FASTOPEN is not available')
+    def test_tcp_fastopen(self):
+        from waitress import server
+        sock = self._makeSock()
+        server.set_listen_socket_options(
+            sock, self._makeAdj(tcp_fastopen=64))
+        sock.listen(5)
+        self.assertEqual(
+            sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN), 64)
+        saved = server.fastopen_server_enabled
+        try:
+            server.fastopen_server_enabled = lambda: True
+            self.assertEqual(
+                server.listen_socket_options(sock), ['TCP_FASTOPEN=64'])
+            # refused by the kernel, so not reported as in effect
+            server.fastopen_server_enabled = lambda: False
+            self.assertEqual(server.listen_socket_options(sock), [])
+        finally:
+            server.fastopen_server_enabled = saved
+
+    def test_fastopen_server_enabled(self):
+        import tempfile
+        from waitress.server import fastopen_server_enabled
+        with tempfile.NamedTemporaryFile('w') as f:
+            f.write('1\n')
+            f.flush()
+            self.assertFalse(fastopen_server_enabled(f.name))
+            f.seek(0)
+            f.write('3\n')
+            f.flush()
+            self.assertTrue(fastopen_server_enabled(f.name))
+        self.assertTrue(fastopen_server_enabled('/nonexistent'))
+
+    @unittest.skipIf(not hasattr(socket, 'TCP_DEFER_ACCEPT'),
+                     'TCP_DEFER_ACCEPT is Linux only')
+    def test_tcp_server(self):
+        from waitress.server import create_server
+        from waitress.server import listen_socket_options
+        inst = create_server(dummy_app, host='127.0.0.1', port=0,
+                             map={}, tcp_defer_accept=1,
+                             _dispatcher=DummyTaskDispatcher())
+        self.addCleanup(inst.close)
+        self.assertEqual(len(listen_socket_options(inst.socket)), 1)
+
 if hasattr(socket, 'AF_UNIX'):
 
     class TestUnixWSGIServer(unittest.TestCase):
@@ -287,6 +788,22 @@ if hasattr(socket, 'AF_UNIX'):
                 [(inst, client, ('localhost', None), inst.adj)]
             )
 
+        def test_create_with_unix_socket(self):
+            from waitress.server import create_server
+            from waitress.utilities import cleanup_unix_socket
+            cleanup_unix_socket(self.unix_socket)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.unix_socket)
+            sock.listen(5)
+            self.inst = create_server(
+                dummy_app,
+                map={},
+                sockets=[sock],
+                _dispatcher=DummyTaskDispatcher())
+            self.assertEqual(self.inst.__class__.__name__, 'UnixWSGIServer')
+            self.assertTrue(self.inst.socket is sock)
+            self.assertEqual(self.inst.sockinfo[0], socket.AF_UNIX)
+
         def test_creates_new_sockinfo(self):
             from waitress.server import UnixWSGIServer
             self.inst = UnixWSGIServer(
@@ -314,6 +831,15 @@ class DummySock(object):
     def accept(self):
         if self.toraise:
             raise self.toraise
+        if isinstance(self.acceptresult, list):
+            # a backlog of several connections
+            if not self.acceptresult:
+                raise socket.error(errno.EAGAIN)
+            self.accepted = True
+            return self.acceptresult.pop(0)
+        if self.accepted:
+            # the backlog held a single connection
+            raise socket.error(errno.EAGAIN)
         self.accepted = True
         return self.acceptresult
 
@@ -365,8 +891,36 @@ class DummyTask(object):
     def service(self): # pragma: no cover
         self.serviced = True
 
+class DummyChannel(object):
+    request = None
+    requests = ()
+    will_close = False
+    expiry_slot = None
+    interest_changes = 0
+
+    def interest_changed(self):
+        self.interest_changes += 1
+
+class DummyStreamingRequest(object):
+    streaming = True
+
+    def __init__(self, body_stream):
+        self.body_stream = body_stream
+
+@contextlib.contextmanager
+def _patch(obj, **attrs):
+    saved = dict((name, getattr(obj, name)) for name in attrs)
+    for name, value in attrs.items():
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(obj, name, value)
+
 class DummyAdj:
     connection_limit = 1
+    accept_batch = 16
     log_socket_errors = True
     socket_options = [('level', 'optname', 'value')]
     cleanup_interval = 900
@@ -377,6 +931,23 @@ class DummyAsyncore(object):
     def loop(self, timeout=30.0, use_poll=False, map=None, count=None):
         raise SystemExit
 
+class DummyThread(object):
+    started = False
+
+    def __init__(self, target=None, args=(), name=None):
+        self.target = target
+        self.args = args
+        self.name = name
+
+    def start(self):
+        self.started = True
+
+    def is_alive(self):
+        return False
+
+class DummyThreading(object):
+    Thread = DummyThread
+
 class DummyTrigger(object):
 
     def pull_trigger(self):
@@ -28,6 +28,20 @@ class TestThreadedTaskDispatcher(unittest.TestCase):
         self.assertEqual(inst.threads, {})
         self.assertEqual(len(inst.logger.logged), 1)
 
+    def test_handler_thread_counts_busy_threads(self):
+        from waitress.metrics import Metrics
+        inst = self._makeOne()
+        inst.metrics = Metrics()
+        inst.threads[0] = True
+        busy = []
+        task = DummyTask()
+        task.service = lambda: busy.append(inst.metrics.busy_threads.get())
+        inst.queue.put(task)
+        inst.queue.put(None)
+        inst.handler_thread(0)
+        self.assertEqual(busy, [1])
+        self.assertEqual(inst.metrics.busy_threads.get(), 0)
+
     def test_set_thread_count_increase(self):
         inst = self._makeOne()
         L = []
@@ -82,6 +96,138 @@ class TestThreadedTaskDispatcher(unittest.TestCase):
         self.assertTrue(task.deferred)
         self.assertTrue(task.cancelled)
 
+    def test_set_autoscale(self):
+        inst = self._makeOne()
+        L = []
+        inst.start_new_thread = lambda *x: L.append(x)
+        inst.set_autoscale(2, 4, 30)
+        self.assertEqual((inst.min_threads, inst.max_threads), (2, 4))
+        self.assertEqual(inst.idle_timeout, 30)
+        self.assertEqual(len(L), 2)
+
+    def test_scale_not_autoscaling(self):
+        inst = self._makeOne()
+        self.assertEqual(inst.scale(1, 'test'), None)
+
+    def test_scale_up(self):
+        inst = self._makeOne()
+        inst.queue_logger = DummyLogger()
+        L = []
+        inst.start_new_thread = lambda *x: L.append(x)
+        inst.set_autoscale(1, 2)
+        self.assertEqual(inst.scale(1, 'test'), 2)
+        self.assertEqual(len(inst.threads), 2)
+        self.assertEqual(inst.scale(1, 'test'), None)
+        self.assertEqual(len(L), 2)
+        self.assertEqual([e[1:] for e in inst.scale_events], [(2, 'test')])
+        self.assertEqual(inst.queue_logger.logged,
+                         ['Task thread count is 2 (test)'])
+
+    def test_scale_down(self):
+        inst = self._makeOne()
+        inst.queue_logger = DummyLogger()
+        inst.start_new_thread = lambda *x: None
+        inst.set_autoscale(1, 2)
+        inst.scale(1, 'test')
+        self.assertEqual(inst.scale(-1, 'idle'), 1)
+        self.assertEqual(inst.queue.get(), None)
+        self.assertEqual(inst.scale(-1, 'idle'), None)
+
+    def test_add_task_autoscale(self):
+        inst = self._makeOne()
+        inst.queue_logger = DummyLogger()
+        inst.start_new_thread = lambda *x: None
+        inst.set_autoscale(1, 4)
+        task = DummyTask()
+        inst.add_task(task)
+        self.assertTrue(task.queued_at)
+        self.assertEqual(len(inst.threads), 1)
+        inst.add_task(DummyTask())
+        self.assertEqual(len(inst.threads), 2)
+        self.assertEqual(inst.scale_events[-1][1:], (2, 'queue depth 1'))
+
+    def test_handler_thread_idle_timeout(self):
+        inst = self._makeOne()
+        inst.queue_logger = DummyLogger()
+        inst.start_new_thread = lambda *x: None
+        inst.set_autoscale(1, 2, idle_timeout=0.01)
+        inst.scale(1, 'test')
+        # the idle thread stops itself
+        inst.handler_thread(0)
+        self.assertEqual(len(inst.threads), 1)
+        self.assertEqual(inst.stop_count, 0)
+        self.assertEqual(inst.scale_events[-1][1:], (1, 'idle'))
+
+    def test_handler_thread_queue_wait(self):
+        inst = self._makeOne()
+        inst.queue_logger = DummyLogger()
+        inst.start_new_thread = lambda *x: None
+        inst.set_autoscale(1, 2)
+        task = DummyTask()
+        task.queued_at = 1
+        inst.queue.put(task)
+        inst.queue.put(None)
+        inst.handler_thread(0)
+        self.assertTrue(task.serviced)
+        self.assertEqual(len(inst.threads), 1)
+        self.assertEqual(inst.scale_events[-1][1], 2)
+        self.assertTrue(inst.scale_events[-1][2].startswith('queue wait'))
+
+    def test_shutdown_stops_autoscaling(self):
+        inst = self._makeOne()
+        inst.start_new_thread = lambda *x: None
+        inst.set_autoscale(1, 2)
+        inst.threads.clear()
+        inst.shutdown(timeout=.01)
+        self.assertEqual(inst.max_threads, None)
+        self.assertEqual(inst.scale(1, 'test'), None)
+
+    def test_overloaded_no_limits(self):
+        inst = self._makeOne()
+        self.assertFalse(inst.overloaded(100))
+
+    def test_overloaded_max_queue_depth(self):
+        inst = self._makeOne()
+        inst.max_queue_depth = 2
+        self.assertFalse(inst.overloaded(0))
+        self.assertFalse(inst.overloaded(1))
+        self.assertTrue(inst.overloaded(2))
+
+    def test_overloaded_max_queue_wait(self):
+        import time
+        inst = self._makeOne()
+        inst.max_queue_wait = 0.5
+        task = DummyTask()
+        task.queued_at = time.time()
+        inst.queue.put(task)
+        self.assertFalse(inst.overloaded(1))
+        task.queued_at -= 1
+        self.assertTrue(inst.overloaded(1))
+
+    def test_overloaded_max_queue_wait_sentinel(self):
+        inst = self._makeOne()
+        inst.max_queue_wait = 0.5
+        inst.queue.put(None)
+        self.assertFalse(inst.overloaded(1))
+
+    def test_add_task_overloaded(self):
+        inst = self._makeOne()
+        inst.queue_logger = DummyLogger()
+        inst.max_queue_depth = 1
+        inst.add_task(DummyTask())
+        task = DummyTask()
+        inst.add_task(task)
+        self.assertTrue(task.rejected)
+        self.assertFalse(task.deferred)
+        self.assertEqual(inst.queue.qsize(), 1)
+
+    def test_add_task_max_queue_wait_sets_queued_at(self):
+        inst = self._makeOne()
+        inst.max_queue_wait = 1
+        task = DummyTask()
+        inst.add_task(task)
+        self.assertTrue(task.queued_at)
+
     def test_shutdown_one_thread(self):
         inst = self._makeOne()
         inst.threads[0] = 1
@@ -101,6 +247,43 @@ class TestThreadedTaskDispatcher(unittest.TestCase):
         self.assertEqual(inst.shutdown(cancel_pending=False, timeout=.01),
                          False)
 
+class Test_build_overloaded_response(unittest.TestCase):
+
+    def _callFUT(self, version='1.1', ident='waitress', retry_after=1):
+        from waitress.task import build_overloaded_response
+        return build_overloaded_response(version, ident, retry_after)
+
+    def test_it(self):
+        head, tail = self._callFUT(retry_after=5)
+        response = head + b'Thu, 01 Jan 1970 00:00:00 GMT' + tail
+        lines = response.split(b'\r\n')
+        self.assertEqual(lines[0], b'HTTP/1.1 503 Service Unavailable')
+        self.assertEqual(lines[1:7], [
+            b'Connection: close',
+            b'Content-Length: 131',
+            b'Content-Type: text/plain',
+            b'Date: Thu, 01 Jan 1970 00:00:00 GMT',
+            b'Retry-After: 5',
+            b'Server: waitress',
+        ])
+        body = response.split(b'\r\n\r\n', 1)[1]
+        self.assertEqual(len(body), 131)
+        self.assertTrue(body.startswith(b'Service Unavailable'))
+        self.assertTrue(body.endswith(b'(generated by waitress)'))
+
+    def test_cached(self):
+        self.assertTrue(self._callFUT() is self._callFUT())
+
+    def test_unknown_version(self):
+        head, tail = self._callFUT(version='8.4')
+        self.assertTrue(head.startswith(b'HTTP/1.0 503 '))
+        self.assertTrue(self._callFUT(version='1.0') is
+                        self._callFUT(version='8.4'))
+
+    def test_no_ident(self):
+        head, tail = self._callFUT(ident=None)
+        self.assertFalse(b'Server:' in tail)
+
 class TestTask(unittest.TestCase):
 
     def _makeOne(self, channel=None, request=None):
@@ -289,6 +472,62 @@ class TestTask(unittest.TestCase):
         self.assertTrue(lines[2].startswith(b'Date:'))
         self.assertEqual(lines[3], b'Server: waitress')
 
+    def test_build_response_header_canonical_names(self):
+        from waitress import task
+        inst = self._makeOne()
+        inst.request = DummyParser()
+        inst.version = '1.1'
+        inst.content_length = 0
+        inst.response_headers = [
+            ('content-TYPE', 'text/plain'),
+            ('etag', '"x"'),
+            ('x-some-HEADER', 'value'),
+            ('Set-Cookie', 'a=b'),
+            ('Set-Cookie', 'c=d'),
+        ]
+        result = inst.build_response_header()
+        lines = filter_lines(result)
+        self.assertEqual(lines[0], b'HTTP/1.1 200 OK')
+        self.assertEqual(lines[1], b'Content-Length: 0')
+        self.assertEqual(lines[2], b'Content-Type: text/plain')
+        self.assertTrue(lines[3].startswith(b'Date:'))
+        self.assertEqual(lines[4:], [
+            b'Etag: "x"', b'Server: waitress', b'Set-Cookie: a=b',
+            b'Set-Cookie: c=d', b'X-Some-Header: value'])
+        self.assertEqual(task.header_names['x-some-HEADER'], 'X-Some-Header')
+        self.assertTrue(('1.1', '200 OK') in task.status_lines)
+
+    def test_build_response_header_tables_full(self):
+        from waitress import task
+        inst = self._makeOne()
+        inst.request = DummyParser()
+        inst.version = '1.1'
+        inst.status = '299 Unlisted'
+        inst.response_headers = [('x-unlisted-name', 'value')]
+        old_size = task.response_cache_size
+        task.response_cache_size = 0
+        try:
+            result = inst.build_response_header()
+        finally:
+            task.response_cache_size = old_size
+        lines = filter_lines(result)
+        self.assertEqual(lines[0], b'HTTP/1.1 299 Unlisted')
+        self.assertTrue(b'X-Unlisted-Name: value' in lines)
+        self.assertFalse('x-unlisted-name' in task.header_names)
+        self.assertFalse(('1.1', '299 Unlisted') in task.status_lines)
+
+    def test_build_response_header_custom_ident(self):
+        from waitress import task
+        inst = self._makeOne()
+        inst.request = DummyParser()
+        inst.version = '1.1'
+        inst.channel.server.adj = DummyAdj()
+        inst.channel.server.adj.ident = 'custom'
+        result = inst.build_response_header()
+        self.assertTrue(b'Server: custom' in filter_lines(result))
+        self.assertEqual(task.header_lines[('Server', 'custom')],
+                         b'Server: custom\r\n')
+
     def test_build_response_header_preexisting_content_length(self):
         inst = self._makeOne()
         inst.request = DummyParser()
@@ -319,6 +558,25 @@ class TestTask(unittest.TestCase):
         inst.start()
         self.assertTrue(inst.start_time)
 
+    def test_start_with_observer(self):
+        inst = self._makeOne()
+        inst.channel.adj = DummyAdj()
+        inst.channel.adj.observer = observer = DummyObserver()
+        inst.start()
+        self.assertEqual(observer.events, [('started', inst)])
+        self.assertTrue(inst.request.started_at)
+
+    def test_finish_with_observer(self):
+        inst = self._makeOne()
+        inst.channel.adj = DummyAdj()
+        inst.channel.adj.observer = observer = DummyObserver()
+        inst.wrote_header = True
+        inst.chunked_response = True
+        inst.finish()
+        self.assertEqual(observer.events, [('finished', inst)])
+        self.assertTrue(inst.request.finished_at)
+        self.assertEqual(inst.channel.tracked, [inst])
+
     def test_finish_didnt_write_header(self):
         inst = self._makeOne()
         inst.wrote_header = False
@@ -346,6 +604,7 @@ class TestTask(unittest.TestCase):
         inst.content_length = 3
         inst.write(b'abc')
         self.assertEqual(inst.channel.written, b'abc')
+        self.assertEqual(inst.channel.woken, 1)
 
     def test_write_header_not_written(self):
         inst = self._makeOne()
@@ -754,9 +1013,10 @@ class TestWSGITask(unittest.TestCase):
             'CONTENT_LENGTH', 'CONTENT_TYPE', 'HTTP_CONNECTION', 'HTTP_X_FOO',
             'PATH_INFO', 'QUERY_STRING', 'REMOTE_ADDR', 'REQUEST_METHOD',
             'SCRIPT_NAME', 'SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL',
-            'SERVER_SOFTWARE', 'wsgi.errors', 'wsgi.file_wrapper', 'wsgi.input',
-            'wsgi.input_terminated', 'wsgi.multiprocess', 'wsgi.multithread',
-            'wsgi.run_once', 'wsgi.url_scheme', 'wsgi.version'])
+            'SERVER_SOFTWARE', 'waitress.input_view', 'wsgi.errors',
+            'wsgi.file_wrapper', 'wsgi.input', 'wsgi.input_terminated',
+            'wsgi.multiprocess', 'wsgi.multithread', 'wsgi.run_once',
+            'wsgi.url_scheme', 'wsgi.version'])
 
         self.assertEqual(environ['REQUEST_METHOD'], 'GET')
         self.assertEqual(environ['SERVER_PORT'], '80')
@@ -779,8 +1039,37 @@ class TestWSGITask(unittest.TestCase):
         self.assertEqual(environ['wsgi.run_once'], False)
         self.assertEqual(environ['wsgi.input'], 'stream')
         self.assertEqual(environ['wsgi.input_terminated'], True)
+        self.assertEqual(environ['waitress.input_view'](), 'view')
         self.assertEqual(inst.environ, environ)
 
+    def test_get_environment_unlearned_header(self):
+        inst = self._makeOne()
+        request = DummyParser()
+        request.headers = {'X_NOT_FROM_THE_PARSER': ' abc '}
+        inst.request = request
+        environ = inst.get_environment()
+        self.assertEqual(environ['HTTP_X_NOT_FROM_THE_PARSER'], 'abc')
+
+    def test_get_environment_copies_template(self):
+        inst = self._makeOne()
+        inst.request = DummyParser()
+        environ = inst.get_environment()
+        template = inst.channel.server.environ_template
+        self.assertFalse(environ is template)
+        self.assertFalse('REQUEST_METHOD' in template)
+
+    def test_get_environment_current_stderr(self):
+        import sys
+        inst = self._makeOne()
+        inst.request = DummyParser()
+        stderr = sys.stderr
+        sys.stderr = errors = object()
+        try:
+            environ = inst.get_environment()
+        finally:
+            sys.stderr = stderr
+        self.assertTrue(environ['wsgi.errors'] is errors)
+
     def test_get_environment_values_w_scheme_override_untrusted(self):
         inst = self._makeOne()
         request = DummyParser()
@@ -818,9 +1107,10 @@ class TestWSGITask(unittest.TestCase):
             'CONTENT_LENGTH', 'CONTENT_TYPE', 'HTTP_CONNECTION', 'HTTP_X_FOO',
             'PATH_INFO', 'QUERY_STRING', 'REMOTE_ADDR', 'REQUEST_METHOD',
             'SCRIPT_NAME', 'SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL',
-            'SERVER_SOFTWARE', 'wsgi.errors', 'wsgi.file_wrapper', 'wsgi.input',
-            'wsgi.input_terminated', 'wsgi.multiprocess', 'wsgi.multithread',
-            'wsgi.run_once', 'wsgi.url_scheme', 'wsgi.version'])
+            'SERVER_SOFTWARE', 'waitress.input_view', 'wsgi.errors',
+            'wsgi.file_wrapper', 'wsgi.input', 'wsgi.input_terminated',
+            'wsgi.multiprocess', 'wsgi.multithread', 'wsgi.run_once',
+            'wsgi.url_scheme', 'wsgi.version'])
 
         self.assertEqual(environ['REQUEST_METHOD'], 'GET')
         self.assertEqual(environ['SERVER_PORT'], '80')
@@ -962,6 +1252,9 @@ class DummyTask(object):
     def cancel(self):
         self.cancelled = True
 
+    def reject(self):
+        self.rejected = True
+
 class DummyAdj(object):
     log_socket_errors = True
     ident = 'waitress'
@@ -969,13 +1262,16 @@ class DummyAdj(object):
     port = 80
     url_prefix = ''
     trusted_proxy = None
+    observer = None
 
 class DummyServer(object):
     server_name = 'localhost'
     effective_port = 80
 
     def __init__(self):
+        from waitress.task import environ_template
         self.adj = DummyAdj()
+        self.environ_template = environ_template(self)
 
 class DummyChannel(object):
     closed_when_done = False
@@ -989,6 +1285,14 @@ class DummyChannel(object):
         self.server = server
         self.written = b''
         self.otherdata = []
+        self.tracked = []
+        self.woken = 0
+
+    def track_flush(self, task):
+        self.tracked.append(task)
+
+    def wake_for_output(self):
+        self.woken += 1
 
     def write_soon(self, data):
         if isinstance(data, bytes):
@@ -1012,9 +1316,23 @@ class DummyParser(object):
     def get_body_stream(self):
         return 'stream'
 
+    def get_body_view(self):
+        return 'view'
+
 def filter_lines(s):
     return list(filter(None, s.split(b'\r\n')))
 
+class DummyObserver(object):
+
+    def __init__(self):
+        self.events = []
+
+    def started(self, task):
+        self.events.append(('started', task))
+
+    def finished(self, task):
+        self.events.append(('finished', task))
+
 class DummyLogger(object):
 
     def __init__(self):
@@ -1023,5 +1341,8 @@ class DummyLogger(object):
     def warning(self, msg):
         self.logged.append(msg)
 
+    def info(self, msg):
+        self.logged.append(msg)
+
     def exception(self, msg):
         self.logged.append(msg)
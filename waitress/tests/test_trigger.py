@@ -7,8 +7,8 @@ if not sys.platform.startswith("win"):
     class Test_trigger(unittest.TestCase):
 
         def _makeOne(self, map):
-            from waitress.trigger import trigger
-            self.inst = trigger(map)
+            from waitress.trigger import pipe_trigger
+            self.inst = pipe_trigger(map)
             return self.inst
 
         def tearDown(self):
@@ -71,6 +71,19 @@ if not sys.platform.startswith("win"):
             r = os.read(inst._fds[0], 1)
             self.assertEqual(r, b'x')
 
+        def test_pull_trigger_coalesced(self):
+            map = {}
+            inst = self._makeOne(map)
+            inst.pull_trigger()
+            inst.pull_trigger()
+            inst.pull_trigger(lambda: None)
+            self.assertEqual(len(inst.thunks), 1)
+            inst.handle_read()
+            self.assertEqual(inst.pulled, False)
+            self.assertEqual(len(inst.thunks), 0)
+            inst.pull_trigger()
+            self.assertEqual(os.read(inst._fds[0], 8192), b'x')
+
         def test_handle_read_socket_error(self):
             map = {}
             inst = self._makeOne(map)
@@ -89,11 +102,22 @@ if not sys.platform.startswith("win"):
             inst = self._makeOne(map)
             inst.pull_trigger()
             L = []
-            inst.thunks = [lambda: L.append(True)]
+            inst.thunks.append(lambda: L.append(True))
             result = inst.handle_read()
             self.assertEqual(result, None)
             self.assertEqual(L, [True])
-            self.assertEqual(inst.thunks, [])
+            self.assertEqual(len(inst.thunks), 0)
+
+        def test_handle_read_thunk_queues_thunk(self):
+            map = {}
+            inst = self._makeOne(map)
+            L = []
+            inst.pull_trigger(lambda: inst.pull_trigger(lambda: L.append(2)))
+            inst.handle_read()
+            # run at once, though its pull wakes the mainloop once more
+            self.assertEqual(L, [2])
+            self.assertEqual(len(inst.thunks), 0)
+            self.assertEqual(inst.pulled, True)
 
         def test_handle_read_thunk_error(self):
             map = {}
@@ -106,4 +130,50 @@ if not sys.platform.startswith("win"):
             result = inst.handle_read()
             self.assertEqual(result, None)
             self.assertEqual(len(L), 1)
-            self.assertEqual(inst.thunks, [])
+            self.assertEqual(len(inst.thunks), 0)
+
+    import os as _os
+    if hasattr(_os, 'eventfd'):
+
+        class Test_eventfd_trigger(unittest.TestCase):
+
+            def _makeOne(self, map):
+                from waitress.trigger import eventfd_trigger
+                self.inst = eventfd_trigger(map)
+                return self.inst
+
+            def tearDown(self):
+                self.inst.close()
+
+            def test_is_default(self):
+                from waitress import trigger
+                self.assertTrue(trigger.trigger is trigger.eventfd_trigger)
+                self._makeOne({})
+
+            def test__close(self):
+                inst = self._makeOne({})
+                fd, = inst._fds
+                inst.close()
+                self.assertRaises(OSError, os.read, fd, 8)
+
+            def test_pull_trigger_counts(self):
+                inst = self._makeOne({})
+                inst._physical_pull()
+                inst._physical_pull()
+                self.assertEqual(os.eventfd_read(inst._fds[0]), 2)
+
+            def test_pull_trigger_once(self):
+                inst = self._makeOne({})
+                inst.pull_trigger()
+                inst.pull_trigger(lambda: None)
+                self.assertEqual(os.eventfd_read(inst._fds[0]), 1)
+
+            def test_handle_read(self):
+                inst = self._makeOne({})
+                L = []
+                inst.pull_trigger(lambda: L.append(True))
+                inst.handle_read()
+                self.assertEqual(L, [True])
+                self.assertEqual(inst.pulled, False)
+                # drained
+                self.assertRaises(OSError, os.eventfd_read, inst._fds[0])
@@ -14,6 +14,8 @@
 
 import unittest
 
+from waitress.compat import PY2
+
 class Test_parse_http_date(unittest.TestCase):
 
     def _callFUT(self, v):
@@ -43,6 +45,25 @@ class Test_build_http_date(unittest.TestCase):
         t = int(time())
         self.assertEqual(t, parse_http_date(build_http_date(t)))
 
+class Test_cached_http_date(unittest.TestCase):
+
+    def _callFUT(self, when):
+        from waitress.utilities import cached_http_date
+        return cached_http_date(when)
+
+    def test_same_as_build_http_date(self):
+        from waitress.utilities import build_http_date
+        self.assertEqual(self._callFUT(1000000000.5),
+                         build_http_date(1000000000))
+        self.assertEqual(self._callFUT(1000000001.1),
+                         build_http_date(1000000001))
+
+    def test_cached_within_second(self):
+        from waitress import utilities
+        first = self._callFUT(1000000000.1)
+        self.assertTrue(self._callFUT(1000000000.9) is first)
+        self.assertEqual(utilities.http_date_cache, (1000000000, first))
+
 class Test_unpack_rfc850(unittest.TestCase):
 
     def _callFUT(self, val):
@@ -89,6 +110,19 @@ class Test_find_double_newline(unittest.TestCase):
     def test_mixed(self):
         self.assertEqual(self._callFUT(b'\n\n00\r\n\r\n'), 2)
 
+    def test_crlf_before_lf(self):
+        self.assertEqual(self._callFUT(b'a\r\n\r\n\n\n'), 5)
+
+    @unittest.skipIf(PY2, "re can't search a memoryview on Python 2")
+    def test_memoryview(self):
+        self.assertEqual(self._callFUT(memoryview(b'ab\r\n\r\ncd')), 6)
+
+    def test_start(self):
+        from waitress.utilities import find_double_newline
+        self.assertEqual(find_double_newline(b'\n\na\n\n', 1), 5)
+        self.assertEqual(find_double_newline(b'a\n\n', -1), 3)
+        self.assertEqual(find_double_newline(b'\n\na', 2), -1)
+
 class TestBadRequest(unittest.TestCase):
 
     def _makeOne(self):
@@ -1351,6 +1351,305 @@ class Test_poll2(unittest.TestCase):
             wasyncore.select = old_select
         self.assertEqual(pollster.polled, [0.0])
 
+@unittest.skipIf(asyncore.selectors is None, 'selectors module required')
+class Test_selector_map(unittest.TestCase):
+    def _makeOne(self):
+        from waitress.wasyncore import selector_map
+        return selector_map(DummySelector())
+
+    def test_register(self):
+        inst = self._makeOne()
+        inst.register(5)
+        self.assertEqual(inst.selector.registered,
+                         {5: asyncore.selectors.EVENT_READ})
+        self.assertEqual(inst.events, {5: asyncore.selectors.EVENT_READ})
+
+    def test_set_events_unchanged_does_not_touch_selector(self):
+        inst = self._makeOne()
+        inst.register(5)
+        inst.selector.calls = []
+        inst.set_events(5, asyncore.selectors.EVENT_READ)
+        self.assertEqual(inst.selector.calls, [])
+
+    def test_set_events_modify(self):
+        inst = self._makeOne()
+        inst.register(5)
+        inst.selector.calls = []
+        inst.set_events(5, asyncore.selectors.EVENT_WRITE)
+        self.assertEqual(inst.selector.calls, ['modify'])
+        self.assertEqual(inst.selector.registered,
+                         {5: asyncore.selectors.EVENT_WRITE})
+
+    def test_set_events_none_unregisters(self):
+        inst = self._makeOne()
+        inst.register(5)
+        inst.set_events(5, 0)
+        self.assertEqual(inst.selector.registered, {})
+        self.assertEqual(inst.events, {})
+        inst.set_events(5, asyncore.selectors.EVENT_READ)
+        self.assertEqual(inst.selector.registered,
+                         {5: asyncore.selectors.EVENT_READ})
+
+    def test_set_events_stale_registration(self):
+        inst = self._makeOne()
+        inst.selector.registered[5] = asyncore.selectors.EVENT_WRITE
+        inst.set_events(5, asyncore.selectors.EVENT_READ)
+        self.assertEqual(inst.selector.registered,
+                         {5: asyncore.selectors.EVENT_READ})
+
+    def test_unregister(self):
+        inst = self._makeOne()
+        inst.register(5)
+        inst.unregister(5)
+        inst.unregister(5)
+        self.assertEqual(inst.selector.registered, {})
+        self.assertEqual(inst.events, {})
+
+    def test_clear(self):
+        inst = self._makeOne()
+        inst[5] = DummyDispatcher()
+        inst.register(5)
+        inst.clear()
+        self.assertEqual(inst, {})
+        self.assertEqual(inst.selector.registered, {})
+
+    def test_dispatcher_add_and_del_channel(self):
+        from waitress.wasyncore import dispatcher
+        inst = self._makeOne()
+        disp = dispatcher(sock=dummysocket(), map=inst)
+        self.assertEqual(inst.selector.registered,
+                         {42: asyncore.selectors.EVENT_READ})
+        disp.del_channel()
+        self.assertEqual(inst, {})
+        self.assertEqual(inst.selector.registered, {})
+
+    def test_dispatcher_interest_changed(self):
+        from waitress.wasyncore import dispatcher
+        inst = self._makeOne()
+        disp = dispatcher(sock=dummysocket(), map=inst)
+        inst.changed.clear()
+        disp.interest_changed()
+        self.assertEqual(inst.changed, set([42]))
+        disp.del_channel()
+        self.assertEqual(inst.changed, set())
+        disp.interest_changed()
+        self.assertEqual(inst.changed, set())
+
+    def test_dispatcher_interest_changed_plain_map(self):
+        from waitress.wasyncore import dispatcher
+        map = {}
+        disp = dispatcher(sock=dummysocket(), map=map)
+        disp.interest_changed()
+        self.assertEqual(map, {42: disp})
+
+class Test_make_socket_map(unittest.TestCase):
+    def _callFUT(self, use_selectors):
+        from waitress.wasyncore import make_socket_map
+        return make_socket_map(use_selectors)
+
+    def test_plain(self):
+        self.assertEqual(type(self._callFUT(False)), dict)
+
+    @unittest.skipIf(asyncore.selectors is None, 'selectors module required')
+    def test_selectors(self):
+        from waitress.wasyncore import selector_map
+        result = self._callFUT(True)
+        self.assertEqual(type(result), selector_map)
+        result.selector.close()
+
+@unittest.skipIf(asyncore.selectors is None, 'selectors module required')
+class Test_poll_selector(unittest.TestCase):
+    def _callFUT(self, timeout=0.0, map=None):
+        from waitress.wasyncore import poll_selector
+        return poll_selector(timeout, map)
+
+    def _makeMap(self):
+        from waitress.wasyncore import selector_map
+        return selector_map()
+
+    def test_nothing_writable_nothing_readable_but_map_not_empty(self):
+        dummy_time = DummyTime()
+        map = self._makeMap()
+        map[0] = DummyDispatcher()
+        try:
+            from waitress import wasyncore
+            old_time = wasyncore.time
+            wasyncore.time = dummy_time
+            result = self._callFUT(map=map)
+        finally:
+            wasyncore.time = old_time
+            map.selector.close()
+        self.assertEqual(result, None)
+        self.assertEqual(dummy_time.sleepvals, [0.0])
+
+    def test_dispatches_ready_events(self):
+        r, w = socket.socketpair()
+        map = self._makeMap()
+        try:
+            reader = DummyDispatcher()
+            reader.readable = lambda: True
+            writer = DummyDispatcher()
+            writer.writable = lambda: True
+            map[r.fileno()] = reader
+            map.register(r.fileno())
+            map[w.fileno()] = writer
+            map.register(w.fileno())
+            w.send(b'x')
+            self._callFUT(map=map)
+            self.assertTrue(reader.read_event_handled)
+            self.assertFalse(reader.write_event_handled)
+            self.assertTrue(writer.write_event_handled)
+            self.assertFalse(writer.read_event_handled)
+            self.assertEqual(map.events, {
+                r.fileno(): asyncore.selectors.EVENT_READ,
+                w.fileno(): asyncore.selectors.EVENT_WRITE,
+            })
+        finally:
+            map.selector.close()
+            r.close()
+            w.close()
+
+    def test_accepting_not_writable(self):
+        r, w = socket.socketpair()
+        map = self._makeMap()
+        try:
+            disp = DummyDispatcher()
+            disp.accepting = True
+            disp.readable = lambda: True
+            disp.writable = lambda: True
+            map[r.fileno()] = disp
+            map.register(r.fileno())
+            self._callFUT(map=map)
+            self.assertEqual(map.events,
+                             {r.fileno(): asyncore.selectors.EVENT_READ})
+        finally:
+            map.selector.close()
+            r.close()
+            w.close()
+
+    def test_only_changed_channels_asked(self):
+        r, w = socket.socketpair()
+        map = self._makeMap()
+        try:
+            asked = []
+            idle = DummyDispatcher()
+            idle.readable = lambda: asked.append('idle') or True
+            disp = DummyDispatcher()
+            disp.readable = lambda: asked.append('disp') or False
+            map[r.fileno()] = idle
+            map.register(r.fileno())
+            map[w.fileno()] = disp
+            map.register(w.fileno())
+            self._callFUT(map=map)
+            self.assertEqual(sorted(asked), ['disp', 'idle'])
+            # no events, and nothing changed
+            del asked[:]
+            self._callFUT(map=map)
+            self.assertEqual(asked, [])
+            self.assertEqual(map.events,
+                             {r.fileno(): asyncore.selectors.EVENT_READ})
+            # told about a change, e.g. by a task thread
+            map.changed.add(w.fileno())
+            self._callFUT(map=map)
+            self.assertEqual(asked, ['disp'])
+            # asked again after handling an event
+            del asked[:]
+            w.send(b'x')
+            self._callFUT(map=map)
+            self.assertTrue(idle.read_event_handled)
+            self._callFUT(map=map)
+            self.assertEqual(asked, ['idle'])
+        finally:
+            map.selector.close()
+            r.close()
+            w.close()
+
+    def test_listeners_asked_every_poll(self):
+        r, w = socket.socketpair()
+        map = self._makeMap()
+        try:
+            asked = []
+            disp = DummyDispatcher()
+            disp.accepting = True
+            disp.readable = lambda: asked.append(1) or False
+            map[r.fileno()] = disp
+            map.register(r.fileno())
+            self._callFUT(map=map)
+            self._callFUT(map=map)
+            self.assertEqual(asked, [1, 1])
+        finally:
+            map.selector.close()
+            r.close()
+            w.close()
+
+    def test_removed_channel_skipped(self):
+        map = self._makeMap()
+        map.changed.add(99)
+        dummy_time = DummyTime()
+        try:
+            from waitress import wasyncore
+            old_time = wasyncore.time
+            wasyncore.time = dummy_time
+            map[0] = DummyDispatcher()
+            self._callFUT(map=map)
+        finally:
+            wasyncore.time = old_time
+            map.selector.close()
+        self.assertEqual(map.changed, set())
+
+    def test_loop_uses_poll_selector(self):
+        map = self._makeMap()
+        map[0] = DummyDispatcher()
+        dummy_time = DummyTime()
+        try:
+            from waitress import wasyncore
+            old_time = wasyncore.time
+            wasyncore.time = dummy_time
+            wasyncore.loop(timeout=0.5, map=map, count=1)
+        finally:
+            wasyncore.time = old_time
+            map.selector.close()
+        self.assertEqual(dummy_time.sleepvals, [0.5])
+
+@unittest.skipIf(asyncore.selectors is None, 'selectors module required')
+class Test_readwrite_selector(unittest.TestCase):
+    def _callFUT(self, obj, events):
+        from waitress.wasyncore import readwrite_selector
+        return readwrite_selector(obj, events)
+
+    def test_handle_read_event(self):
+        inst = DummyDispatcher()
+        self._callFUT(inst, asyncore.selectors.EVENT_READ)
+        self.assertTrue(inst.read_event_handled)
+        self.assertFalse(inst.write_event_handled)
+
+    def test_handle_write_event(self):
+        inst = DummyDispatcher()
+        self._callFUT(inst, asyncore.selectors.EVENT_WRITE)
+        self.assertFalse(inst.read_event_handled)
+        self.assertTrue(inst.write_event_handled)
+
+    def test_socketerror_not_in_disconnected(self):
+        inst = DummyDispatcher(socket.error(errno.EALREADY, 'EALREADY'))
+        self._callFUT(inst, asyncore.selectors.EVENT_READ)
+        self.assertTrue(inst.error_handled)
+
+    def test_socketerror_in_disconnected(self):
+        inst = DummyDispatcher(socket.error(errno.ECONNRESET, 'ECONNRESET'))
+        self._callFUT(inst, asyncore.selectors.EVENT_READ)
+        self.assertTrue(inst.close_handled)
+
+    def test_exception_in_reraised(self):
+        from waitress import wasyncore
+        inst = DummyDispatcher(wasyncore.ExitNow)
+        self.assertRaises(wasyncore.ExitNow,
+                          self._callFUT, inst, asyncore.selectors.EVENT_READ)
+
+    def test_exception_not_in_reraised(self):
+        inst = DummyDispatcher(ValueError)
+        self._callFUT(inst, asyncore.selectors.EVENT_READ)
+        self.assertTrue(inst.error_handled)
+
 class Test_dispatcher(unittest.TestCase):
     def _makeOne(self, sock=None, map=None):
         from waitress.wasyncore import dispatcher
@@ -1443,6 +1742,89 @@ class Test_dispatcher(unittest.TestCase):
         inst = self._makeOne(sock=sock, map=map)
         self.assertRaises(socket.error, inst.send, 'a')
 
+    @unittest.skipUnless(hasattr(socket.socket, 'sendmsg'), 'no sendmsg')
+    def test_sendmsg(self):
+        a, b = socket.socketpair()
+        try:
+            inst = self._makeOne(sock=a, map={})
+            result = inst.sendmsg([b'hello', memoryview(b' world')])
+            self.assertEqual(result, 11)
+            self.assertEqual(b.recv(11), b'hello world')
+        finally:
+            a.close()
+            b.close()
+
+    def test_sendmsg_raise_EWOULDBLOCK(self):
+        sock = dummysocket()
+        def sendmsg(*arg, **kw):
+            raise socket.error(errno.EWOULDBLOCK)
+        sock.sendmsg = sendmsg
+        inst = self._makeOne(sock=sock, map={})
+        self.assertEqual(inst.sendmsg([b'a', b'b']), 0)
+
+    def test_sendmsg_raise_disconnect(self):
+        sock = dummysocket()
+        def sendmsg(*arg, **kw):
+            raise socket.error(errno.ECONNRESET)
+        sock.sendmsg = sendmsg
+        inst = self._makeOne(sock=sock, map={})
+        inst.handle_close = lambda: setattr(inst, 'close_handled', True)
+        self.assertEqual(inst.sendmsg([b'a', b'b']), 0)
+        self.assertTrue(inst.close_handled)
+
+    def test_sendmsg_raise_unexpected_socketerror(self):
+        sock = dummysocket()
+        def sendmsg(*arg, **kw):
+            raise socket.error(122)
+        sock.sendmsg = sendmsg
+        inst = self._makeOne(sock=sock, map={})
+        self.assertRaises(socket.error, inst.sendmsg, [b'a', b'b'])
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), 'no os.sendfile')
+    def test_sendfile(self):
+        import tempfile
+        a, b = socket.socketpair()
+        f = tempfile.TemporaryFile()
+        try:
+            f.write(b'hello world')
+            f.flush()
+            inst = self._makeOne(sock=a, map={})
+            result = inst.sendfile(f.fileno(), 6, 5)
+            self.assertEqual(result, 5)
+            self.assertEqual(b.recv(5), b'world')
+        finally:
+            f.close()
+            a.close()
+            b.close()
+
+    def _sendfile_raising(self, err):
+        from waitress import wasyncore
+        class DummyOS(object):
+            def sendfile(self, *arg):
+                raise OSError(err, 'error')
+        sock = dummysocket()
+        inst = self._makeOne(sock=sock, map={})
+        inst.handle_close = lambda: setattr(inst, 'close_handled', True)
+        orig = wasyncore.os
+        wasyncore.os = DummyOS()
+        try:
+            return inst, inst.sendfile(1, 0, 10)
+        finally:
+            wasyncore.os = orig
+
+    def test_sendfile_raise_EWOULDBLOCK(self):
+        inst, result = self._sendfile_raising(errno.EWOULDBLOCK)
+        self.assertEqual(result, 0)
+        self.assertFalse(hasattr(inst, 'close_handled'))
+
+    def test_sendfile_raise_disconnect(self):
+        inst, result = self._sendfile_raising(errno.EPIPE)
+        self.assertEqual(result, 0)
+        self.assertTrue(inst.close_handled)
+
+    def test_sendfile_raise_unexpected_error(self):
+        self.assertRaises(OSError, self._sendfile_raising, errno.EINVAL)
+
     def test_recv_raises_disconnect(self):
         sock = dummysocket()
         map = {}
@@ -1457,6 +1839,48 @@ class Test_dispatcher(unittest.TestCase):
         self.assertEqual(result, b'')
         self.assertTrue(inst.close_handled)
 
+    def test_recv_into(self):
+        a, b = socket.socketpair()
+        try:
+            inst = self._makeOne(sock=a, map={})
+            b.sendall(b'hello')
+            buf = bytearray(10)
+            result = inst.recv_into(buf)
+            self.assertEqual(result, 5)
+            self.assertEqual(buf[:5], b'hello')
+        finally:
+            a.close()
+            b.close()
+
+    def test_recv_into_closed(self):
+        a, b = socket.socketpair()
+        try:
+            inst = self._makeOne(sock=a, map={})
+            inst.handle_close = lambda: setattr(inst, 'close_handled', True)
+            b.close()
+            self.assertEqual(inst.recv_into(bytearray(10)), 0)
+            self.assertTrue(inst.close_handled)
+        finally:
+            a.close()
+
+    def test_recv_into_raises_disconnect(self):
+        sock = dummysocket()
+        def recv_into(*arg, **kw):
+            raise socket.error(errno.ECONNRESET)
+        sock.recv_into = recv_into
+        inst = self._makeOne(sock=sock, map={})
+        inst.handle_close = lambda: setattr(inst, 'close_handled', True)
+        self.assertEqual(inst.recv_into(bytearray(1)), 0)
+        self.assertTrue(inst.close_handled)
+
+    def test_recv_into_raises_unexpected_socketerror(self):
+        sock = dummysocket()
+        def recv_into(*arg, **kw):
+            raise socket.error(122)
+        sock.recv_into = recv_into
+        inst = self._makeOne(sock=sock, map={})
+        self.assertRaises(socket.error, inst.recv_into, bytearray(1))
+
     def test_close_raises_unknown_socket_error(self):
         sock = dummysocket()
         map = {}
@@ -1648,6 +2072,25 @@ class DummySelect(object):
     def poll(self):
         return self.pollster
 
+class DummySelector(object):
+    def __init__(self):
+        self.registered = {}
+        self.calls = []
+
+    def register(self, fd, events):
+        self.calls.append('register')
+        if fd in self.registered:
+            raise KeyError(fd)
+        self.registered[fd] = events
+
+    def modify(self, fd, events):
+        self.calls.append('modify')
+        self.registered[fd] = events
+
+    def unregister(self, fd):
+        self.calls.append('unregister')
+        del self.registered[fd]
+
 class DummyPollster(object):
     def __init__(self, exc=None):
         self.polled = []
@@ -12,10 +12,10 @@
 #
 ##############################################################################
 
+from collections import deque
 import os
 import socket
 import errno
-import threading
 
 from . import wasyncore
 
@@ -52,19 +52,21 @@ from . import wasyncore
 class _triggerbase(object):
     """OS-independent base class for OS-dependent trigger class."""
 
-    kind = None # subclass must set to "pipe" or "loopback"; used by repr
+    kind = None # subclass sets "eventfd", "pipe" or "loopback"; used by repr
+
+    # Set once the trigger has been pulled, until handle_read drains it; the
+    # pulls made in the meantime have nothing to add, so they cost no system
+    # call.
+    pulled = False
 
     def __init__(self):
         self._closed = False
 
-        # `lock` protects the `thunks` list from being traversed and
-        # appended to simultaneously.
-        self.lock = threading.Lock()
-
-        # List of no-argument callbacks to invoke when the trigger is
+        # Queue of no-argument callbacks to invoke when the trigger is
         # pulled.  These run in the thread running the wasyncore mainloop,
-        # regardless of which thread pulls the trigger.
-        self.thunks = []
+        # regardless of which thread pulls the trigger.  deque.append and
+        # deque.popleft are atomic, so it needs no lock.
+        self.thunks = deque()
 
     def readable(self):
         return True
@@ -90,29 +92,37 @@ class _triggerbase(object):
 
     def pull_trigger(self, thunk=None):
         if thunk:
-            with self.lock:
-                self.thunks.append(thunk)
-        self._physical_pull()
+            self.thunks.append(thunk)
+        if not self.pulled:
+            self.pulled = True
+            self._physical_pull()
 
     def handle_read(self):
         try:
             self.recv(8192)
         except (OSError, socket.error):
             return
-        with self.lock:
-            for thunk in self.thunks:
-                try:
-                    thunk()
-                except:
-                    nil, t, v, tbinfo = wasyncore.compact_traceback()
-                    self.log_info(
-                        'exception in trigger thunk: (%s:%s %s)' %
-                        (t, v, tbinfo))
-            self.thunks = []
+        # Only now, so that a pull made before the recv() cannot be drained
+        # with the flag left set.  A pull skipped between the two needs no
+        # wakeup: the mainloop is running, and the thunks are run below.
+        self.pulled = False
+        # A thunk queued while these run is run too; one queued after the
+        # queue is found empty comes with a pull of its own, as the flag is
+        # clear by then.
+        thunks = self.thunks
+        while thunks:
+            thunk = thunks.popleft()
+            try:
+                thunk()
+            except:
+                nil, t, v, tbinfo = wasyncore.compact_traceback()
+                self.log_info(
+                    'exception in trigger thunk: (%s:%s %s)' %
+                    (t, v, tbinfo))
 
 if os.name == 'posix':
 
-    class trigger(_triggerbase, wasyncore.file_dispatcher):
+    class pipe_trigger(_triggerbase, wasyncore.file_dispatcher):
         kind = "pipe"
 
         def __init__(self, map):
@@ -129,6 +139,28 @@ if os.name == 'posix':
         def _physical_pull(self):
             os.write(self.trigger, b'x')
 
+    trigger = pipe_trigger
+
+    if hasattr(os, 'eventfd'):
+
+        class eventfd_trigger(pipe_trigger):
+            # Linux (Python 3.10 and later): a pull adds one to the counter
+            # of an eventfd, which a single read() resets, rather than
+            # writing a byte to a pipe that may fill up.  One file
+            # descriptor instead of two.
+            kind = "eventfd"
+
+            def __init__(self, map):
+                _triggerbase.__init__(self)
+                self.trigger = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+                self._fds = [self.trigger]
+                wasyncore.file_dispatcher.__init__(self, self.trigger, map=map)
+
+            def _physical_pull(self):
+                os.eventfd_write(self.trigger, 1)
+
+        trigger = eventfd_trigger
+
 else: # pragma: no cover
     # Windows version; uses just sockets, because a pipe isn't select'able
     # on Windows.
@@ -25,22 +25,18 @@ import calendar
 logger = logging.getLogger('waitress')
 queue_logger = logging.getLogger('waitress.queue')
 
-def find_double_newline(s):
-    """Returns the position just after a double newline in the given string."""
-    pos1 = s.find(b'\n\r\n') # One kind of double newline
-    if pos1 >= 0:
-        pos1 += 3
-    pos2 = s.find(b'\n\n')   # Another kind of double newline
-    if pos2 >= 0:
-        pos2 += 2
-
-    if pos1 >= 0:
-        if pos2 >= 0:
-            return min(pos1, pos2)
-        else:
-            return pos1
-    else:
-        return pos2
+# Either kind of double newline; the leftmost match is also the one that
+# ends first, as the two forms can't overlap.
+double_newline_re = re.compile(b'\n\r?\n')
+
+def find_double_newline(s, start=0):
+    """Returns the position just after the first double newline in the given
+    string that starts at or after ``start``, or -1.  ``s`` may be any
+    bytes-like object, including a memoryview."""
+    match = double_newline_re.search(s, max(start, 0))
+    if match is None:
+        return -1
+    return match.end()
 
 def concat(*args):
     return ''.join(args)
@@ -156,6 +152,22 @@ def build_http_date(when):
         day, monthname[month], year,
         hh, mm, ss)
 
+# (second, build_http_date(second)) for the second last asked for
+http_date_cache = (None, None)
+
+def cached_http_date(when):
+    """
+    Same as build_http_date, but only formats the date once per second, for
+    the Date header of every response.
+    """
+    global http_date_cache
+    second = int(when)
+    cached = http_date_cache
+    if cached[0] != second:
+        # a tuple is replaced atomically, threads never see half of it
+        cached = http_date_cache = (second, build_http_date(second))
+    return cached[1]
+
 def parse_http_date(d):
     d = d.lower()
     m = rfc850_reg.match(d)
@@ -204,3 +216,7 @@ class RequestEntityTooLarge(BadRequest):
 class InternalServerError(Error):
     code = 500
     reason = 'Internal Server Error'
+
+class ServiceUnavailable(Error):
+    code = 503
+    reason = 'Service Unavailable'
@@ -66,6 +66,11 @@ from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, EINVAL, \
      ENOTCONN, ESHUTDOWN, EISCONN, EBADF, ECONNABORTED, EPIPE, EAGAIN, EINTR, \
      errorcode
 
+try:
+    import selectors
+except ImportError: # pragma: no cover
+    selectors = None # py2
+
 _DISCONNECTED = frozenset({ECONNRESET, ENOTCONN, ESHUTDOWN, ECONNABORTED, EPIPE,
                            EBADF})
 
@@ -208,11 +213,147 @@ def poll2(timeout=0.0, map=None):
 
 poll3 = poll2                           # Alias for backward compatibility
 
+class selector_map(dict):
+    """A socket map whose channels stay registered with a ``selectors``
+    selector (epoll, kqueue, ...) between loop iterations.
+
+    Channels are registered once when they are added to the map and
+    unregistered when they are removed from it.  A poll only asks the
+    channels that may have changed for ``readable()`` / ``writable()``:
+    those that had events on the previous poll, those whose
+    ``interest_changed()`` was called since, and listening sockets, whose
+    answers depend on the rest of the map.  The cost of a poll is then
+    proportional to the number of active sockets rather than to the number
+    of open ones.
+    """
+
+    def __init__(self, selector=None):
+        dict.__init__(self)
+        if selector is None:
+            selector = selectors.DefaultSelector()
+        self.selector = selector
+        # fd -> events currently registered with the selector
+        self.events = {}
+        # fds whose readable() / writable() are asked on the next poll;
+        # added to by other threads
+        self.changed = set()
+
+    def register(self, fd):
+        # Nearly every dispatcher starts out readable (listeners, triggers,
+        # freshly accepted channels); the next poll corrects the interest.
+        self.set_events(fd, selectors.EVENT_READ)
+        self.changed.add(fd)
+
+    def unregister(self, fd):
+        self.changed.discard(fd)
+        if self.events.pop(fd, 0):
+            try:
+                self.selector.unregister(fd)
+            except (KeyError, ValueError): # pragma: no cover
+                pass
+
+    def set_events(self, fd, events):
+        current = self.events.get(fd, 0)
+        if events == current:
+            return
+        selector = self.selector
+        if not events:
+            # selectors can't express "no interest"; keeping the fd
+            # registered would make a level-triggered poller spin on it.
+            selector.unregister(fd)
+            del self.events[fd]
+            return
+        if current:
+            selector.modify(fd, events)
+        else:
+            try:
+                selector.register(fd, events)
+            except KeyError:
+                # The fd number was reused after a socket was closed
+                # without going through del_channel.
+                selector.unregister(fd)
+                selector.register(fd, events)
+        self.events[fd] = events
+
+    def clear(self):
+        for fd in list(self.events):
+            self.unregister(fd)
+        dict.clear(self)
+
+def make_socket_map(use_selectors=False):
+    """Return a new socket map; a :class:`selector_map` if
+    ``use_selectors`` is true and the ``selectors`` module is available,
+    otherwise a plain dictionary."""
+    if use_selectors and selectors is not None:
+        return selector_map()
+    return {}
+
+def readwrite_selector(obj, events):
+    try:
+        if events & selectors.EVENT_READ:
+            obj.handle_read_event()
+        if events & selectors.EVENT_WRITE:
+            obj.handle_write_event()
+    except socket.error as e:
+        if e.args[0] not in _DISCONNECTED:
+            obj.handle_error()
+        else:
+            obj.handle_close()
+    except _reraised_exceptions:
+        raise
+    except:
+        obj.handle_error()
+
+def poll_selector(timeout=0.0, map=None):
+    # Use the persistent registrations of a selector_map
+    if map is None: # pragma: no cover
+        map = socket_map
+    if map:
+        changed = map.changed
+        listeners = []
+        while changed:
+            # set.pop() is atomic; fds added by other threads meanwhile are
+            # either seen here or on the next poll
+            fd = changed.pop()
+            obj = map.get(fd)
+            if obj is None:
+                continue
+            events = 0
+            if obj.readable():
+                events |= selectors.EVENT_READ
+            # accepting sockets should not be writable
+            if obj.writable() and not obj.accepting:
+                events |= selectors.EVENT_WRITE
+            if obj.accepting:
+                # whether another connection is accepted depends on the
+                # rest of the map (connection_limit, ...); ask every time
+                listeners.append(fd)
+            map.set_events(fd, events)
+        changed.update(listeners)
+
+        if not map.events:
+            time.sleep(timeout)
+            return
+
+        # Errors and hangups are reported as read and write readiness by
+        # the selectors module; recv()/send() then notice the condition.
+        for key, events in map.selector.select(timeout):
+            fd = key.fd
+            obj = map.get(fd)
+            if obj is None: # pragma: no cover
+                continue
+            readwrite_selector(obj, events)
+            # handling an event is what changes a channel's interest the
+            # most often (output sent, a request read, ...)
+            changed.add(fd)
+
 def loop(timeout=30.0, use_poll=False, map=None, count=None):
     if map is None: # pragma: no cover
         map = socket_map
 
-    if use_poll and hasattr(select, 'poll'):
+    if isinstance(map, selector_map):
+        poll_fun = poll_selector
+    elif use_poll and hasattr(select, 'poll'):
         poll_fun = poll2
     else:
         poll_fun = poll
@@ -310,6 +451,22 @@ class dispatcher:
         if map is None:
             map = self._map
         map[self._fileno] = self
+        if isinstance(map, selector_map):
+            map.register(self._fileno)
+
+    def interest_changed(self):
+        """
+        Tells the socket map that ``readable()`` or ``writable()`` may answer
+        differently than the last time they were asked, for some other
+        reason than an event on the socket having been handled.  Needed for
+        a :class:`selector_map` only, which asks the channels that had no
+        events again only after this; may be called from any thread, before
+        waking the loop.
+        """
+        changed = getattr(self._map, 'changed', None)
+        fd = self._fileno
+        if changed is not None and fd is not None:
+            changed.add(fd)
 
     def del_channel(self, map=None):
         fd = self._fileno
@@ -318,6 +475,8 @@ class dispatcher:
         if fd in map:
             #self.log_info('closing channel %d:%s' % (fd, self))
             del map[fd]
+            if isinstance(map, selector_map):
+                map.unregister(fd)
         self._fileno = None
 
     def create_socket(self, family=socket.AF_INET, type=socket.SOCK_STREAM):
@@ -409,6 +568,35 @@ class dispatcher:
             else:
                 raise
 
+    def sendmsg(self, buffers):
+        """Send the bytes-like objects in ``buffers`` with a single
+        ``sendmsg()`` call.  Only available where ``socket.sendmsg`` is."""
+        try:
+            result = self.socket.sendmsg(buffers)
+            return result
+        except socket.error as why:
+            if why.args[0] == EWOULDBLOCK:
+                return 0
+            elif why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            else:
+                raise
+
+    def sendfile(self, fd, offset, count):
+        """Send ``count`` bytes of the file ``fd``, starting at ``offset``,
+        with ``os.sendfile``.  Only available where ``os.sendfile`` is."""
+        try:
+            return os.sendfile(self.socket.fileno(), fd, offset, count)
+        except OSError as why:
+            if why.args[0] == EWOULDBLOCK:
+                return 0
+            elif why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            else:
+                raise
+
     def recv(self, buffer_size):
         try:
             data = self.socket.recv(buffer_size)
@@ -427,6 +615,24 @@ class dispatcher:
             else:
                 raise
 
+    def recv_into(self, buffer, nbytes=0):
+        """Read into the writable bytes-like ``buffer``; returns the number
+        of bytes read, 0 once the connection has been closed."""
+        try:
+            result = self.socket.recv_into(buffer, nbytes)
+            if not result:
+                # a closed connection is indicated by signaling
+                # a read condition, and having recv_into() return 0.
+                self.handle_close()
+            return result
+        except socket.error as why:
+            # winsock sometimes raises ENOTCONN
+            if why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            else:
+                raise
+
     def close(self):
         self.connected = False
         self.accepting = False